@@ -54,6 +54,15 @@ class Plugin(em.Plugin):
                                    "(default to <CRYOSPARC_HOME>/scipion_projects)",
                        var_type=VarTypes.FOLDER)
 
+        cls._defineVar(CRYOSPARC_CS2STAR_CACHE, CS2STAR_CACHE_DEFAULT_DIR,
+                       description="Folder where the .star files converted from cryoSPARC .cs files are cached.",
+                       var_type=VarTypes.FOLDER)
+
+        cls._defineVar(CRYOSPARC_CS2STAR_CACHE_SIZE, CS2STAR_CACHE_DEFAULT_SIZE,
+                       description="Maximum size (MB) of the .cs to .star conversion cache, the least recently "
+                                   "used files are removed first. Use 0 to disable the cache.",
+                       var_type=VarTypes.INTEGER)
+
         cls._defineVar(CRYOSPARC_PASSWORD, None,
                        description='The password with which cryoSPARC was installed. This is only required for the use '
                                    'of the Flexutils plugin and its connection to the 3D flex training protocol.')
@@ -25,6 +25,7 @@
 # *
 # **************************************************************************
 import enum
+import os
 from pwem.constants import (
     SYM_CYCLIC, SYM_TETRAHEDRAL, SYM_OCTAHEDRAL, SYM_I222,
     SYM_I222r)
@@ -39,13 +40,43 @@ CRYO_PROJECTS_DIR = 'CRYO_PROJECTS_DIR'
 CRYOSPARC_USER = 'CRYOSPARC_USER'
 CRYOSPARC_PASSWORD = 'CRYOSPARC_PASSWORD'
 CRYOSPARC_USE_SSD = 'CRYOSPARC_USE_SSD'
+CRYOSPARC_IMPORT_PARTICLES_CS = 'CRYOSPARC_IMPORT_PARTICLES_CS'
+# Optional: maximum number of parallel .cs to .star conversions
+CRYOSPARC_CS2STAR_WORKERS = 'CRYOSPARC_CS2STAR_WORKERS'
+# Optional: how the cryoSPARC outputs are placed in the protocol folders (see
+# COPY_MODES), by default the cheapest mode the filesystem supports
+CRYOSPARC_COPY_MODE = 'CRYOSPARC_COPY_MODE'
+# Optional: if on, the outputs are symlinks to the cryoSPARC job files, that
+# are only copied if the job is cleared (see utils.materializeFiles)
+CRYOSPARC_LAZY_OUTPUTS = 'CRYOSPARC_LAZY_OUTPUTS'
+# Optional: folder and size (in MB, 0 disables it) of the .cs to .star cache
+CRYOSPARC_CS2STAR_CACHE = 'CRYOSPARC_CS2STAR_CACHE'
+CRYOSPARC_CS2STAR_CACHE_SIZE = 'CRYOSPARC_CS2STAR_CACHE_SIZE'
 CRYOSPARC_MASTER = 'cryosparc_master'
 CRYOSPARC_STANDALONE_INSTALLATION = 'CRYOSPARC_STANDALONE_INSTALLATION'
 CRYOSPARC_DEFAULT_LANE = 'CRYOSPARC_DEFAULT_LANE'
 CRYOSPARC_VERSION_FILE = 'version'
 CRYOSPARC_CONFIG_FILE = 'config.sh'
 CRYOSPARC_LICENSE_ID_VARIABLE = 'CRYOSPARC_LICENSE_ID'
+CRYOSPARC_MASTER_HOSTNAME_VARIABLE = 'CRYOSPARC_MASTER_HOSTNAME'
+CRYOSPARC_BASE_PORT_VARIABLE = 'CRYOSPARC_BASE_PORT'
+CRYOSPARC_COMMAND_CORE_PORT_OFFSET = 2  # command_core listens on base port + 2
 CRYOSPARC_CS2STAR_SCRIPT = 'cs2Start.py'
+CS2STAR_WORKER_STOP_TIMEOUT = 10  # seconds
+CS2STAR_CACHE_DEFAULT_SIZE = 2048  # MB
+
+# copyFiles modes
+COPY_MODE_AUTO = 'auto'  # hardlink, reflink or copy, the first that works
+COPY_MODE_HARDLINK = 'hardlink'
+COPY_MODE_REFLINK = 'reflink'  # copy-on-write clone (btrfs, xfs...)
+COPY_MODE_SYMLINK = 'symlink'
+COPY_MODE_COPY = 'copy'
+COPY_MODES = [COPY_MODE_AUTO, COPY_MODE_HARDLINK, COPY_MODE_REFLINK,
+              COPY_MODE_SYMLINK, COPY_MODE_COPY]
+FICLONE = 0x40049409  # linux ioctl to clone a file
+CS2STAR_CACHE_DEFAULT_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'scipion-em-cryosparc2', 'cs2star')
 
 
 def getPyemEnvName(version):
@@ -152,6 +183,9 @@ fscValues['fsc_sphericalmask'] = 'Spherical'
 fscValues['fsc_prmm'] = 'Phase randomized'
 
 excludedFSCValues = ['fsc_noisesub_raw', 'fsc_noisesub_true']
+# Parsed FSC curves, cached next to the fsc.txt file (see readCryosparcFsc)
+FSC_CACHE_SUFFIX = '_curves.npz'
+FSC_CACHE_SOURCE = '__source__'
 
 HALF_EVEN = 0
 HALF_ODD = 1
@@ -545,3 +579,29 @@ ALIGNMENT_DICT = {
     "_rlnOriginXAngst": RELIONCOLUMNS.rlnOriginXAngst.value,
     "_rlnOriginYAngst": RELIONCOLUMNS.rlnOriginYAngst.value,
     "_rlnOriginZAngst": RELIONCOLUMNS.rlnOriginZAngst.value}
+
+# Extra column of the rows read from .cs files with the alignment matrix of
+# each particle, computed for a whole batch of particles (shifts in Angstroms)
+ALIGNMENT_MATRIX_LABEL = 'alignmentMatrix'
+
+# Number of particles whose alignment is converted at once
+CONVERT_BATCH_SIZE = 100000
+# Buffer size of the STAR files written by the columnar particle writer
+STAR_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# Sign of the particle images imported in cryoSPARC (-1: dark particles on
+# a light background, the cryoSPARC default for non flipped data)
+CS_BLOB_SIGN = -1.0
+
+# Imports done in a cryoSPARC project, shared by the protocols of a Scipion
+# project (see utils.ImportCache)
+IMPORT_CACHE_FILE = 'import_cache.json'
+# Size of the blocks read when hashing the imported files
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Files copied by copyFiles, so an interrupted copy resumes where it stopped
+COPY_MANIFEST_FILE = '.scipion_copy_manifest.jsonl'
+# Optional: number of files copied at the same time by copyFiles
+CRYOSPARC_COPY_THREADS = 'CRYOSPARC_COPY_THREADS'
+COPY_DEFAULT_THREADS = 4
+# Size of the blocks copied at once
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
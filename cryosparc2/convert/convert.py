@@ -25,6 +25,13 @@
 # *
 # **************************************************************************
 import  subprocess
+import atexit
+import hashlib
+import json
+import shutil
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import emtable
 import numpy as np
@@ -32,6 +39,8 @@ import os
 import argparse
 import sys
 import logging
+import operator
+from collections import OrderedDict
 logger = logging.getLogger(__name__)
 
 from emtable.metadata import _guessType
@@ -45,16 +54,44 @@ from pwem.constants import *
 
 from ..constants import *
 from .. import Plugin
+from .csreader import iterCsRows, logmap, euler2rot
 
 
 def convertCs2Star(argsList):
-    input = os.path.abspath(argsList[0])
-    output = os.path.abspath(argsList[1])
+    """ Convert a .cs file into a .star file with pyem
+    :param argsList: [input .cs file, output .star file]
+    """
+    return convertCs2StarFiles([(argsList[0], argsList[1])])[0]
+
+
+def convertCs2StarFiles(filesList, progress=None):
+    """ Convert several .cs files in parallel with the pool of conversion
+    workers (see getCs2StarPool).
+    :param filesList: list of (input .cs file, output .star file)
+    :param progress: optional function called with (done, total, files) as
+                     each file is converted
+    :returns the list of exit codes (0 on success)
+    """
+    filesList = [(os.path.abspath(inputFn), os.path.abspath(outputFn))
+                 for inputFn, outputFn in filesList]
+    results = getCs2StarPool().convert(filesList, progress=progress)
+
+    for (inputFn, _), result in zip(filesList, results):
+        if result != 0:
+            logger.error("convertCs2Star: %s could not be converted" % inputFn)
+    return results
+
+
+def _getCs2StarCmd(args):
     cryosparcScriptPath = os.path.join(os.path.dirname(__file__),
                                        CRYOSPARC_CS2STAR_SCRIPT)
-    cmd = (Plugin.getCondaActivationCmd() + Plugin.getPyemEnvActivation() + ' && python3 ' +
-           cryosparcScriptPath + ' %s %s' % (input, output))
+    return (Plugin.getCondaActivationCmd() + Plugin.getPyemEnvActivation() +
+            ' && exec python3 ' + cryosparcScriptPath + ' ' + args)
+
 
+def _convertCs2StarProcess(inputFn, outputFn):
+    """ Convert a file in a new process of the pyem environment """
+    cmd = _getCs2StarCmd('%s %s' % (inputFn, outputFn))
     logger.info("convertCs2Star: %s" % cmd)
 
     process = subprocess.Popen(cmd, shell=True, cwd=os.getcwd(), stdout=subprocess.PIPE,
@@ -62,6 +99,242 @@ def convertCs2Star(argsList):
     out, error = process.communicate()
     logger.info(out.decode())
     logger.error(error.decode())
+    return process.returncode
+
+
+class Cs2StarWorker:
+    """ Long-lived cs2Start.py process in the pyem environment. The conda
+    activation and the pandas/pyem imports are paid once, then every request
+    converts one or several files (see cs2Start.serve).
+    """
+    def __init__(self):
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        cmd = _getCs2StarCmd('--worker')
+        logger.info("Starting the cs2star worker: %s" % cmd)
+        self._process = subprocess.Popen(cmd, shell=True, cwd=os.getcwd(),
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         universal_newlines=True)
+
+    def convert(self, filesList):
+        """ Convert a list of (input .cs file, output .star file)
+        :returns the list of exit codes
+        """
+        request = json.dumps({'files': [list(files) for files in filesList]})
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+            try:
+                self._process.stdin.write(request + '\n')
+                self._process.stdin.flush()
+                response = self._process.stdout.readline()
+            except OSError:
+                response = ''
+            if not response:
+                self._stop()
+                raise Exception("The cs2star worker exited unexpectedly")
+        return json.loads(response)['results']
+
+    def _stop(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=CS2STAR_WORKER_STOP_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+            self._process = None
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+
+class Cs2StarCache:
+    """ Folder of .star files converted from .cs files. An entry is keyed by
+    the content of the .cs file and the converter version (the conversion
+    script, whose argument defaults are the conversion options, and the pyem
+    version). The least recently used entries are removed when the folder
+    exceeds maxSize bytes.
+    """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._version = None
+
+    def _getVersion(self):
+        if self._version is None:
+            scriptPath = os.path.join(os.path.dirname(__file__),
+                                      CRYOSPARC_CS2STAR_SCRIPT)
+            with open(scriptPath, 'rb') as f:
+                scriptHash = hashlib.sha1(f.read()).hexdigest()
+            self._version = (PYEM_VERSION, scriptHash)
+        return self._version
+
+    def getKey(self, inputFn):
+        from ..utils import getFileFingerprint
+        return getFileFingerprint(inputFn, *self._getVersion())
+
+    def _getEntry(self, key):
+        return os.path.join(self.path, key + '.star')
+
+    def get(self, key, outputFn):
+        """ Copy the cached conversion of key to outputFn
+        :returns True if it was found
+        """
+        entry = self._getEntry(key)
+        try:
+            shutil.copyfile(entry, outputFn)
+            os.utime(entry)  # the modification time is the last use
+        except FileNotFoundError:
+            return False
+        return True
+
+    def set(self, key, outputFn):
+        """ Store outputFn as the conversion of key """
+        os.makedirs(self.path, exist_ok=True)
+        entry = self._getEntry(key)
+        tmpFile = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.get_ident())
+        shutil.copyfile(outputFn, tmpFile)
+        os.replace(tmpFile, entry)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.star'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size = sum(entry[1] for entry in entries)
+            for _, entrySize, entryPath in sorted(entries):
+                if size <= self.maxSize:
+                    break
+                pwutils.cleanPath(entryPath)
+                size -= entrySize
+
+
+def getCs2StarCache():
+    """ Return the conversion cache defined by CRYOSPARC_CS2STAR_CACHE and
+    CRYOSPARC_CS2STAR_CACHE_SIZE, or None if it is disabled """
+    size = int(Plugin.getVar(CRYOSPARC_CS2STAR_CACHE_SIZE,
+                             CS2STAR_CACHE_DEFAULT_SIZE) or 0)
+    path = Plugin.getVar(CRYOSPARC_CS2STAR_CACHE, CS2STAR_CACHE_DEFAULT_DIR)
+    if size <= 0 or not path:
+        return None
+    return Cs2StarCache(path, size * 1024 * 1024)
+
+
+class Cs2StarPool:
+    """ Bounded pool of cs2star workers. The files of a conversion are
+    spread over at most `size` worker processes, started on demand and
+    kept alive for the next conversions.
+    """
+    def __init__(self, size, cache=None):
+        self.size = max(1, size)
+        self.cache = cache
+        self._workers = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and len(self._workers) < self.size:
+                worker = Cs2StarWorker()
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+    def _getCacheKey(self, inputFn):
+        if self.cache is not None:
+            try:
+                return self.cache.getKey(inputFn)
+            except OSError:
+                pass  # e.g. a missing file, the conversion reports it
+        return None
+
+    def _convertFile(self, files):
+        key = self._getCacheKey(files[0])
+        if key is not None and self.cache.get(key, files[1]):
+            logger.info("convertCs2Star: %s found in the cache" % files[0])
+            return 0
+
+        result = self._convertWorker(files)
+        if key is not None and result == 0 and os.path.isfile(files[1]):
+            try:
+                self.cache.set(key, files[1])
+            except OSError as e:
+                logger.warning("convertCs2Star: %s could not be cached: %s"
+                               % (files[1], e))
+        return result
+
+    def _convertWorker(self, files):
+        worker = self._acquire()
+        try:
+            return worker.convert([files])[0]
+        except Exception as e:
+            logger.error("The cs2star worker failed, converting %s in a new "
+                         "process" % files[0], exc_info=e)
+            return _convertCs2StarProcess(*files)
+        finally:
+            self._idle.put(worker)
+
+    def convert(self, filesList, progress=None):
+        """ Convert a list of (input .cs file, output .star file)
+        :returns the list of exit codes, in the order of filesList
+        """
+        total = len(filesList)
+        results = [None] * total
+        if not total:
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(self.size, total)) as executor:
+            futures = {executor.submit(self._convertFile, files): i
+                       for i, files in enumerate(filesList)}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                results[i] = future.result()
+                logger.info("convertCs2Star: %d/%d %s" % (done, total,
+                                                          filesList[i][0]))
+                if progress is not None:
+                    progress(done, total, filesList[i])
+        return results
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+
+
+_cs2StarPool = None
+
+
+def getCs2StarPoolSize():
+    """ Number of parallel conversions: CRYOSPARC_CS2STAR_WORKERS if it is
+    defined, otherwise the available cores """
+    size = os.environ.get(CRYOSPARC_CS2STAR_WORKERS)
+    if size:
+        return int(size)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def getCs2StarPool():
+    """ Return the cs2star pool of this process, its workers are stopped on
+    exit """
+    global _cs2StarPool
+    if _cs2StarPool is None:
+        _cs2StarPool = Cs2StarPool(getCs2StarPoolSize(), getCs2StarCache())
+        atexit.register(_cs2StarPool.close)
+    return _cs2StarPool
 
 
 def defineArgs():
@@ -129,6 +402,45 @@ def addRandomSubset(img, imgRow):
     imgRow.setValue(md.RLN_PARTICLE_RANDOM_SUBSET, int(halve))
 
 
+def readCryosparcFsc(fscFile):
+    """ Read the curves of a cryoSPARC fsc.txt file (tab separated, the first
+    column is the wave number). The phase randomized masked map curve,
+    fsc_prmm, is added when the tight mask and noise substitution curves are
+    present. The table is cached in a .npz file next to fscFile and only
+    parsed again if fscFile changes.
+    :returns an OrderedDict {column: numpy array}
+    """
+    cacheFile = os.path.splitext(fscFile)[0] + FSC_CACHE_SUFFIX
+    stat = os.stat(fscFile)
+    source = np.array([stat.st_size, stat.st_mtime_ns])
+    try:
+        with np.load(cacheFile) as cache:
+            if np.array_equal(cache[FSC_CACHE_SOURCE], source):
+                return OrderedDict((column, cache[column])
+                                   for column in cache.files
+                                   if column != FSC_CACHE_SOURCE)
+    except (OSError, KeyError, ValueError):
+        pass  # no cache or an unreadable one
+
+    with open(fscFile) as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        data = np.loadtxt(f, delimiter='\t', ndmin=2)
+    table = OrderedDict(zip(columns, data.T))
+
+    if 'fsc_tightmask' in table and 'fsc_noisesub_true' in table:
+        fscT, fscNT = table['fsc_tightmask'], table['fsc_noisesub_true']
+        table['fsc_prmm'] = (fscT - fscNT) / (1.0 - np.where(fscNT != 1, fscNT, 0.99))
+
+    try:
+        tmpFile = '%s.%d.tmp.npz' % (cacheFile, os.getpid())
+        np.savez(tmpFile, **{FSC_CACHE_SOURCE: source}, **table)
+        os.replace(tmpFile, cacheFile)
+    except OSError as e:
+        logger.warning("The FSC curves of %s could not be cached: %s"
+                       % (fscFile, e))
+    return table
+
+
 def cryosparcToLocation(filename):
     """ Return a location (index, filename) given
     a cryoSPARC filename with the index@filename structure. """
@@ -151,11 +463,28 @@ def setOfImagesToMd(imgSet, imgMd, imgToFunc, **kwargs):
     if 'alignType' not in kwargs:
         kwargs['alignType'] = imgSet.getAlignment()
 
+    # The alignments are converted in batches, the rows are written once
+    # their alignment has been set
+    pendingRows = []
+    pendingAlignments = []
+    kwargs['pendingAlignments'] = pendingAlignments
+
+    def writePendingRows():
+        if pendingAlignments:
+            alignmentsToRows(pendingAlignments, kwargs['alignType'])
+        for objId, imgRow in pendingRows:
+            imgRow.writeToMd(imgMd, objId)
+        pendingRows.clear()
+        pendingAlignments.clear()
+
     for img in imgSet:
         objId = imgMd.addObject()
         imgRow = md.Row()
         imgToFunc(img, imgRow, **kwargs)
-        imgRow.writeToMd(imgMd, objId)
+        pendingRows.append((objId, imgRow))
+        if len(pendingRows) >= CONVERT_BATCH_SIZE:
+            writePendingRows()
+    writePendingRows()
 
 
 def particleToRow(part, partRow, **kwargs):
@@ -210,7 +539,13 @@ def imageToRow(img, imgRow, imgLabel=RELIONCOLUMNS.rlnImageName.value,
     alignType = kwargs.get('alignType')
 
     if alignType != ALIGN_NONE and img.hasTransform():
-        alignmentToRow(img.getTransform(), imgRow, alignType)
+        pendingAlignments = kwargs.get('pendingAlignments')
+        if pendingAlignments is None:
+            alignmentToRow(img.getTransform(), imgRow, alignType)
+        else:
+            # Converted later with the rest of the batch
+            pendingAlignments.append((imgRow,
+                                      img.getTransform().getMatrix().copy()))
 
     if kwargs.get('writeAcquisition', True) and img.hasAcquisition():
         acquisitionToRow(img.getAcquisition(), imgRow)
@@ -260,48 +595,98 @@ def alignmentToRow(alignment, alignmentRow, alignType):
     invTransform == True  -> for xmipp implies projection
                           -> for xmipp implies alignment
     """
-    is2D = alignType == ALIGN_2D
-    is3D = alignType == ALIGN_3D
-    inverseTransform = alignType == ALIGN_PROJ
-    matrix = alignment.getMatrix()
-    shifts, angles = geometryFromMatrix(matrix, inverseTransform)
+    alignmentsToRows([(alignmentRow, alignment.getMatrix())], alignType)
+
 
-    alignmentRow.set(RELIONCOLUMNS.rlnOriginX.value, shifts[0])
-    alignmentRow.set(RELIONCOLUMNS.rlnOriginY.value, shifts[1])
+def alignmentsToRows(rowsAndMatrices, alignType):
+    """ Batched version of alignmentToRow.
+    rowsAndMatrices: list of (row, transformation matrix) pairs
+    """
+    rows, matrices = zip(*rowsAndMatrices)
+    columns = alignmentColumns(np.array(matrices), alignType)
+    for i, row in enumerate(rows):
+        for label, values in columns.items():
+            row.set(label, values[i])
 
-    if is2D:
-        angle = angles[0] + angles[2]
-        alignmentRow.set(RELIONCOLUMNS.rlnAnglePsi.value, -angle)
 
-        flip = bool(np.linalg.det(matrix[0:2, 0:2]) < 0)
-        if flip:
-            logger.debug("FLIP in 2D not implemented")
-    elif is3D:
+def alignmentColumns(matrices, alignType):
+    """ Convert a (N, 4, 4) stack of transformation matrices into the RELION
+    alignment columns. Return an OrderedDict {label: list of values}
+    """
+    if alignType == ALIGN_3D:
         raise Exception("3D alignment conversion for Relion not implemented. "
                         "It seems the particles were generated with an "
                         "incorrect alignment type. You may either re-launch "
                         "the protocol that generates the particles "
                         "with angles or set 'Consider previous alignment?' "
                         "to No")
+
+    shifts, angles = geometryFromMatrices(matrices, alignType == ALIGN_PROJ)
+    columns = OrderedDict()
+    columns[RELIONCOLUMNS.rlnOriginX.value] = shifts[:, 0]
+    columns[RELIONCOLUMNS.rlnOriginY.value] = shifts[:, 1]
+
+    if alignType == ALIGN_2D:
+        columns[RELIONCOLUMNS.rlnAnglePsi.value] = -(angles[:, 0] + angles[:, 2])
+        if np.any(np.linalg.det(matrices[:, 0:2, 0:2]) < 0):
+            logger.debug("FLIP in 2D not implemented")
     else:
-        alignmentRow.set(RELIONCOLUMNS.rlnOriginZ.value, shifts[2])
-        alignmentRow.set(RELIONCOLUMNS.rlnAngleRot.value, angles[0])
-        alignmentRow.set(RELIONCOLUMNS.rlnAngleTilt.value, angles[1])
-        alignmentRow.set(RELIONCOLUMNS.rlnAnglePsi.value, angles[2])
+        columns[RELIONCOLUMNS.rlnOriginZ.value] = shifts[:, 2]
+        columns[RELIONCOLUMNS.rlnAngleRot.value] = angles[:, 0]
+        columns[RELIONCOLUMNS.rlnAngleTilt.value] = angles[:, 1]
+        columns[RELIONCOLUMNS.rlnAnglePsi.value] = angles[:, 2]
+
+    return OrderedDict((label, values.tolist())
+                       for label, values in columns.items())
 
 
 def geometryFromMatrix(matrix, inverseTransform):
-    from pwem.convert.transformations import (translation_from_matrix,
-                                              euler_from_matrix)
+    shifts, angles = geometryFromMatrices(matrix, inverseTransform)
+    return shifts[0], angles[0]
 
+
+def geometryFromMatrices(matrices, inverseTransform):
+    """ Batched version of geometryFromMatrix.
+    matrices: (N, 4, 4) transformation matrices
+    Return the (N, 3) shifts and (N, 3) euler angles (ZYZ, in degrees)
+    """
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    # Component-major copy (4, 4, N): every m[i, j] is a contiguous array
+    m = np.ascontiguousarray(matrices.transpose(1, 2, 0))
+    t = m[:3, 3]
     if inverseTransform:
-        from numpy.linalg import inv
-        matrix = inv(matrix)
-        shifts = -translation_from_matrix(matrix)
+        # inverse of the affine transform [A | t] is [inv(A) | -inv(A) t]
+        m = _inv3x3(m[:3, :3])
+        shifts = np.einsum('ijn,jn->ni', m, t)
     else:
-        shifts = translation_from_matrix(matrix)
-    angles = -np.rad2deg(euler_from_matrix(matrix, axes='szyz'))
-    return shifts, angles
+        shifts = t.T.copy()
+
+    # Same decomposition of euler_from_matrix(matrix, axes='szyz')
+    sy = np.sqrt(m[2, 1] ** 2 + m[2, 0] ** 2)
+    general = sy > np.finfo(float).eps * 4.0
+    angles = np.empty((3, len(sy)))
+    angles[0] = np.where(general, np.arctan2(m[2, 1], m[2, 0]),
+                         np.arctan2(-m[1, 0], m[1, 1]))
+    angles[1] = np.arctan2(sy, m[2, 2])
+    angles[2] = np.where(general, np.arctan2(m[1, 2], -m[0, 2]), 0.)
+    return shifts, np.rad2deg(angles.T)
+
+
+def _inv3x3(a):
+    """ Invert a component-major (3, 3, N) stack of matrices from their
+    cofactors """
+    inv = np.empty_like(a)
+    inv[0, 0] = a[1, 1] * a[2, 2] - a[1, 2] * a[2, 1]
+    inv[0, 1] = a[0, 2] * a[2, 1] - a[0, 1] * a[2, 2]
+    inv[0, 2] = a[0, 1] * a[1, 2] - a[0, 2] * a[1, 1]
+    inv[1, 0] = a[1, 2] * a[2, 0] - a[1, 0] * a[2, 2]
+    inv[1, 1] = a[0, 0] * a[2, 2] - a[0, 2] * a[2, 0]
+    inv[1, 2] = a[0, 2] * a[1, 0] - a[0, 0] * a[1, 2]
+    inv[2, 0] = a[1, 0] * a[2, 1] - a[1, 1] * a[2, 0]
+    inv[2, 1] = a[0, 1] * a[2, 0] - a[0, 0] * a[2, 1]
+    inv[2, 2] = a[0, 0] * a[1, 1] - a[0, 1] * a[1, 0]
+    det = a[0, 0] * inv[0, 0] + a[0, 1] * inv[1, 0] + a[0, 2] * inv[2, 0]
+    return inv / det
 
 
 def coordinateToRow(coord, coordRow, copyId=True):
@@ -396,7 +781,13 @@ def rowToAlignment(alignmentRow, alignType, pixelSize=1.0):
 
     is2D = alignType == ALIGN_2D
     inverseTransform = alignType == ALIGN_PROJ
-    if alignmentRow.hasAnyColumn(ALIGNMENT_DICT.values()):
+    if alignmentRow.hasColumn(ALIGNMENT_MATRIX_LABEL):
+        # Matrix already computed for the batch of rows, shifts in Angstroms
+        alignment = Transform()
+        M = np.array(alignmentRow.get(ALIGNMENT_MATRIX_LABEL))
+        M[:3, 3] /= pixelSize
+        alignment.setMatrix(M)
+    elif alignmentRow.hasAnyColumn(ALIGNMENT_DICT.values()):
         alignment = Transform()
         angles = np.zeros(3)
         shifts = np.zeros(3)
@@ -438,17 +829,72 @@ def matrixFromGeometry(shifts, angles, inverseTransform):
     """ Create the transformation matrix from a given
     2D shifts in X and Y...and the 3 euler angles.
     """
-    from pwem.convert.transformations import euler_matrix
-    radAngles = -np.deg2rad(angles)
-    M = euler_matrix(radAngles[0], radAngles[1], radAngles[2], 'szyz')
+    return matricesFromGeometry(np.asarray(shifts)[:3], angles,
+                                inverseTransform)[0]
+
+
+def matricesFromGeometry(shifts, angles, inverseTransform):
+    """ Batched version of matrixFromGeometry.
+    shifts: (N, 3) shifts
+    angles: (N, 3) euler angles (ZYZ, in degrees)
+    Return the (N, 4, 4) transformation matrices
+    """
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 3)
+    radAngles = np.deg2rad(np.asarray(angles, dtype=np.float64).reshape(-1, 3))
+    si, sj, sk = np.sin(radAngles).T
+    ci, cj, ck = np.cos(radAngles).T
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    # Same matrix of euler_matrix(-angles, 'szyz'), built component-major
+    # (4, 4, N) so every component is written contiguously
+    M = np.zeros((4, 4, len(radAngles)))
+    M[2, 2] = cj
+    M[2, 1] = sj * si
+    M[2, 0] = sj * ci
+    M[1, 2] = sj * sk
+    M[1, 1] = -cj * ss + cc
+    M[1, 0] = -cj * cs - sc
+    M[0, 2] = -sj * ck
+    M[0, 1] = cj * sc + cs
+    M[0, 0] = cj * cc - ss
+    M[3, 3] = 1.
     if inverseTransform:
-        from numpy.linalg import inv
-        M[:3, 3] = -shifts[:3]
-        M = inv(M)
+        # inverse of the rigid transform [R | -shifts] is [R' | R' shifts]
+        M[:3, :3] = M[:3, :3].transpose(1, 0, 2).copy()
+        M[:3, 3] = np.einsum('ijn,nj->in', M[:3, :3], shifts)
     else:
-        M[:3, 3] = shifts[:3]
+        M[:3, 3] = shifts.T
 
-    return M
+    return np.ascontiguousarray(M.transpose(2, 0, 1))
+
+
+def alignmentMatricesFromColumns(columns, alignType):
+    """ Batched version of rowToAlignment over RELION columns
+    ({label: array}). The shifts are kept in Angstroms, rowToAlignment scales
+    them to the particle pixel size.
+    Return the (N, 4, 4) matrices or None if there are no alignment columns
+    """
+    if alignType == ALIGN_3D:
+        raise Exception("3D alignment conversion for Relion not implemented.")
+    if not any(label in columns for label in ALIGNMENT_DICT.values()):
+        return None
+
+    size = len(next(iter(columns.values())))
+    zeros = np.zeros(size)
+    get = lambda label: columns.get(label, zeros)
+    shifts = np.stack([get(RELIONCOLUMNS.rlnOriginXAngst.value),
+                       get(RELIONCOLUMNS.rlnOriginYAngst.value),
+                       get(RELIONCOLUMNS.rlnOriginZAngst.value)], axis=1)
+    if alignType == ALIGN_2D:
+        shifts[:, 2] = 0
+        angles = np.stack([zeros, zeros,
+                           -get(RELIONCOLUMNS.rlnAnglePsi.value)], axis=1)
+    else:
+        angles = np.stack([get(RELIONCOLUMNS.rlnAngleRot.value),
+                           get(RELIONCOLUMNS.rlnAngleTilt.value),
+                           get(RELIONCOLUMNS.rlnAnglePsi.value)], axis=1)
+    return matricesFromGeometry(shifts, angles, alignType == ALIGN_PROJ)
 
 
 def convertBinaryFiles(imgSet, outputDir, extension='mrcs', **kwargs):
@@ -561,6 +1007,13 @@ def cryosPARCwriteSetOfParticles(imgSet, starFile, outputDir, **kwargs):
     if outputDir is not None:
         filesDict = convertBinaryFiles(imgSet, outputDir)
         kwargs['filesDict'] = filesDict
+
+    # Row hooks can set any label, only the columnar ones avoid the rows
+    if (kwargs.get('preprocessImageRow') is None and
+            kwargs.get('postprocessImageRow') in (None, addRandomSubset)):
+        writeParticlesStar(imgSet, starFile, **kwargs)
+        return
+
     partMd = md.MetaData()
     setOfImagesToMd(imgSet, partMd, particleToRow, **kwargs)
 
@@ -581,6 +1034,228 @@ def cryosPARCwriteSetOfParticles(imgSet, starFile, outputDir, **kwargs):
     partMd.write('%s@%s' % (blockName, starFile))
 
 
+def writeParticlesStar(imgSet, starFile, **kwargs):
+    """ Columnar version of setOfImagesToMd(..., particleToRow) + MetaData
+    write. The rows are written as formatted text blocks, one per batch of
+    iterParticleColumns.
+    Accept the same keyword arguments as cryosPARCwriteSetOfParticles
+    """
+    blockName = kwargs.get('blockName', 'particles')
+    with open(starFile, 'w', buffering=STAR_WRITE_BUFFER_SIZE) as f:
+        f.write('\ndata_%s\n\nloop_\n' % blockName)
+        lineFormat = None
+        for columns in iterParticleColumns(imgSet, **kwargs):
+            if lineFormat is None:
+                f.writelines('_%s #%d\n' % (label, i + 1)
+                             for i, label in enumerate(columns))
+                lineFormat = ' '.join(_starFormat(label)
+                                      for label in columns) + '\n'
+            f.writelines(lineFormat % row for row in zip(*columns.values()))
+        f.write('\n')
+
+
+def iterParticleColumns(imgSet, batchSize=CONVERT_BATCH_SIZE, **kwargs):
+    """ Iterate over the particles of imgSet in batches of columns with the
+    values particleToRow would set: OrderedDict {label: list of values}.
+    The columns are resolved once from the first particle (all the items of
+    a set have the same attributes) and the alignments are converted for the
+    whole batch.
+    """
+    alignType = kwargs.get('alignType', imgSet.getAlignment())
+    firstPart = imgSet.getFirstItem() if imgSet.getSize() else None
+    columns = _particleColumns(imgSet, firstPart, **kwargs)
+    hasAlignment = (firstPart is not None and alignType != ALIGN_NONE and
+                    firstPart.hasTransform())
+    if hasAlignment:
+        alignLabels = list(alignmentColumns(
+            np.array([firstPart.getTransform().getMatrix()]), alignType))
+        for label in alignLabels:
+            columns.pop(label, None)
+
+    labels = list(columns)
+    getters = list(columns.values())
+
+    def batchColumns(rows, matrices):
+        batch = OrderedDict(zip(labels, map(list, zip(*rows))))
+        if hasAlignment:
+            batch.update(alignmentColumns(np.array(matrices), alignType))
+        return batch
+
+    rows, matrices = [], []
+    for part in imgSet:
+        rows.append([getter(part) for getter in getters])
+        if hasAlignment:
+            matrices.append(part.getTransform().getMatrix())
+        if len(rows) >= batchSize:
+            yield batchColumns(rows, matrices)
+            rows, matrices = [], []
+    if rows:
+        yield batchColumns(rows, matrices)
+
+
+def relionColumnsToCs(columns, pixelSize, boxSize, alignType=ALIGN_NONE):
+    """ Map a batch of iterParticleColumns onto the fields of a cryoSPARC
+    particle dataset, the inverse of csToRelionColumns.
+    :returns an OrderedDict {csField: numpy array}
+    """
+    fields = OrderedDict()
+    get = lambda label: np.asarray(columns[label])
+    names = np.asarray(get(RELIONCOLUMNS.rlnImageName.value), dtype=str)
+    parts = np.char.partition(names, '@')
+    hasIndex = parts[:, 1] == '@'
+    indexes = np.zeros(len(names), dtype=np.uint32)
+    indexes[hasIndex] = parts[hasIndex, 0].astype(np.uint32) - 1
+    fields['blob/path'] = np.where(hasIndex, parts[:, 2], parts[:, 0])
+    fields['blob/idx'] = indexes
+    fields['blob/shape'] = np.full((len(names), 2), boxSize, dtype=np.uint32)
+    fields['blob/psize_A'] = np.full(len(names), pixelSize, dtype=np.float32)
+    fields['blob/sign'] = np.full(len(names), CS_BLOB_SIGN, dtype=np.float32)
+
+    if RELIONCOLUMNS.rlnDefocusU.value in columns:
+        fields['ctf/df1_A'] = get(RELIONCOLUMNS.rlnDefocusU.value)
+        fields['ctf/df2_A'] = get(RELIONCOLUMNS.rlnDefocusV.value)
+        fields['ctf/df_angle_rad'] = np.deg2rad(get(RELIONCOLUMNS.rlnDefocusAngle.value))
+        for label, field in [(RELIONCOLUMNS.rlnVoltage.value, 'ctf/accel_kv'),
+                             (RELIONCOLUMNS.rlnSphericalAberration.value, 'ctf/cs_mm'),
+                             (RELIONCOLUMNS.rlnAmplitudeContrast.value, 'ctf/amp_contrast')]:
+            if label in columns:
+                fields[field] = get(label)
+        if RELIONCOLUMNS.rlnPhaseShift.value in columns:
+            fields['ctf/phase_shift_rad'] = np.deg2rad(get(RELIONCOLUMNS.rlnPhaseShift.value))
+
+    if alignType in (ALIGN_PROJ, ALIGN_2D) and RELIONCOLUMNS.rlnAnglePsi.value in columns:
+        group = 'alignments3D' if alignType == ALIGN_PROJ else 'alignments2D'
+        if alignType == ALIGN_PROJ:
+            angles = np.stack([get(RELIONCOLUMNS.rlnAngleRot.value),
+                               get(RELIONCOLUMNS.rlnAngleTilt.value),
+                               get(RELIONCOLUMNS.rlnAnglePsi.value)], axis=1)
+            fields[group + '/pose'] = logmap(euler2rot(np.deg2rad(angles)))
+        else:
+            fields[group + '/pose'] = np.deg2rad(get(RELIONCOLUMNS.rlnAnglePsi.value))
+        # The shifts of the rows are in pixels
+        fields[group + '/shift'] = np.stack([get(RELIONCOLUMNS.rlnOriginX.value),
+                                             get(RELIONCOLUMNS.rlnOriginY.value)],
+                                            axis=1)
+        fields[group + '/psize_A'] = np.full(len(names), pixelSize,
+                                             dtype=np.float32)
+        if alignType == ALIGN_PROJ and RELIONCOLUMNS.rlnRandomSubset.value in columns:
+            fields[group + '/split'] = get(RELIONCOLUMNS.rlnRandomSubset.value) - 1
+
+    return fields
+
+
+def getCsSlots(fields):
+    """ Names of the cryoSPARC slots (blob, ctf...) of a dict of fields """
+    return list(OrderedDict.fromkeys(field.split('/')[0] for field in fields))
+
+
+def _starFormat(label):
+    """ Format of the values of label, as written by MetaData """
+    labelType = md.labelType(label)
+    if labelType == md.LABEL_DOUBLE:
+        return '%f'
+    if labelType in (md.LABEL_INT, md.LABEL_SIZET, md.LABEL_BOOL):
+        return '%d'
+    return '%s'
+
+
+def _attrGetter(attrPath, label=None):
+    """ Return a function that reads the value of a (nested) attribute from a
+    particle, converted to the python type of label if given """
+    getAttr = operator.attrgetter(attrPath)
+    if label is None:
+        return lambda obj: getAttr(obj).get()
+    valueType = md.label2Python(label)
+    return lambda obj: valueType(getAttr(obj).get())
+
+
+def _objectColumns(columns, obj, attrPath, attrDict, extraLabels=[]):
+    """ Columnar version of objectToRow """
+    columns[RELIONCOLUMNS.rlnEnabled.value] = lambda part: part.isEnabled()
+    for attr, label in attrDict.items():
+        if hasattr(obj, attr):
+            columns[label] = _attrGetter(attrPath + attr, label)
+    attrLabels = attrDict.values()
+    for label in extraLabels:
+        attrName = '_' + label
+        if label not in attrLabels and hasattr(obj, attrName):
+            columns[label] = _attrGetter(attrPath + attrName)
+
+
+def _particleColumns(imgSet, part, **kwargs):
+    """ Resolve the columns written by particleToRow for the items of imgSet.
+    Return an OrderedDict {label: function(particle) -> value}, setting a
+    label again replaces its value as in a row
+    """
+    columns = OrderedDict()
+    if part is None:
+        return columns
+
+    coord = part.getCoordinate()
+    micNameLabel = RELIONCOLUMNS.rlnMicrographName.value
+    if coord is not None:
+        _objectColumns(columns, coord, '_coordinate.', COOR_DICT,
+                       extraLabels=COOR_EXTRA_LABELS)
+        if coord.getMicName():
+            columns[micNameLabel] = lambda p: str(
+                p.getCoordinate().getMicName().replace(" ", ""))
+        elif coord.getMicId():
+            columns[micNameLabel] = lambda p: str(p.getCoordinate().getMicId())
+    if part.hasMicId():
+        columns[RELIONCOLUMNS.rlnMicrographId.value] = lambda p: int(p.getMicId())
+        if micNameLabel not in columns:
+            columns[micNameLabel] = lambda p: ('fake_micrograph_%06d.mrc'
+                                               % p.getMicId())
+    if part.hasAttribute('_rlnParticleId'):
+        label = RELIONCOLUMNS.rlnParticleId.value
+        columns[label] = _attrGetter('_rlnParticleId', label)
+
+    if kwargs.get('fillRandomSubset') and part.hasAttribute('_rlnRandomSubset'):
+        label = RELIONCOLUMNS.rlnRandomSubset.value
+        columns[label] = _attrGetter('_rlnRandomSubset', label)
+        if part.hasAttribute('_rlnBeamTiltX'):
+            columns['rlnBeamTiltX'] = lambda p: float(p._rlnBeamTiltX.get())
+            columns['rlnBeamTiltY'] = lambda p: float(p._rlnBeamTiltY.get())
+
+    # imageToRow
+    filesDict = kwargs.get('filesDict', {})
+    columns[RELIONCOLUMNS.rlnImageId.value] = lambda p: int(p.getObjId())
+
+    def imageName(p):
+        index, fn = p.getLocation()
+        return locationToCryosparc(index, filesDict.get(fn, fn))
+    columns[RELIONCOLUMNS.rlnImageName.value] = imageName
+
+    if kwargs.get('writeCtf', True) and part.hasCTF():
+        ctfModel = part.getCTF()
+        if ctfModel.getPhaseShift() is not None:
+            columns[RELIONCOLUMNS.rlnPhaseShift.value] = \
+                lambda p: p.getCTF().getPhaseShift()
+        _objectColumns(columns, ctfModel, '_ctfModel.', CTF_DICT,
+                       extraLabels=CTF_EXTRA_LABELS)
+
+    if kwargs.get('writeAcquisition', True) and part.hasAcquisition():
+        _objectColumns(columns, part.getAcquisition(), '_acquisition.',
+                       ACQUISITION_DICT)
+
+    _objectColumns(columns, part, '', {},
+                   extraLabels=IMAGE_EXTRA_LABELS + kwargs.get('extraLabels', []))
+
+    if kwargs.get('postprocessImageRow') is addRandomSubset:
+        columns[RELIONCOLUMNS.rlnRandomSubset.value] = \
+            lambda p: 1 + (p.getObjId() % 2)
+
+    if kwargs.get('fillMagnification', False):
+        mag = imgSet.getAcquisition().getMagnification()
+        detectorPxSize = mag * imgSet.getSamplingRate() / 10000
+        columns[RELIONCOLUMNS.rlnMagnification.value] = lambda p: mag
+        columns[RELIONCOLUMNS.rlnDetectorPixelSize.value] = lambda p: detectorPxSize
+    else:
+        columns.pop(RELIONCOLUMNS.rlnMagnification.value, None)
+
+    return columns
+
+
 def rowToCtfModel(ctfRow):
     """ Create a CTFModel from a row of a meta """
     if ctfRow.hasAllColumns(CTF_DICT.values()):
@@ -741,11 +1416,16 @@ def rowToAcquisition(acquisitionRow):
 
 def readSetOfParticles(filename, partSet, **kwargs):
     """read from Relion image meta
-        filename: The metadata filename where the images are.
+        filename: The metadata filename where the images are. A cryoSPARC
+            .cs file is read directly
         imgSet: the SetOfParticles that will be populated.
         rowToParticle: this function will be used to convert the row to Object
     """
-    for imgRow in emtable.Table.iterRows(filename):
+    if filename.endswith('.cs'):
+        rows = iterCsRows(filename, alignType=kwargs.get('alignType'))
+    else:
+        rows = emtable.Table.iterRows(filename)
+    for imgRow in rows:
         img = rowToParticle(imgRow, **kwargs)
         partSet.append(img)
 
@@ -16,8 +16,9 @@ def cs2Star(args):
     MAX_HEADER_SIZE = 50000
 
     log = logging.getLogger('root')
-    hdlr = logging.StreamHandler(sys.stdout)
-    log.addHandler(hdlr)
+    if not log.handlers:  # the worker converts several files
+        hdlr = logging.StreamHandler(sys.stdout)
+        log.addHandler(hdlr)
     log.setLevel(logging.getLevelName(logging.INFO))
 
     if args.swapxy:
@@ -27,7 +28,9 @@ def cs2Star(args):
 
     if args.input[0].endswith(".cs"):
         log.debug("Detected CryoSPARC 2+ .cs file")
-        cs = np.load(args.input[0], max_header_size=MAX_HEADER_SIZE)
+        # Memory-map the file: only the fields pyem uses are read from disk
+        cs = np.load(args.input[0], mmap_mode='r',
+                     max_header_size=MAX_HEADER_SIZE)
         if args.first10k:
             cs = cs[:10000]
 
@@ -218,7 +221,33 @@ def defineArgs():
     return parser
 
 
+def serve():
+    """ Conversion worker: read one JSON request per line from stdin,
+    {"files": [[input, output], ...]}, and answer each one with a JSON line
+    {"results": [exit code, ...]}. The interpreter (and the pandas and pyem
+    imports) is reused by all the requests. The conversion output goes to
+    stderr so it does not mix with the answers """
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    parser = defineArgs()
+    for line in sys.stdin:
+        request = json.loads(line)
+        results = []
+        for inputFn, outputFn in request['files']:
+            try:
+                results.append(cs2Star(parser.parse_args([inputFn, outputFn])))
+            except Exception as e:
+                print("Error converting %s: %s" % (inputFn, e), file=sys.stderr)
+                results.append(1)
+        channel.write(json.dumps({'results': results}) + '\n')
+        channel.flush()
+    return 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--worker']:
+        sys.exit(serve())
     parser = defineArgs()
     argsList = [sys.argv[1], sys.argv[2]]
     args = parser.parse_args(argsList)
@@ -0,0 +1,312 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Native reader of cryoSPARC .cs files. The .cs structured array is mapped, in
+vectorized form, onto the RELION columns the pyem conversion produces, so the
+rows can be consumed by the same callbacks (createItemMatrix, rowToAlignment,
+setCryosparcAttributes...) without writing and parsing a STAR file.
+"""
+import logging
+from collections import OrderedDict
+
+import emtable
+import numpy as np
+
+from pwem.constants import ALIGN_NONE
+
+from ..constants import RELIONCOLUMNS, ALIGNMENT_MATRIX_LABEL
+
+logger = logging.getLogger(__name__)
+
+# see https://numpy.org/doc/stable/reference/generated/numpy.load.html
+# for an explanation of MAX_HEADER_SIZE
+CS_MAX_HEADER_SIZE = 50000
+# Number of records converted at once when a .cs file is iterated
+CS_BATCH_SIZE = 100000
+
+# Fields (or groups of fields, e.g. 'ctf' for all the 'ctf/...' fields) read
+# from the .cs files. Passthrough blocks, pose marginals and other fields that
+# are not converted are never loaded
+CS_RELION_FIELDS = ('blob', 'location', 'ctf', 'alignments3D', 'alignments2D')
+CS_REFINEMENT_FIELDS = ('blob/psize_A', 'ctf', 'alignments3D')
+CS_CLASSIFICATION2D_FIELDS = ('blob/psize_A', 'alignments2D')
+CS_COORDINATE_FIELDS = ('location',)
+
+
+def loadCsFile(csFile, mmap=False):
+    """ Load a .cs file as a numpy structured array
+    :param mmap: if True the file is memory-mapped (read only) and the
+                 records are only read from disk when they are accessed
+    """
+    mmapMode = 'r' if mmap else None
+    try:
+        return np.load(csFile, mmap_mode=mmapMode,
+                       max_header_size=CS_MAX_HEADER_SIZE)
+    except TypeError:  # numpy < 1.24 has no max_header_size
+        return np.load(csFile, mmap_mode=mmapMode)
+    except ValueError:
+        # Arrays with python objects can not be memory-mapped
+        if not mmap:
+            raise
+        return loadCsFile(csFile)
+
+
+def getCsFields(csFile):
+    """ Return the field names of a .cs file (only its header is read) """
+    return loadCsFile(csFile, mmap=True).dtype.names
+
+
+def selectCsFields(names, fields):
+    """ Return the names matching fields, in the order of the file. A field
+    matches its own name and, if it is a group, all the names in the group """
+    fields = set(fields)
+    return [name for name in names
+            if name in fields or name.split('/')[0] in fields]
+
+
+def iterCsBatches(csFile, batchSize=CS_BATCH_SIZE, fields=None):
+    """ Iterate over a .cs file in batches of at most batchSize records. The
+    file is memory-mapped, so the memory used is bounded by the batch size and
+    not by the number of particles
+    :param fields: if given, the batches only contain these fields (see
+           selectCsFields) and only their bytes are read from the records
+    """
+    cs = loadCsFile(csFile, mmap=True)
+    if fields is None:
+        for start in range(0, len(cs), batchSize):
+            yield np.array(cs[start:start + batchSize])
+        return
+
+    names = selectCsFields(cs.dtype.names, fields)
+    dtype = np.dtype([(name, cs.dtype.fields[name][0]) for name in names])
+    for start in range(0, len(cs), batchSize):
+        records = cs[start:start + batchSize]
+        batch = np.empty(len(records), dtype=dtype)
+        for name in names:
+            batch[name] = records[name]
+        yield batch
+
+
+def expmap(rotVecs):
+    """ Convert cryoSPARC poses (axis-angle vectors, N x 3) into rotation
+    matrices (N x 3 x 3), with the same convention used by pyem """
+    rotVecs = np.asarray(rotVecs, dtype=np.float64).reshape(-1, 3)
+    theta = np.linalg.norm(rotVecs, axis=1)
+    valid = theta >= 1e-16
+    w = np.zeros_like(rotVecs)
+    w[valid] = rotVecs[valid] / theta[valid, None]
+    k = np.zeros((len(rotVecs), 3, 3))
+    k[:, 0, 1], k[:, 0, 2] = w[:, 2], -w[:, 1]
+    k[:, 1, 0], k[:, 1, 2] = -w[:, 2], w[:, 0]
+    k[:, 2, 0], k[:, 2, 1] = w[:, 1], -w[:, 0]
+    sinTheta = np.sin(theta)[:, None, None]
+    cosTheta = np.cos(theta)[:, None, None]
+    r = np.eye(3) + sinTheta * k + (1 - cosTheta) * np.matmul(k, k)
+    r[~valid] = np.eye(3)
+    return r
+
+
+def rot2euler(r):
+    """ Decompose rotation matrices (N x 3 x 3) into RELION ZYZ Euler angles
+    (rot, tilt, psi), in radians. Vectorized version of the Shoemake
+    decomposition used by RELION and pyem """
+    r = np.asarray(r, dtype=np.float64).reshape(-1, 3, 3)
+    epsilon = np.finfo(np.double).eps
+    absSb = np.sqrt(r[:, 0, 2] ** 2 + r[:, 1, 2] ** 2)
+    general = absSb > 16 * epsilon
+
+    gamma = np.arctan2(r[:, 1, 2], -r[:, 0, 2])
+    alpha = np.arctan2(r[:, 2, 1], r[:, 2, 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        signSb = np.where(np.abs(np.sin(gamma)) < epsilon,
+                          np.sign(-r[:, 0, 2]) / np.cos(gamma),
+                          np.where(np.sin(gamma) > 0, np.sign(r[:, 1, 2]),
+                                   -np.sign(r[:, 1, 2])))
+    beta = np.arctan2(signSb * absSb, r[:, 2, 2])
+
+    # Gimbal lock: tilt is 0 or 180 degrees
+    positive = r[:, 2, 2] > 0
+    alpha = np.where(general, alpha, 0)
+    beta = np.where(general, beta, np.where(positive, 0, np.pi))
+    gamma = np.where(general, gamma,
+                     np.where(positive, np.arctan2(-r[:, 1, 0], r[:, 0, 0]),
+                              np.arctan2(r[:, 1, 0], -r[:, 0, 0])))
+    return np.stack([alpha, beta, gamma], axis=1)
+
+
+def euler2rot(angles):
+    """ Rotation matrices (N x 3 x 3) of RELION ZYZ Euler angles (rot, tilt,
+    psi) in radians. Inverse of rot2euler """
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1, 3)
+    ca, cb, cg = np.cos(angles).T
+    sa, sb, sg = np.sin(angles).T
+    r = np.empty((len(angles), 3, 3))
+    r[:, 0, 0] = cg * cb * ca - sg * sa
+    r[:, 0, 1] = cg * cb * sa + sg * ca
+    r[:, 0, 2] = -cg * sb
+    r[:, 1, 0] = -sg * cb * ca - cg * sa
+    r[:, 1, 1] = -sg * cb * sa + cg * ca
+    r[:, 1, 2] = sg * sb
+    r[:, 2, 0] = sb * ca
+    r[:, 2, 1] = sb * sa
+    r[:, 2, 2] = cb
+    return r
+
+
+def logmap(r):
+    """ Convert rotation matrices (N x 3 x 3) into cryoSPARC poses
+    (axis-angle vectors, N x 3). Inverse of expmap """
+    r = np.asarray(r, dtype=np.float64).reshape(-1, 3, 3)
+    # expmap gives the transpose of the usual Rodrigues matrix
+    m = np.transpose(r, (0, 2, 1))
+    cosTheta = np.clip((np.trace(m, axis1=1, axis2=2) - 1) / 2, -1, 1)
+    theta = np.arccos(cosTheta)
+    sinTheta = np.sin(theta)
+    axis = np.stack([m[:, 2, 1] - m[:, 1, 2],
+                     m[:, 0, 2] - m[:, 2, 0],
+                     m[:, 1, 0] - m[:, 0, 1]], axis=1)
+    rotVecs = axis / 2  # first order approximation for theta close to 0
+    general = sinTheta > 1e-6
+    rotVecs[general] = axis[general] * (theta[general] /
+                                        (2 * sinTheta[general]))[:, None]
+
+    # theta close to pi: the axis is a column of (m + I) / 2 = w w^T
+    large = ~general & (cosTheta < 0)
+    if np.any(large):
+        b = (m[large] + np.eye(3)) / 2
+        rows = np.arange(len(b))
+        column = np.argmax(np.diagonal(b, axis1=1, axis2=2), axis=1)
+        w = b[rows, :, column] / np.sqrt(b[rows, column, column])[:, None]
+        rotVecs[large] = w * theta[large, None]
+    return rotVecs
+
+
+def _decode(values):
+    """ Return the cryoSPARC paths (bytes) as an array of str """
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        return np.char.decode(values, 'utf-8')
+    return np.array([v.decode('utf-8') if isinstance(v, bytes) else str(v)
+                     for v in values], dtype=str)
+
+
+def csToRelionColumns(cs):
+    """ Map the blob, location, ctf, alignments3D and alignments2D fields of a
+    .cs structured array onto RELION particle columns.
+    :returns an OrderedDict {rlnColumn: numpy array}
+    """
+    names = cs.dtype.names
+    columns = OrderedDict()
+
+    if 'blob/path' in names:
+        paths = _decode(cs['blob/path'])
+        indexes = np.char.mod('%06d@', cs['blob/idx'].astype(np.int64) + 1)
+        columns[RELIONCOLUMNS.rlnImageName.value] = np.char.add(indexes, paths)
+
+    if 'location/micrograph_path' in names:
+        columns[RELIONCOLUMNS.rlnMicrographName.value] = _decode(cs['location/micrograph_path'])
+    if 'location/center_x_frac' in names:
+        shape = cs['location/micrograph_shape']
+        # Same conventions of the pyem conversion: swap x/y and invert y
+        columns[RELIONCOLUMNS.rlnCoordinateX.value] = (cs['location/center_x_frac'] * shape[:, 1]).astype(int)
+        columns[RELIONCOLUMNS.rlnCoordinateY.value] = ((1 - cs['location/center_y_frac']) * shape[:, 0]).astype(int)
+
+    if 'ctf/df1_A' in names:
+        columns[RELIONCOLUMNS.rlnDefocusU.value] = cs['ctf/df1_A']
+        columns[RELIONCOLUMNS.rlnDefocusV.value] = cs['ctf/df2_A']
+        columns[RELIONCOLUMNS.rlnDefocusAngle.value] = np.rad2deg(cs['ctf/df_angle_rad'])
+    if 'ctf/phase_shift_rad' in names:
+        columns[RELIONCOLUMNS.rlnPhaseShift.value] = np.rad2deg(cs['ctf/phase_shift_rad'])
+    if 'ctf/ctf_fit_to_A' in names:
+        columns[RELIONCOLUMNS.rlnCtfMaxResolution.value] = cs['ctf/ctf_fit_to_A']
+    if 'ctf/cross_corr_ctffind4' in names:
+        columns[RELIONCOLUMNS.rlnCtfFigureOfMerit.value] = cs['ctf/cross_corr_ctffind4']
+    if 'ctf/exp_group_id' in names:
+        columns[RELIONCOLUMNS.rlnOpticsGroup.value] = cs['ctf/exp_group_id'].astype(int) + 1
+
+    if 'alignments3D/pose' in names:
+        angles = np.rad2deg(rot2euler(expmap(cs['alignments3D/pose'])))
+        columns[RELIONCOLUMNS.rlnAngleRot.value] = angles[:, 0]
+        columns[RELIONCOLUMNS.rlnAngleTilt.value] = angles[:, 1]
+        columns[RELIONCOLUMNS.rlnAnglePsi.value] = angles[:, 2]
+        _addShifts(cs, 'alignments3D', columns)
+        if 'alignments3D/split' in names:
+            columns[RELIONCOLUMNS.rlnRandomSubset.value] = cs['alignments3D/split'].astype(int) + 1
+        if 'alignments3D/class' in names:
+            columns[RELIONCOLUMNS.rlnClassNumber.value] = cs['alignments3D/class'].astype(int) + 1
+    elif 'alignments2D/pose' in names:
+        columns[RELIONCOLUMNS.rlnAnglePsi.value] = np.rad2deg(cs['alignments2D/pose'])
+        _addShifts(cs, 'alignments2D', columns)
+        if 'alignments2D/class' in names:
+            columns[RELIONCOLUMNS.rlnClassNumber.value] = cs['alignments2D/class'].astype(int) + 1
+
+    return columns
+
+
+def _addShifts(cs, group, columns):
+    """ Shifts are stored in pixels of the alignment pixel size """
+    names = cs.dtype.names
+    if group + '/psize_A' in names:
+        pixelSize = cs[group + '/psize_A']
+    elif 'blob/psize_A' in names:
+        pixelSize = cs['blob/psize_A']
+    else:
+        pixelSize = 1.0
+    shifts = cs[group + '/shift']
+    columns[RELIONCOLUMNS.rlnOriginXAngst.value] = shifts[:, 0] * pixelSize
+    columns[RELIONCOLUMNS.rlnOriginYAngst.value] = shifts[:, 1] * pixelSize
+
+
+def iterRowsFromColumns(columns):
+    """ Iterate over a dict of columns as emtable rows """
+    if not columns:
+        return
+    Row = emtable.Table(columns=list(columns)).Row
+    for values in zip(*[values.tolist() if values.ndim == 1 else list(values)
+                        for values in columns.values()]):
+        yield Row(*values)
+
+
+def iterCsRows(csFile, batchSize=CS_BATCH_SIZE, alignType=None,
+               fields=CS_RELION_FIELDS):
+    """ Iterate over the particles of a .cs file as emtable rows with the
+    RELION columns used by the STAR based conversion. The file is converted
+    in batches of batchSize records.
+    :param alignType: if given, the alignment matrices of each batch are
+           computed at once and added to the rows (see rowToAlignment)
+    :param fields: fields of the file that are read, by default all the ones
+           with a RELION column
+    """
+    from .convert import alignmentMatricesFromColumns
+    logger.info("Reading %s" % csFile)
+    for batch in iterCsBatches(csFile, batchSize, fields=fields):
+        columns = csToRelionColumns(batch)
+        if alignType not in (None, ALIGN_NONE):
+            matrices = alignmentMatricesFromColumns(columns, alignType)
+            if matrices is not None:
+                columns[ALIGNMENT_MATRIX_LABEL] = matrices
+        yield from iterRowsFromColumns(columns)
@@ -1,10 +1,10 @@
 import os
 import logging
-import emtable
 
 from cryosparc2 import RELIONCOLUMNS
-from cryosparc2.convert import (convertCs2Star, readSetOfParticles,
+from cryosparc2.convert import (iterCsRows, readSetOfParticles,
                                 cryosparcToLocation)
+from cryosparc2.convert.csreader import CS_COORDINATE_FIELDS
 from pwem import ALIGN_PROJ
 from pwem.objects import Coordinate, SetOfCoordinates
 
@@ -16,25 +16,13 @@ class cryoSPARCImport:
     def __init__(self, protocol, csFile):
         self.protocol = protocol
         self._csFile = csFile
-        self._createFilenameTemplates()
-
-    def _createFilenameTemplates(self):
-        """ Centralize how files are called. """
-        myDict = {
-            'output': self.protocol._getExtraPath('output.star')
-        }
-        self.protocol._updateFilenamesDict(myDict)
 
     def importParticles(self):
         """
         Import particles from a cs 'particles.cs'
         """
         try:
-            csPartFile = os.path.abspath(self._csFile)
-            self.outputStarFn = self.protocol._getFileName('output')
-            argsList = [csPartFile, self.outputStarFn]
-            convertCs2Star(argsList)
-            # Validate the start file generated
+            # Validate the particles metadata
             self._validateConvert()
 
             self.partSet = self.protocol._createSetOfParticles()
@@ -67,23 +55,18 @@ class cryoSPARCImport:
             if fileName.endswith('.cs'):
                 try:
                     csPartFile = os.path.abspath(fileName)
-                    outputStarFn = self.protocol._getFileName('output')
-                    argsList = [csPartFile, outputStarFn]
-                    convertCs2Star(argsList)
-                    self._fillSetOfCoordinates(outputCoords, outputStarFn, micList)
+                    self._fillSetOfCoordinates(outputCoords, csPartFile, micList)
 
                 except Exception as e:
                     logger.error("The .cs file has not been imported: %s" % fileName, exc_info=e)
 
         return outputCoords
 
-    def _fillSetOfCoordinates(self, outputCoords, outputStarFn, micList):
+    def _fillSetOfCoordinates(self, outputCoords, csPartFile, micList):
 
         coord = Coordinate()
-        mdFileName = '%s@%s' % ('particles', outputStarFn)
-        table = emtable.Table(fileName=outputStarFn)
 
-        for row in table.iterRows(mdFileName):
+        for row in iterCsRows(csPartFile, fields=CS_COORDINATE_FIELDS):
             coord.setObjId(None)
             micName = os.path.basename(row.get(RELIONCOLUMNS.rlnMicrographName.value))
             splitMicName = micName.split('_')
@@ -101,8 +84,7 @@ class cryoSPARCImport:
             outputCoords.append(coord)
 
     def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self.protocol._getFileName('output')
-        readSetOfParticles(outImgsFn, imgSet,
+        readSetOfParticles(os.path.abspath(self._csFile), imgSet,
                            postprocessImageRow=self._updateItem,
                            alignType=ALIGN_PROJ,
                            samplingRate=imgSet.getSamplingRate())
@@ -121,17 +103,16 @@ class cryoSPARCImport:
         return errors
 
     def _validateMetadata(self, label, warnings=True):
-        # read data_particles table
-        table = emtable.Table(fileName=self.outputStarFn, tableName='particles')
-        row = table[0]
+        # read the first particle
+        row = next(iterCsRows(os.path.abspath(self._csFile)), None)
 
         if row is None:
             raise Exception("Cannot import from empty metadata: %s"
-                            % self.outputStarFn)
+                            % self._csFile)
 
         if not row.get(label, False):
             raise Exception("Label *%s* is missing in metadata: %s"
-                            % (label, self.outputStarFn))
+                            % (label, self._csFile))
 
         index, fn = cryosparcToLocation(row.get(label))
         if fn.startswith("/"):
@@ -143,7 +124,7 @@ class cryoSPARCImport:
 
         if warnings and self._imgPath is None:
             self.protocol.warning("WARNING: Binary data was not found from metadata: %s"
-                                  % self.outputStarFn)
+                                  % self._csFile)
         return row
 
     def findImagesFrom(self, referenceFile, searchFile):
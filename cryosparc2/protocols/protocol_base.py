@@ -25,9 +25,8 @@
 # *
 # **************************************************************************
 import os
-import ast
-import requests
 import logging
+import numpy as np
 logger = logging.getLogger(__name__)
 
 from pkg_resources import parse_version
@@ -37,16 +36,21 @@ import pyworkflow.object as pwobj
 import pyworkflow.utils as pwutils
 from pwem.objects import FSC
 
-from ..constants import V3_3_1, excludedFSCValues, fscValues, V4_0_0, V4_1_0
-from ..convert import convertBinaryVol, writeSetOfParticles, ImageHandler
+from ..constants import (V3_3_1, excludedFSCValues, fscValues, V4_0_0,
+                         IMPORT_CACHE_FILE)
+from ..convert import (convertBinaryVol, writeSetOfParticles, ImageHandler,
+                       convertCs2StarFiles, readCryosparcFsc)
 from ..utils import (getProjectPath, createEmptyProject,
                      createEmptyWorkSpace, getProjectName,
                      getCryosparcProjectsDir, createProjectContainerDir,
-                     doImportParticlesStar, doImportVolumes, killJob, clearJob,
-                     get_job_streamlog, getSystemInfo, getJobStatus,
+                     doImportParticlesStar, doImportParticlesCs,
+                     useCsParticleImport, doImportVolumes, killJob, clearJob,
+                     getStreamlogIndex, getSystemInfo, getJobStatus,
                      STOP_STATUSES, getCryosparcVersion, getProjectInformation,
-                     getCryosparcProjectId, _getLicenceFromFile, doImportMicrographs, getCryosparcProjectsList,
-                     getCryosparcWorkSpaces)
+                     getCryosparcProjectId, doImportMicrographs, getCryosparcProjectsList,
+                     getCryosparcWorkSpaces, ImportCache, getFileFingerprint,
+                     getSetFingerprint, waitForCryosparcJobs, materializeFiles,
+                     downloadJobFile)
 
 
 class ProtCryosparcBase(pw.EMProtocol):
@@ -56,7 +60,9 @@ class ProtCryosparcBase(pw.EMProtocol):
     _protCompatibility = []
     _className = ""
     _fscColumns = 6
-    _logLastLine = 0
+    _logLastText = None
+    # Import jobs submitted and not awaited yet (see convertInputStep)
+    _pendingImports = None
 
     def _initializeCryosparcProject(self):
         """
@@ -70,13 +76,13 @@ class ProtCryosparcBase(pw.EMProtocol):
         if not matchProjects or not folderPaths:
             # create an empty project
             self.emptyProject = createEmptyProject(self.projectPath, self.projectDirName)
-            self.projectName = pwobj.String(self.emptyProject[-1].split()[-1])
+            self.projectName = pwobj.String(self.emptyProject.split()[-1])
             self.projectDir = pwobj.String(getProjectInformation(self.projectName,
                                            info='project_dir'))
             # create an empty workspace
             self.emptyWorkSpace = createEmptyWorkSpace(self.projectName, self.getRunName(),
                                                        self.getObjComment())
-            self.workSpaceName = pwobj.String(self.emptyWorkSpace[-1].split()[-1])
+            self.workSpaceName = pwobj.String(self.emptyWorkSpace.split()[-1])
             self._store(self)
         else:
             self.projectDir = pwobj.String(matchProjects[-1]['project_dir'])
@@ -101,19 +107,16 @@ class ProtCryosparcBase(pw.EMProtocol):
         self.projectDirName = getProjectName(self.getProject().getShortName())
         self.projectPath = pw.pwutils.join(getCryosparcProjectsDir(),
                                         self.projectDirName)
-        self.projectContainerDir = createProjectContainerDir(self.projectPath)[1]
+        self.projectContainerDir = createProjectContainerDir(self.projectPath)
 
     def convertInputStep(self):
         """ Create the input file in STAR format as expected by Relion.
         If the input particles comes from Relion, just link the file.
         """
-        imgSet = self._getInputParticles()
-        if imgSet is not None:
-            # Create links to binary files and write the relion .star file
-            writeSetOfParticles(imgSet, self._getFileName('input_particles'),
-                                self._getPath())
-            self._importParticles()
-
+        # The imports are independent: they are all submitted and then awaited
+        # together. The volumes go first so cryoSPARC imports them while the
+        # particles are being converted
+        self._pendingImports = []
         volume = self._getInputVolume()
         if volume is not None:
             self._importVolume()
@@ -130,11 +133,17 @@ class ProtCryosparcBase(pw.EMProtocol):
         else:
             self.focusMask = pwobj.String()
 
+        imgSet = self._getInputParticles()
+        if imgSet is not None:
+            self._importParticles()
+
         micrographs = self._getInputMicrographs()
         if micrographs is not None:
             self._importMicrographs()
 
+        pendingImports, self._pendingImports = self._pendingImports, None
         self._store(self)
+        waitForCryosparcJobs(self.projectName.get(), pendingImports)
 
     def _getScaledAveragesFile(self, csAveragesFile, force=False):
 
@@ -242,56 +251,111 @@ class ProtCryosparcBase(pw.EMProtocol):
         if cryosparcVersion >= parse_version(V3_3_1):
             self.outputMaskSuffix = sufix
 
+    def _getImportCache(self):
+        if not hasattr(self, 'projectPath'):
+            self._initializeUtilsVariables()
+        return ImportCache(os.path.join(self.projectPath, IMPORT_CACHE_FILE))
+
+    def _cachedImport(self, key, doImport):
+        """ Return the job that imported the input identified by key in this
+        cryoSPARC project, calling doImport() only if there is none """
+        importCache = self._getImportCache()
+        job = importCache.get(self.projectName.get(), key)
+        if job is not None:
+            self.info("Reusing the import job %s" % job)
+            return pwobj.String(job)
+        job = doImport()
+        importCache.set(key, job.get(), files=[self._getPath()])
+        return job
+
+    def _convertCsFiles(self, filesList):
+        """ Convert a list of (.cs file, .star file) in parallel, reporting
+        each converted file in the run log """
+        def progress(done, total, files):
+            self.info("Converted %d/%d: %s" % (done, total,
+                                                os.path.basename(files[0])))
+        return convertCs2StarFiles(filesList, progress=progress)
+
+    def _getVolumeFile(self, vol):
+        return os.path.abspath(vol.getFileName().split(':mrc')[0])
+
+    def _importVolumeFile(self, vol, fileName, volType, msg):
+        """ Import a volume file (converted to mrc if needed) """
+        key = getFileFingerprint(fileName, volType, vol.getSamplingRate())
+
+        def doImport():
+            volFn = fileName
+            if volType in ('map', 'mask'):
+                volFn = os.path.join(os.getcwd(),
+                                     convertBinaryVol(vol, self._getTmpPath()))
+            return doImportVolumes(self, volFn, vol, volType, msg,
+                                   pendingJobs=self._pendingImports)
+
+        return self._cachedImport(key, doImport)
+
     def _importVolume(self):
         vol = self._getInputVolume()
         self._initializeVolumeSuffix()
-        vol_fn = os.path.join(os.getcwd(), convertBinaryVol(vol, self._getTmpPath()))
-        importVolumeJob = doImportVolumes(self, vol_fn, vol, 'map', 'Importing volume...')
+        importVolumeJob = self._importVolumeFile(vol, self._getVolumeFile(vol),
+                                                 'map', 'Importing volume...')
         self.volume = pwobj.String(str(importVolumeJob.get()) + self.outputVolumeSuffix)
 
         if vol.hasHalfMaps():
             halfMaps = vol.getHalfMaps().split(",")
             map_half_A_fn = os.path.abspath(halfMaps[0].split(':mrc')[0])
-            importVolumeHalfAJob = doImportVolumes(self, map_half_A_fn, vol,
-                                                   'map_half_A', 'Importing half volume A...')
+            importVolumeHalfAJob = self._importVolumeFile(vol, map_half_A_fn,
+                                                          'map_half_A', 'Importing half volume A...')
             self.importVolumeHalfA = pwobj.String(str(importVolumeHalfAJob.get()) + self.outputVolumeHalf_A)
 
             map_half_B_fn = os.path.abspath(halfMaps[1].split(':mrc')[0])
-            importVolumeHalfBJob = doImportVolumes(self, map_half_B_fn, vol,
-                                                   'map_half_B', 'Importing half volume B...')
+            importVolumeHalfBJob = self._importVolumeFile(vol, map_half_B_fn,
+                                                          'map_half_B', 'Importing half volume B...')
             self.importVolumeHalfB = pwobj.String(str(importVolumeHalfBJob.get()) + self.outputVolumeHalf_B)
 
         self.currenJob.set(importVolumeJob.get())
 
     def _importMask(self):
         self._initializeMaskSuffix()
-        maskFn = os.path.join(os.getcwd(), convertBinaryVol(self._getInputMask(),
-                                                            self._getTmpPath()))
-
-        importMaskJob = doImportVolumes(self, maskFn, self._getInputMask(),
-                                        'mask', 'Importing mask... ')
+        mask = self._getInputMask()
+        importMaskJob = self._importVolumeFile(mask, self._getVolumeFile(mask),
+                                               'mask', 'Importing mask... ')
         self.currenJob.set(importMaskJob.get())
         self.mask = pwobj.String(str(importMaskJob.get()) + self.outputMaskSuffix)
 
     def _importFocusMask(self):
         self._initializeMaskSuffix()
-        maskFn = os.path.join(os.getcwd(), convertBinaryVol(self._getInputFocusMask(),
-                                                            self._getTmpPath()))
-
-        importFocusMaskJob = doImportVolumes(self, maskFn, self._getInputFocusMask(),
-                                             'mask', 'Importing focus mask... ')
+        focusMask = self._getInputFocusMask()
+        importFocusMaskJob = self._importVolumeFile(focusMask,
+                                                    self._getVolumeFile(focusMask),
+                                                    'mask',
+                                                    'Importing focus mask... ')
         self.currenJob.set(importFocusMaskJob.get())
         self.focusMask = pwobj.String(str(importFocusMaskJob.get()) + self.outputMaskSuffix)
 
     def _importParticles(self):
-        # import_particles_star
-        importedParticlesJob = doImportParticlesStar(self)
+        imgSet = self._getInputParticles()
+        csImport = useCsParticleImport()
+
+        def doImport():
+            if csImport:
+                return doImportParticlesCs(self)
+            # Create links to binary files and write the relion .star file
+            writeSetOfParticles(imgSet, self._getFileName('input_particles'),
+                                self._getPath())
+            # import_particles_star
+            return doImportParticlesStar(self, pendingJobs=self._pendingImports)
+
+        key = getSetFingerprint(imgSet, 'particles', csImport)
+        importedParticlesJob = self._cachedImport(key, doImport)
         self.currenJob = pwobj.String(str(importedParticlesJob.get()))
         self.particles = pwobj.String(str(importedParticlesJob.get()) +
                                       '.imported_particles')
 
     def _importMicrographs(self):
-        importedMicrographsJob = doImportMicrographs(self)
+        micrographs = self._getInputMicrographs()
+        key = getSetFingerprint(micrographs, 'micrographs')
+        importedMicrographsJob = self._cachedImport(
+            key, lambda: doImportMicrographs(self, pendingJobs=self._pendingImports))
         self.currenJob = pwobj.String(str(importedMicrographsJob.get()))
         self.micrographs = pwobj.String(str(importedMicrographsJob.get()) +
                                       '.imported_micrographs')
@@ -306,130 +370,87 @@ class ProtCryosparcBase(pw.EMProtocol):
             if status not in STOP_STATUSES:
                 try:
                     killJob(project, job)
+                    self._materializeJobFiles(job)
                     clearJob(project, job)
                 except Exception as e:
                     logger.error("Can't kill job %s from project %s" % (job, project), exc_info=e)
 
+    def _materializeJobFiles(self, job):
+        """ Replace the links to the files of a cryoSPARC job (lazy outputs)
+        by the files themselves, before the job is cleared """
+        if hasattr(self, 'projectDir'):
+            materializeFiles(self._getPath(),
+                             os.path.join(self.projectDir.get(), str(job)))
+
     def createFSC(self, idd, imgSet, vol):
         # Need to get the cryosparc master address
-        system_info = getSystemInfo()
-        status_errors = system_info[0]
-
-        if not status_errors:
-            cryosparcVersion = getCryosparcVersion()
-            system_info = eval(system_info[1])
-            master_hostname = system_info.get('master_hostname')
-            if parse_version(cryosparcVersion) < parse_version(V4_1_0):
-                port_webapp = system_info.get('port_webapp')
-                url = "http://%s:%s/file/%s" % (master_hostname, port_webapp, idd)
-                fscRequest = requests.get(url, allow_redirects=True)
-            else:
-                port_webapp = system_info.get('port_command_vis')
-                url = "http://%s:%s/get_job_file" % (master_hostname, port_webapp)
-                jsonParam = {'fileid': idd}
-                licence_id = _getLicenceFromFile()
-                headers = {'License-ID': licence_id}
-                fscRequest = requests.post(url, json=jsonParam, headers=headers,
-                                          allow_redirects=True)
+        if getSystemInfo():
             fscFile = "fsc.txt"
             fscFilePath = os.path.join(self._getExtraPath(), fscFile)
             factor = self._getInputParticles().getDim()[0] * imgSet.getSamplingRate()
 
             # Convert into scipion fsc format
-            open(fscFilePath, 'wb').write(fscRequest.content)
+            downloadJobFile(idd, fscFilePath)
             fscSet = self.getSetOfFCSsFromFile(fscFilePath, factor)
             self._defineOutputs(outputFSC=fscSet)
             self._defineSourceRelation(vol, fscSet)
 
     def getSetOfFCSsFromFile(self, file, factor):
-        f = open(file, 'r')
-        lines = f.readlines()
+        """ Create the set of FSCs of a cryoSPARC fsc.txt file, the curves
+        are parsed once (see readCryosparcFsc) """
+        table = readCryosparcFsc(file)
         fscSet = self._createSetOfFSCs()
-        columns = lines[0].strip().split('\t')[1:]
-        col = 1
-        fsc_t = None
-        fsc_nt = None
-
-        for column in columns:
-            if column == 'fsc_tightmask':
-                fsc_t = \
-                self.getFSCFromRawData(lines, column, col, factor).getData()[1]
-            if column == 'fsc_noisesub_true':
-                fsc_nt = \
-                self.getFSCFromRawData(lines, column, col, factor).getData()[1]
+        columns = list(table)
+        wv = (table[columns[0]] / factor).tolist()
+
+        for column in columns[1:]:
             if column not in excludedFSCValues:
-                fsc = self.getFSCFromRawData(lines, column, col, factor)
+                fsc = FSC(objLabel=fscValues[column])
+                fsc.setData(wv, table[column].tolist())
                 fscSet.append(fsc)
-            col += 1
-        f.close()
-        corr = []
-
-        if fsc_t is not None and fsc_nt is not None:  # Phase Randomized Masket Map can be calculated
-            for i in range(len(fsc_t)):
-                fsc_nt_value = 0.99
-                if fsc_nt[i] != 1:
-                     fsc_nt_value = fsc_nt[i]
-                corr.append((fsc_t[i] - fsc_nt[i]) / (1.0 - fsc_nt_value))
-            fsc = FSC(objLabel=fscValues['fsc_prmm'])
-            fsc_wv = fscSet.getFirstItem().getData()[0]
-            fsc.setData(fsc_wv, corr)
-            fscSet.append(fsc)
         fscSet.write()
         return fscSet
 
     def getFSCFromRawData(self, lines, label, col, factor):
-        wv = []
-        corr = []
-        for x in lines[1:]:
-            wv_value = float(x.strip().split('\t')[0])
-            coor_value = x.strip().split('\t')[col]
-            wv.append(str(wv_value / factor))
-            corr.append(coor_value)
+        data = np.loadtxt(lines[1:], delimiter='\t', usecols=(0, col), ndmin=2)
         fsc = FSC(objLabel=fscValues[label])
-        fsc.setData(wv, corr)
+        fsc.setData((data[:, 0] / factor).tolist(), data[:, 1].tolist())
         return fsc
 
     def findLastIteration(self, jobName):
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-
-                if z.startswith('FSC Iteration') or z.startswith('FSC iIteration'):
-                    for imgfile in y['imgfiles']:
-                        if imgfile['filetype'] == 'txt':
-                            idd = imgfile['fileid']
-                            break
-                    itera = z.split(',')[0][-3:]
-                    self._store(self)
-                elif 'Using Filter Radius' in z:
-                    nomRes = str(y['text']).split('(')[1].split(')')[
-                        0].replace(
-                        'A', 'Å')
-                    self.mapResolution = pwobj.String(nomRes)
-                    self._store(self)
-                elif 'Estimated Bfactor' in z:
-                    estBFactor = str(y['text']).split(':')[1].replace('\n',
-                                                                      '')
-                    self.estBFactor = pwobj.String(estBFactor)
-                    self._store(self)
-        return idd, itera
+        index = self.getStreamlogIndex(jobName)
+        if index.mapResolution is not None:
+            self.mapResolution = pwobj.String(index.mapResolution)
+        if index.estBFactor is not None:
+            self.estBFactor = pwobj.String(index.estBFactor)
+        self._store(self)
+        return index.lastFscFileId, index.lastIteration
+
+    def getStreamlogIndex(self, jobName):
+        """ Return the index of the given job event log. It is kept in the
+        protocol folder and only the new events are parsed on each call """
+        return getStreamlogIndex(self.projectName.get(), jobName,
+                                 self._getPath('streamlog_%s.json' % jobName))
 
     def _createModelFile(self):
         pass
 
     def getLogLine(self):
-        return self._logLastLine
+        """ Index of the next cryoSPARC event log line to print. It is
+        stored with the protocol, so a resumed run does not print again the
+        lines already shown """
+        if self.hasAttribute('logLastLine'):
+            return self.logLastLine.get()
+        return 0
 
     def setLogLine(self, lastLine: int):
-        self._logLastLine = lastLine
+        if self.hasAttribute('logLastLine'):
+            self.logLastLine.set(lastLine)
+        else:
+            self.logLastLine = pwobj.Integer(lastLine)
+
+    def getLogLastText(self):
+        return self._logLastText
+
+    def setLogLastText(self, text):
+        self._logLastText = text
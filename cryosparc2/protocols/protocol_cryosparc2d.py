@@ -37,7 +37,8 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
 import pyworkflow.utils as pwutils
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (rowToAlignment, convertCs2Star, cryosparcToLocation)
+from ..convert import (rowToAlignment, convertCs2Star, cryosparcToLocation,
+                       iterCsRows, CS_CLASSIFICATION2D_FIELDS)
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, clearIntermediateResults,
                      copyFiles, getOutputPreffix, isCryosparcStandalone)
@@ -280,9 +281,6 @@ class ProtCryo2D(ProtCryosparcBase, pwprot.ProtClassify2D):
                                                                mrcFileName])
 
         csPartFile = os.path.join(self._getExtraPath(), csParticlesName)
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csPartFile, outputStarFn]
-        convertCs2Star(argsList)
 
         csClassAverageFile = os.path.join(self._getExtraPath(),
                                           csClassAveragesName)
@@ -295,7 +293,7 @@ class ProtCryo2D(ProtCryosparcBase, pwprot.ProtClassify2D):
         self._loadClassesInfo(self._getFileName('out_class_m2'))
         # Use the pointer with extended (indirect)
         classes2DSet = self._createSetOfClasses2D(self.inputParticles)
-        self._fillClassesFromLevel(classes2DSet)
+        self._fillClassesFromLevel(classes2DSet, csPartFile)
 
         self._defineOutputs(outputClasses=classes2DSet)
         self._defineSourceRelation(self.inputParticles, classes2DSet)
@@ -348,16 +346,15 @@ class ProtCryo2D(ProtCryosparcBase, pwprot.ProtClassify2D):
             self._classesInfo[classNumber + 1] = (index, scaledFile, row)
         self._numClass = index
 
-    def _fillClassesFromLevel(self, clsSet):
+    def _fillClassesFromLevel(self, clsSet, csPartFile):
         """ Create the SetOfClasses2D from a given iteration. """
 
         # the particle with orientation parameters (all_parameters)
-        xmpMd = 'particles@' + self._getFileName("out_particles")
-
         clsSet.classifyItems(updateItemCallback=self._updateParticle,
                              updateClassCallback=self._updateClass,
-                             itemDataIterator=emtable.Table.iterRows(
-                                 xmpMd))  # relion style
+                             itemDataIterator=iterCsRows(csPartFile,
+                                                         alignType=ALIGN_2D,
+                                                         fields=CS_CLASSIFICATION2D_FIELDS))
 
     def _updateParticle(self, item, row):
         item.setClassId(row.get(RELIONCOLUMNS.rlnClassNumber.value))
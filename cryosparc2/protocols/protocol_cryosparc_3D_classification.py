@@ -36,10 +36,10 @@ from pyworkflow.protocol.params import (FloatParam, LEVEL_ADVANCED,
                                         BooleanParam, StringParam, EnumParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertBinaryVol, convertCs2Star,
+from ..convert import (convertCs2Star,
                        rowToAlignment, ALIGN_PROJ, cryosparcToLocation)
-from ..utils import (addSymmetryParam, addComputeSectionParams, doImportVolumes,
-                     get_job_streamlog, calculateNewSamplingRate,
+from ..utils import (addSymmetryParam, addComputeSectionParams,
+                     calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, getSymmetry, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, fixVolume,
                      copyFiles, getOutputPreffix)
@@ -249,12 +249,10 @@ class ProtCryoSparc3DClassification(ProtCryosparcBase):
         self.importVolumes = CsvList()
         self._initializeVolumeSuffix()
         for vol in self.vols:
-            self.vol_fn = os.path.join(os.getcwd(),
-                                       convertBinaryVol(
-                                           vol,
-                                           self._getTmpPath()))
-            self.importVolume = doImportVolumes(self, self.vol_fn, vol, 'map',
-                                                'Importing volume...')
+            self.importVolume = self._importVolumeFile(vol,
+                                                       self._getVolumeFile(vol),
+                                                       'map',
+                                                       'Importing volume...')
             self.importVolumes.append(self.importVolume.get())
             self.currenJob.set(self.importVolume.get())
 
@@ -377,25 +375,7 @@ class ProtCryoSparc3DClassification(ProtCryosparcBase):
                 output_file.write(row)
 
     def findLastIteration(self, jobName):
-        import ast
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-                if z.startswith('Done iteration'):
-                    itera = z.split(' ')[2]
-
-        return itera
+        return self.getStreamlogIndex(jobName).doneIteration
 
     # --------------------------- INFO functions -------------------------------
     def _validate(self):
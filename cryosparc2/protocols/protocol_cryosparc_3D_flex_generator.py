@@ -102,7 +102,7 @@ class ProtCryoSparc3DFlexGenerator(ProtCryosparcBase, ProtFlexBase):
         if not validateMsgs:
             flexTrainingProt = self.flexTraining.get()
             flexTrainingJob = getJob(flexTrainingProt.projectName.get(), flexTrainingProt.run3DFlexTrainJob.get())
-            checkPoints = eval(flexTrainingJob[1])['output_result_groups']
+            checkPoints = flexTrainingJob['output_result_groups']
             for output in checkPoints:
                 if output['name'] == 'flex_model':
                     numItems = output['num_items']
@@ -210,9 +210,8 @@ class ProtCryoSparc3DFlexTraining(ProtCryosparcBase, ProtFlexBase):
         copyFiles(csOutputFolder, self._getExtraPath(), files=[csParticlesName, trainModelRar, trainModelCs])
         csPartFile = os.path.join(self._getExtraPath(), csParticlesName)
 
-        # Taking the zvalues from the .cs file using numpy
-        arr = np.load(csPartFile)
-        zValues = [[arr[i][j] for j in range(2, len(arr[i]), 2)] for i in range(len(arr))]
+        # Taking the zvalues from the .cs file, a batch of particles at a time
+        zValues = self._iterZValues(csPartFile)
 
         inputSet = self.input3DFlexDataPrepareProt.get()._getInputParticles()
         outImgSet = SetOfParticlesFlex.create(self._getPath(), suffix='', progName=CRYOSPARCFLEX)
@@ -251,6 +250,15 @@ class ProtCryoSparc3DFlexTraining(ProtCryosparcBase, ProtFlexBase):
 
 
 
+    def _iterZValues(self, csPartFile):
+        """ Iterate over the latent coordinates of the particles (every other
+        field of the latents file, starting at the third one). Only these
+        fields are read """
+        fields = getCsFields(csPartFile)[2::2]
+        for batch in iterCsBatches(csPartFile, fields=fields):
+            for zValue in np.stack([batch[field] for field in fields], axis=1).tolist():
+                yield zValue
+
     def _defineParamsName(self):
         """ Define a list with 3D Flex Training parameters names"""
         self._paramsName = ['flex_K', 'flex_num_layers', 'flex_num_layers',
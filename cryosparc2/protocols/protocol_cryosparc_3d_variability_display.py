@@ -232,15 +232,13 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
 
             filePath = os.path.join(outputFolder, allClusterSeries)
             outputStarFn = os.path.join(starFilesPath, allClusterSeriesStar)
-            argsList = [filePath, outputStarFn]
-            convertCs2Star(argsList)
+            filesList = [(filePath, outputStarFn)]
 
-            # Creating the .star cluster per cluster
+            # Creating the .star cluster per cluster, all the files are
+            # converted in a single request
             numOfClusters = self.var_num_frames.get()
             self.info(pwutils.yellowStr("Generating .star files for all clusters"))
             for i in range(numOfClusters):
-                self.info(pwutils.yellowStr("Processing cluster %d ..." % i))
-
                 clusterParticlesPattern = '%s%s_cluster_%03d_particles.cs' % (getOutputPreffix(self.projectName.get()),
                                                                               self.run3DVariabilityDisplay.get(), i)
 
@@ -254,9 +252,13 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
                 for j in range(len(patterns)):
                     filePath = os.path.join(outputFolder, patterns[j])
                     outputStarFn = os.path.join(starFilesPath, outputs[j])
-                    argsList = [filePath, outputStarFn]
-                    convertCs2Star(argsList)
-                self._partClassDict(os.path.join(starFilesPath, outputs[0]), i)
+                    filesList.append((filePath, outputStarFn))
+            self._convertCsFiles(filesList)
+
+            for i in range(numOfClusters):
+                self.info(pwutils.yellowStr("Processing cluster %d ..." % i))
+                self._partClassDict(os.path.join(starFilesPath,
+                                                 'output_cluster_particle%03d.star' % i), i)
         else:
             # Copy the CS output to extra folder
             outputFolder = self._getExtraPath()
@@ -282,6 +284,7 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
 
                 self._create2DModelFile(componetFilesPath)
 
+                filesList = []
                 for i in range(clusterNumber):
                     componentCSParticlesPattern = '%s%s_particles_series_%d_frame_%d.cs' % (getOutputPreffix(self.projectName.get()),
                                                                                           self.run3DVariabilityDisplay.get(),
@@ -292,9 +295,10 @@ class ProtCryoSparc3DVariabilityDisplay(ProtCryosparcBase, ProtRefine3D):
                     outputStarPath = os.path.join(componetFilesPath, componentStarPattern)
 
                     filePath = os.path.join(outputFolder, componentCSParticlesPattern)
-                    argsList = [filePath, outputStarPath]
-                    convertCs2Star(argsList)
+                    filesList.append((filePath, outputStarPath))
+                self._convertCsFiles(filesList)
 
+                for i, (_, outputStarPath) in enumerate(filesList):
                     self._partClassDict(outputStarPath, i)
 
     def createOutputStep(self):
@@ -36,7 +36,6 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam,
 
 from .protocol_base import ProtCryosparcBase
 from .. import RELIONCOLUMNS
-from ..convert import convertCs2Star
 from ..utils import (addComputeSectionParams, cryosparcValidate,  enqueueJob, waitForCryosparc, clearIntermediateResults,
                      copyFiles)
 
@@ -147,30 +146,31 @@ class ProtCryoSparcBlobPicker(ProtCryosparcBase):
                                       self.runBlobPicker.get())
         # Copy the CS output coordinates to extra folder
         outputPath = os.path.join(self._getExtraPath(), self.runBlobPicker.get())
-        copyFiles(csOutputFolder, outputPath)
         csPickedParticlesName = 'picked_particles.cs'
+        copyFiles(csOutputFolder, outputPath, include=['*.cs'])
 
         csFile = os.path.join(outputPath, csPickedParticlesName)
         outputStarFn = self._getExtraPath('output_coordinates.star')
-        argsList = [csFile, outputStarFn]
-        convertCs2Star(argsList)
-
-        outputCoords = self._fillSetOfCoordinates(micSetPtr, outputStarFn, micList)
+        filesList = [(csFile, outputStarFn)]
 
         # Copy the  CTF output to extra folder
         if self.estimate_ctf.get():
             csOutputFolder = os.path.join(self.projectDir.get(),
                                           self.runPatchCTF.get())
             outputPath = os.path.join(self._getExtraPath(), self.runPatchCTF.get())
-            copyFiles(csOutputFolder, outputPath)
+            copyFiles(csOutputFolder, outputPath, include=['*.cs'])
 
             ctfEstimatedFileName = 'exposures_ctf_estimated.cs'
             csFile = os.path.join(outputPath, ctfEstimatedFileName)
-            outputStarFn = self._getExtraPath('ctf.star')
-            argsList = [csFile, outputStarFn]
-            convertCs2Star(argsList)
+            ctfStarFn = self._getExtraPath('ctf.star')
+            filesList.append((csFile, ctfStarFn))
+
+        self._convertCsFiles(filesList)
 
-            outputCtfSet = self._fillSetOfCTF(outputStarFn, micList)
+        outputCoords = self._fillSetOfCoordinates(micSetPtr, outputStarFn, micList)
+
+        if self.estimate_ctf.get():
+            outputCtfSet = self._fillSetOfCTF(ctfStarFn, micList)
 
             self._defineOutputs(outputCTF=outputCtfSet)
             self._defineSourceRelation(micSetPtr, outputCtfSet)
@@ -26,7 +26,6 @@
 # **************************************************************************
 import os
 
-import emtable
 from pkg_resources import parse_version
 
 from pwem import ALIGN_PROJ
@@ -39,8 +38,8 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
                                         EnumParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
-                       setCryosparcAttributes)
+from ..convert import (iterCsRows, createItemMatrix,
+                       setCryosparcAttributes, CS_REFINEMENT_FIELDS)
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, copyFiles,
                      getCryosparcVersion)
@@ -228,7 +227,6 @@ class ProtCryoSparcGlobalCtfRefinement(ProtCryosparcBase, pwprot.ProtParticles):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runGlobalCtfRefinement.get())
         csFileName = "particles.cs"
@@ -238,25 +236,22 @@ class ProtCryoSparcGlobalCtfRefinement(ProtCryosparcBase, pwprot.ProtParticles):
 
         csFile = os.path.join(self._getExtraPath(), csFileName)
 
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         imgSet = self._getInputParticles()
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
         imgSet.copyItems(self._getInputParticles(),
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         itemDataIterator=iterCsRows(csFile,
+                                                     alignType=ALIGN_PROJ,
+                                                     fields=CS_REFINEMENT_FIELDS))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
@@ -24,10 +24,8 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import ast
 import os
 
-import emtable
 from pkg_resources import parse_version
 
 from pwem import ALIGN_PROJ
@@ -40,13 +38,13 @@ from pyworkflow.protocol.params import (PointerParam, LEVEL_ADVANCED, IntParam,
 from pwem.objects import Volume
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
-                       setCryosparcAttributes)
+from ..convert import (iterCsRows, createItemMatrix,
+                       setCryosparcAttributes, CS_REFINEMENT_FIELDS)
 from ..utils import (addComputeSectionParams, calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, fixVolume,
                      copyFiles, addSymmetryParam, getSymmetry,
-                     getCryosparcVersion, get_job_streamlog, getOutputPreffix)
+                     getCryosparcVersion, getOutputPreffix)
 from ..constants import *
 
 
@@ -284,9 +282,6 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
                                                                half2Name])
 
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csFile, outputStarFn]
-        convertCs2Star(argsList)
 
         fnVol = os.path.join(self._getExtraPath(), fnVolName)
         half1 = os.path.join(self._getExtraPath(), half1Name)
@@ -302,7 +297,7 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputVolume=vol)
         self._defineSourceRelation(self.inputParticles, vol)
@@ -310,12 +305,13 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
         self._defineTransformRelation(self.inputParticles, outImgSet)
         self.createFSC(idd, imgSet, vol)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
         imgSet.copyItems(self._getInputParticles(),
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         itemDataIterator=iterCsRows(csFile,
+                                                     alignType=ALIGN_PROJ,
+                                                     fields=CS_REFINEMENT_FIELDS))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
@@ -323,25 +319,7 @@ class ProtCryoSparcHomogeneousReconstruct(ProtCryosparcBase):
                                RELIONCOLUMNS.rlnRandomSubset.value)
 
     def findLastIteration(self, jobName):
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-
-                if z.startswith('FSC, after mask auto-tightening'):
-                    idd = y['imgfiles'][2]['fileid']
-
-        return idd
+        return self.getStreamlogIndex(jobName).tightMaskFscFileId
 
     # --------------------------- INFO functions -------------------------------
     def _validate(self):
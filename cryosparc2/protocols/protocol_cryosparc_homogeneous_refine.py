@@ -25,7 +25,6 @@
 # *
 # **************************************************************************
 import os
-import emtable
 from pkg_resources import parse_version
 
 import pwem.objects as pwobj
@@ -35,8 +34,8 @@ from pwem.convert.symmetry import moveParticleInsideUnitCell
 from pyworkflow.protocol.params import *
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
-                       setCryosparcAttributes)
+from ..convert import (iterCsRows, createItemMatrix,
+                       setCryosparcAttributes, CS_REFINEMENT_FIELDS)
 from ..utils import (addSymmetryParam, addComputeSectionParams,
                      calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, getSymmetry,
@@ -456,11 +455,6 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
 
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
 
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         fnVol = os.path.join(self._getExtraPath(), fnVolName)
         half1 = os.path.join(self._getExtraPath(), half1Name)
         half2 = os.path.join(self._getExtraPath(), half2Name)
@@ -477,7 +471,7 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
         self._getUnitCellMatricesAndPlanes()
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         # if self.symmetryGroup.get() == SYM_DIHEDRAL_Y:
         #     from pwem.convert.symmetry import Dihedral
@@ -557,13 +551,13 @@ class ProtCryoSparc3DHomogeneousRefine(ProtCryosparcBase):
                                                  n=self.symmetryOrder.get(),
                                                  generalize=False)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
         imgSet.copyItems(self._getInputParticles(),
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(
-                             fileName=outImgsFn))
+                         itemDataIterator=iterCsRows(csFile,
+                                                     alignType=pwobj.ALIGN_PROJ,
+                                                     fields=CS_REFINEMENT_FIELDS))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=pwobj.ALIGN_PROJ)
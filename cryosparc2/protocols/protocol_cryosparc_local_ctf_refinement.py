@@ -26,7 +26,6 @@
 # **************************************************************************
 import os
 
-import emtable
 
 from pwem import ALIGN_PROJ
 from pwem.protocols import ProtParticles
@@ -37,8 +36,8 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam,
 
 from .protocol_base import ProtCryosparcBase
 from .. import RELIONCOLUMNS
-from ..convert import (convertCs2Star, createItemMatrix,
-                       setCryosparcAttributes)
+from ..convert import (iterCsRows, createItemMatrix,
+                       setCryosparcAttributes, CS_REFINEMENT_FIELDS)
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, copyFiles)
 
@@ -162,7 +161,6 @@ class ProtCryoSparcLocalCtfRefinement(ProtCryosparcBase, ProtParticles):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runLocalCtfRefinement.get())
         csFileName = "particles.cs"
@@ -172,25 +170,22 @@ class ProtCryoSparcLocalCtfRefinement(ProtCryosparcBase, ProtParticles):
 
         csFile = os.path.join(self._getExtraPath(), csFileName)
 
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
-
         imgSet = self._getInputParticles()
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
         imgSet.copyItems(self._getInputParticles(),
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         itemDataIterator=iterCsRows(csFile,
+                                                     alignType=ALIGN_PROJ,
+                                                     fields=CS_REFINEMENT_FIELDS))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
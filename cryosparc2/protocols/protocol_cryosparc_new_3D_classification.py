@@ -39,10 +39,10 @@ from pyworkflow.protocol.params import (FloatParam, LEVEL_ADVANCED,
                                         BooleanParam, EnumParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertBinaryVol, convertCs2Star,
+from ..convert import (convertCs2Star,
                        rowToAlignment, ALIGN_PROJ, cryosparcToLocation)
-from ..utils import (addComputeSectionParams, doImportVolumes,
-                     get_job_streamlog, calculateNewSamplingRate,
+from ..utils import (addComputeSectionParams,
+                     calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
                      waitForCryosparc, clearIntermediateResults, fixVolume,
                      copyFiles, getCryosparcVersion, getOutputPreffix)
@@ -481,35 +481,7 @@ class ProtCryoSparcNew3DClassification(ProtCryosparcBase):
                 output_file.write(row)
 
     def findLastIteration(self, jobName):
-        import ast
-        get_job_streamlog(self.projectName.get(),
-                          jobName,
-                          self._getFileName('stream_log'))
-
-        # Get the metadata information from stream.log
-        with open(self._getFileName('stream_log')) as f:
-            data = f.readlines()
-
-        x = ast.literal_eval(data[0])
-        it = None
-        itera = None
-
-        # Find the ID of last iteration and the map resolution
-        for y in x:
-            if 'text' in y:
-                z = str(y['text'])
-                if z.startswith('Batch Class Distribution (Iteration:'):
-                    it = z.split(': ')[1].split(')')[0]
-                elif z.startswith('Viewing Direction Distribution (Iteration'):
-                    it = z.split(' ')[4].split(')')[0]
-
-                if it is not None:
-                    if int(it) > 99:
-                        itera = it
-                    else:
-                        itera = '0' + it if int(it) >= 10 else '00' + it
-
-        return itera
+        return self.getStreamlogIndex(jobName).classIteration
 
     # --------------------------- INFO functions -------------------------------
 
@@ -556,13 +528,10 @@ class ProtCryoSparcNew3DClassification(ProtCryosparcBase):
         self.importVolumes = CsvList()
         self._initializeVolumeSuffix()
         for vol in self.vols:
-            self.vol_fn = os.path.join(os.getcwd(),
-                                       convertBinaryVol(
-                                           vol,
-                                           self._getTmpPath()))
-            self.importVolume = doImportVolumes(self, self.vol_fn, vol,
-                                                'map',
-                                                'Importing volume...')
+            self.importVolume = self._importVolumeFile(vol,
+                                                       self._getVolumeFile(vol),
+                                                       'map',
+                                                       'Importing volume...')
             self.importVolumes.append(self.importVolume.get())
             self.currenJob.set(self.importVolume.get())
 
@@ -27,7 +27,6 @@
 
 import os
 
-import emtable
 
 from pwem import ALIGN_PROJ
 from pwem.protocols import ProtOperateParticles
@@ -39,8 +38,8 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
 from pwem.objects import Volume
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, createItemMatrix,
-                       setCryosparcAttributes)
+from ..convert import (iterCsRows, createItemMatrix,
+                       setCryosparcAttributes, CS_REFINEMENT_FIELDS)
 from ..utils import (addComputeSectionParams, calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
                      waitForCryosparc, clearIntermediateResults,
@@ -260,9 +259,6 @@ class ProtCryoSparcLocalRefine(ProtCryosparcBase, ProtOperateParticles):
                                                                half2Name])
 
         csFile = os.path.join(self._getExtraPath(), csParticlesName)
-        outputStarFn = self._getFileName('out_particles')
-        argsList = [csFile, outputStarFn]
-        convertCs2Star(argsList)
 
         fnVol = os.path.join(self._getExtraPath(), fnVolName)
         half1 = os.path.join(self._getExtraPath(), half1Name)
@@ -278,7 +274,7 @@ class ProtCryoSparcLocalRefine(ProtCryosparcBase, ProtOperateParticles):
 
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputVolume=vol)
         self._defineSourceRelation(self.inputParticles.get(), vol)
@@ -337,12 +333,13 @@ class ProtCryoSparcLocalRefine(ProtCryosparcBase, ProtOperateParticles):
 
     # ---------------Utils Functions------------------------------------
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         imgSet.setAlignmentProj()
         imgSet.copyItems(self._getInputParticles(),
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=emtable.Table.iterRows(outImgsFn))
+                         itemDataIterator=iterCsRows(csFile,
+                                                     alignType=ALIGN_PROJ,
+                                                     fields=CS_REFINEMENT_FIELDS))
 
     def _createItemMatrix(self, particle, row):
         createItemMatrix(particle, row, align=ALIGN_PROJ)
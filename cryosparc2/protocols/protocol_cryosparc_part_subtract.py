@@ -35,7 +35,7 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam,
                                         LEVEL_ADVANCED, Positive, BooleanParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, readSetOfParticles,
+from ..convert import (readSetOfParticles,
                        cryosparcToLocation)
 from ..utils import (addComputeSectionParams, calculateNewSamplingRate,
                      cryosparcValidate, gpusValidate, enqueueJob,
@@ -159,7 +159,6 @@ class ProtCryoSparcSubtract(ProtCryosparcBase, ProtOperateParticles):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runPartStract.get())
         csFileName = "subtracted_particles.cs"
@@ -170,23 +169,19 @@ class ProtCryoSparcSubtract(ProtCryosparcBase, ProtOperateParticles):
 
         csFile = os.path.join(self._getExtraPath(), self.runPartStract.get(),
                               csFileName)
-        argsList = [csFile, outputStarFn]
-        convertCs2Star(argsList)
 
         imgSet = self._getInputParticles()
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
+    def _fillDataFromIter(self, imgSet, csFile):
         hasCtf = imgSet.hasCTF()
         hasAcquisition = True  # I think this is always present ROB
-        readSetOfParticles(outImgsFn, imgSet,
+        readSetOfParticles(csFile, imgSet,
                            postprocessImageRow=self._updateItem,
                            alignType=ALIGN_PROJ, readCtf=hasCtf, 
                            readAcquisition=hasAcquisition,
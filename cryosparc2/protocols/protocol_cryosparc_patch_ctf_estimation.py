@@ -137,7 +137,7 @@ class ProtCryoSparcPatchCTFEstimate(ProtCryosparcBase):
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runPatchCTF.get())
         outputPath = os.path.join(self._getExtraPath(), self.runPatchCTF.get())
-        copyFiles(csOutputFolder, outputPath)
+        copyFiles(csOutputFolder, outputPath, include=['*.cs'])
 
         ctfEstimatedFileName = 'exposures_ctf_estimated.cs'
         csFile = os.path.join(outputPath, ctfEstimatedFileName)
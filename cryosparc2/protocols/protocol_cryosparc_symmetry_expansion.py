@@ -34,7 +34,7 @@ from pyworkflow.protocol.params import (PointerParam, FloatParam,
                                         IntParam)
 
 from .protocol_base import ProtCryosparcBase
-from ..convert import (convertCs2Star, readSetOfParticles)
+from ..convert import readSetOfParticles
 from ..utils import (addComputeSectionParams, cryosparcValidate, gpusValidate,
                      enqueueJob, waitForCryosparc, clearIntermediateResults,
                      addSymmetryParam, getSymmetry, copyFiles)
@@ -115,7 +115,6 @@ class ProtCryoSparcSymmetryExpansion(ProtCryosparcBase):
         Create the protocol output. Convert cryosparc file to Relion file
         """
         self._initializeUtilsVariables()
-        outputStarFn = self._getFileName('out_particles')
         csOutputFolder = os.path.join(self.projectDir.get(),
                                       self.runSymExp.get())
         csFileName = "particles_expanded.cs"
@@ -125,22 +124,18 @@ class ProtCryoSparcSymmetryExpansion(ProtCryosparcBase):
 
         csFile = os.path.join(self._getExtraPath(), csFileName)
 
-        argsList = [csFile, outputStarFn]
-
-        convertCs2Star(argsList)
         imgSet = self._getInputParticles()
         self.setFilePattern(imgSet.getFirstItem().getFileName())
         outImgSet = self._createSetOfParticles()
         outImgSet.copyInfo(imgSet)
         outImgSet.setDim(imgSet.getDim())
-        self._fillDataFromIter(outImgSet)
+        self._fillDataFromIter(outImgSet, csFile)
 
         self._defineOutputs(outputParticles=outImgSet)
         self._defineTransformRelation(imgSet, outImgSet)
 
-    def _fillDataFromIter(self, imgSet):
-        outImgsFn = 'particles@' + self._getFileName('out_particles')
-        readSetOfParticles(outImgsFn, imgSet,
+    def _fillDataFromIter(self, imgSet, csFile):
+        readSetOfParticles(csFile, imgSet,
                            postprocessImageRow=self.updateParticlePath,
                            alignType=imgSet.getAlignment(),
                            samplingRate=imgSet.getSamplingRate())
@@ -0,0 +1,491 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Local stand-in for a cryoSPARC master. It implements the command_core
+functions used by the plugin over JSON-RPC, serves job files as the
+command_vis/webapp servers do, and installs a fake `cryosparcm` executable,
+so the plugin can be tested and benchmarked on a machine without cryoSPARC
+or GPUs.
+
+Jobs do not compute anything: when a job completes, the outputs recorded for
+its job type are replayed into the job directory. A recordings folder has
+one sub folder per job type:
+
+    <recordsDir>/<job_type>/
+        streamlog.json  list of events of the job event log
+        job.json        (optional) extra fields returned by get_job
+        outputs/        files copied into the job folder on completion
+        files/<fileid>  files served by get_job_file and /file/<fileid>
+
+The "{job}" placeholder is replaced by the job uid in the output file names
+and in the streamlog texts.
+
+Run it standalone with:
+    python -m cryosparc2.tests.fake_master <rootDir> [--records DIR] [--latency SECS]
+and set CRYOSPARC_HOME=<rootDir> in the Scipion config.
+"""
+import argparse
+import inspect
+import json
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_LICENSE = 'fake-license-id'
+FAKE_VERSION = 'v4.4.0'
+FAKE_USER_ID = 'fake-user-id'
+
+CRYOSPARCM_SCRIPT = """#!%(python)s
+# Fake cryosparcm: only the 'cli' mode is supported
+import ast
+import json
+import sys
+import urllib.request
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] != 'cli':
+        print("Only 'cryosparcm cli' is supported by the fake master")
+        return 1
+    call = ast.parse(argv[2].strip(), mode='eval').body
+    params = [ast.literal_eval(arg) for arg in call.args]
+    payload = json.dumps({'jsonrpc': '2.0', 'method': call.func.id,
+                          'params': params, 'id': 1}).encode()
+    request = urllib.request.Request('%(url)s', data=payload,
+                                     headers={'Content-Type': 'application/json'})
+    content = json.loads(urllib.request.urlopen(request).read())
+    if content.get('error') is not None:
+        print(content['error'])
+        return 1
+    print(content['result'])
+    return 0
+
+
+sys.exit(main(sys.argv))
+"""
+
+
+class FakeCryosparcMaster:
+    """ Fake cryoSPARC master running in a background thread.
+    :param rootDir: folder used as CRYOSPARC_HOME. The cryosparc_master
+                    config files, the cryosparcm executable and the projects
+                    are created inside it
+    :param recordsDir: folder with the recorded job outputs (see module doc)
+    :param latency: seconds added to every request
+    :param jobDuration: seconds a job stays running before completing
+    :param failJobTypes: job types that finish with 'failed' status
+    """
+    def __init__(self, rootDir, recordsDir=None, latency=0., jobDuration=0.,
+                 version=FAKE_VERSION, failJobTypes=()):
+        self.rootDir = os.path.abspath(rootDir)
+        self.recordsDir = recordsDir
+        self.latency = latency
+        self.jobDuration = jobDuration
+        self.version = version
+        self.failJobTypes = list(failJobTypes)
+        self.projects = {}
+        self.workspaces = {}
+        self.jobs = {}
+        self.calls = []
+        self._lock = threading.RLock()
+        self._stopEvent = threading.Event()
+        self._server = None
+        self._thread = None
+
+    # --------------------------- server functions ----------------------------
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return "http://localhost:%d/api" % self.port
+
+    def start(self):
+        master = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                content = json.loads(self.rfile.read(length) or b'{}')
+                master.sleep(master.latency)
+                if self.path == '/api':
+                    self._sendJson(master.dispatch(content))
+                elif self.path == '/get_job_file':
+                    self._sendFile(content.get('fileid'))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                master.sleep(master.latency)
+                if self.path.startswith('/file/'):
+                    self._sendFile(self.path.split('/')[-1])
+                else:
+                    self.send_error(404)
+
+            def _sendJson(self, content):
+                data = json.dumps(content).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _sendFile(self, fileId):
+                path = master.findFile(fileId)
+                if path is None:
+                    self.send_error(404)
+                    return
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        self._createInstallation()
+        return self
+
+    def sleep(self, seconds):
+        """ Wait the given seconds or until the master is stopped """
+        if seconds:
+            self._stopEvent.wait(seconds)
+
+    def stop(self):
+        self._stopEvent.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _createInstallation(self):
+        """ Create the cryosparc_master files read by the plugin """
+        masterDir = os.path.join(self.rootDir, 'cryosparc_master')
+        binDir = os.path.join(masterDir, 'bin')
+        os.makedirs(binDir, exist_ok=True)
+        with open(os.path.join(masterDir, 'version'), 'w') as f:
+            f.write(self.version + '\n')
+        with open(os.path.join(masterDir, 'config.sh'), 'w') as f:
+            f.write('export CRYOSPARC_LICENSE_ID="%s"\n' % FAKE_LICENSE)
+            f.write('export CRYOSPARC_MASTER_HOSTNAME="localhost"\n')
+            # The command_core port is base port + 2
+            f.write('export CRYOSPARC_BASE_PORT=%d\n' % (self.port - 2))
+        cryosparcm = os.path.join(binDir, 'cryosparcm')
+        with open(cryosparcm, 'w') as f:
+            f.write(CRYOSPARCM_SCRIPT % {'python': sys.executable,
+                                         'url': self.url})
+        os.chmod(cryosparcm, os.stat(cryosparcm).st_mode | stat.S_IEXEC)
+
+    def dispatch(self, content):
+        """ Execute a JSON-RPC request and build its response """
+        method = content.get('method', '')
+        params = content.get('params', [])
+        response = {'jsonrpc': '2.0', 'id': content.get('id')}
+        function = getattr(self, 'rpc_' + method.replace('.', '_'), None)
+        with self._lock:
+            self.calls.append(method)
+        if function is None:
+            response['error'] = {'code': -32601,
+                                 'message': 'Method not found: %s' % method}
+            return response
+        try:
+            args = params if isinstance(params, list) else []
+            kwargs = params if isinstance(params, dict) else {}
+            response['result'] = function(*args, **kwargs)
+        except Exception as e:
+            response['error'] = {'code': 500, 'message': str(e)}
+        return response
+
+    def findFile(self, fileId):
+        if self.recordsDir is None or fileId is None:
+            return None
+        for jobType in os.listdir(self.recordsDir):
+            path = os.path.join(self.recordsDir, jobType, 'files', str(fileId))
+            if os.path.exists(path):
+                return path
+        return None
+
+    # --------------------------- job functions -------------------------------
+    def _getJob(self, projectUid, jobUid):
+        job = self.jobs.get((str(projectUid), str(jobUid)))
+        if job is None:
+            raise Exception("Job %s does not exist in project %s"
+                            % (jobUid, projectUid))
+        self._updateJob(job)
+        return job
+
+    def _updateJob(self, job):
+        """ Move the job forward in time and replay its outputs """
+        if job['status'] not in ('queued', 'running'):
+            return
+        elapsed = time.time() - job['queued_at']
+        if elapsed < self.jobDuration:
+            job['status'] = 'running'
+            return
+        jobDir = os.path.join(self.projects[job['project_uid']]['project_dir'],
+                              job['uid'])
+        os.makedirs(jobDir, exist_ok=True)
+        recordDir = self._recordDir(job['job_type'])
+        if recordDir is not None:
+            outputsDir = os.path.join(recordDir, 'outputs')
+            if os.path.exists(outputsDir):
+                for fileName in os.listdir(outputsDir):
+                    src = os.path.join(outputsDir, fileName)
+                    dst = os.path.join(jobDir,
+                                       fileName.replace('{job}', job['uid']))
+                    if os.path.isdir(src):
+                        shutil.copytree(src, dst, dirs_exist_ok=True)
+                    else:
+                        shutil.copy(src, dst)
+        failed = job['job_type'] in self.failJobTypes
+        job['status'] = 'failed' if failed else 'completed'
+
+    def _recordDir(self, jobType):
+        if self.recordsDir is None:
+            return None
+        recordDir = os.path.join(self.recordsDir, jobType)
+        return recordDir if os.path.exists(recordDir) else None
+
+    def _streamlog(self, job):
+        recordDir = self._recordDir(job['job_type'])
+        events = []
+        if recordDir is not None:
+            logFile = os.path.join(recordDir, 'streamlog.json')
+            if os.path.exists(logFile):
+                with open(logFile) as f:
+                    events = json.loads(f.read().replace('{job}', job['uid']))
+        if job['status'] == 'running' and self.jobDuration:
+            # Reveal the events proportionally to the elapsed time
+            fraction = (time.time() - job['queued_at']) / self.jobDuration
+            events = events[:int(len(events) * min(fraction, 1.))]
+        elif job['status'] in ('building', 'queued'):
+            events = []
+        return events
+
+    # --------------------------- RPC functions -------------------------------
+    def rpc_system_describe(self):
+        procs = []
+        for name in dir(self):
+            if name.startswith('rpc_') and name != 'rpc_system_describe':
+                params = list(inspect.signature(getattr(self, name)).parameters)
+                procs.append({'name': name[4:],
+                              'params': [{'name': p} for p in params]})
+        return {'procs': procs}
+
+    def rpc_test_connection(self):
+        return True
+
+    def rpc_get_running_version(self):
+        return self.version
+
+    def rpc_get_system_info(self):
+        return {'master_hostname': 'localhost',
+                'port_webapp': self.port,
+                'port_app': self.port,
+                'port_mongo': self.port,
+                'port_command_core': self.port,
+                'port_command_vis': self.port,
+                'port_command_proxy': self.port,
+                'port_command_rtp': self.port,
+                'port_rtp_webapp': self.port,
+                'version': self.version}
+
+    def rpc_UserExists(self, email):
+        return True
+
+    def rpc_GetUser(self, email):
+        return {'_id': FAKE_USER_ID, 'emails': [{'address': email}]}
+
+    def rpc_get_scheduler_lanes(self):
+        return [{'name': 'default', 'type': 'node', 'title': 'default'}]
+
+    def rpc_check_or_create_project_container_dir(self, projectContainerDir):
+        os.makedirs(projectContainerDir, exist_ok=True)
+        return projectContainerDir
+
+    def rpc_create_empty_project(self, owner, projectContainerDir, title=None,
+                                 *args):
+        with self._lock:
+            uid = 'P%d' % (len(self.projects) + 1)
+            projectDir = os.path.join(projectContainerDir,
+                                      'CS-%s' % str(title).lower())
+            os.makedirs(projectDir, exist_ok=True)
+            project = {'uid': uid, 'title': title, 'owner_user_id': owner,
+                       'project_dir': projectDir}
+            with open(os.path.join(projectDir, 'project.json'), 'w') as f:
+                json.dump(project, f)
+            self.projects[uid] = project
+        return uid
+
+    def rpc_list_projects(self, *args):
+        return list(self.projects.values())
+
+    def rpc_get_project(self, projectUid):
+        return self.projects[projectUid]
+
+    def rpc_update_project_directory(self, projectUid, newProjectDir):
+        self.projects[projectUid]['project_dir'] = newProjectDir
+
+    def rpc_create_empty_workspace(self, projectUid, user, createdByJob=None,
+                                   title=None, desc=None):
+        with self._lock:
+            workspaces = self.workspaces.setdefault(projectUid, [])
+            uid = 'W%d' % (len(workspaces) + 1)
+            workspaces.append({'uid': uid, 'project_uid': projectUid,
+                               'title': title, 'description': desc})
+        return uid
+
+    def rpc_list_workspaces(self, projectUid=None):
+        if projectUid is None:
+            return [w for ws in self.workspaces.values() for w in ws]
+        return self.workspaces.get(projectUid, [])
+
+    def rpc_make_job(self, jobType, projectUid, workspaceUid, userId, *args):
+        dicts = [arg for arg in args if isinstance(arg, dict)]
+        with self._lock:
+            projectJobs = [key for key in self.jobs if key[0] == projectUid]
+            uid = 'J%d' % (len(projectJobs) + 1)
+            self.jobs[(projectUid, uid)] = {
+                'uid': uid, 'project_uid': projectUid,
+                'workspace_uid': workspaceUid, 'job_type': jobType,
+                'params': dicts[0] if dicts else {},
+                'input_group_connects': dict(dicts[1]) if len(dicts) > 1 else {},
+                'result_connects': {}, 'status': 'building',
+                'queued_at': None}
+        return uid
+
+    def rpc_do_job(self, jobType, projectUid, workspaceUid, userId, params={},
+                   inputGroupConnects={}):
+        uid = self.rpc_make_job(jobType, projectUid, workspaceUid, userId,
+                                params, inputGroupConnects)
+        self.rpc_enqueue_job(projectUid, uid)
+        return uid
+
+    def rpc_job_connect_group(self, projectUid, sourceGroup, destGroup):
+        jobUid, group = destGroup.split('.', 1)
+        job = self._getJob(projectUid, jobUid)
+        job['input_group_connects'].setdefault(group, [])
+        if not isinstance(job['input_group_connects'][group], list):
+            job['input_group_connects'][group] = [job['input_group_connects'][group]]
+        job['input_group_connects'][group].append(sourceGroup)
+        return True
+
+    def rpc_job_connect_result(self, projectUid, sourceResult, destResult):
+        jobUid, result = destResult.split('.', 1)
+        self._getJob(projectUid, jobUid)['result_connects'][result] = sourceResult
+        return True
+
+    def rpc_enqueue_job(self, projectUid, jobUid, lane=None, *args):
+        job = self._getJob(projectUid, jobUid)
+        job['status'] = 'queued'
+        job['queued_at'] = time.time()
+        return 'queued'
+
+    def rpc_get_job_status(self, projectUid, jobUid):
+        return self._getJob(projectUid, jobUid)['status']
+
+    def rpc_wait_job_complete(self, projectUid, jobUid, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            status = self.rpc_get_job_status(projectUid, jobUid)
+            if status not in ('queued', 'running'):
+                return status
+            self.sleep(0.05)
+        return self.rpc_get_job_status(projectUid, jobUid)
+
+    def rpc_get_job(self, projectUid, jobUid, *fields):
+        job = dict(self._getJob(projectUid, jobUid))
+        job.setdefault('output_result_groups', [])
+        recordDir = self._recordDir(job['job_type'])
+        if recordDir is not None:
+            jobFile = os.path.join(recordDir, 'job.json')
+            if os.path.exists(jobFile):
+                with open(jobFile) as f:
+                    job.update(json.load(f))
+        return job
+
+    def rpc_get_job_streamlog(self, project_uid, job_uid, offset=0):
+        return self._streamlog(self._getJob(project_uid, job_uid))[offset:]
+
+    def rpc_get_job_log(self, projectUid, jobUid):
+        events = self.rpc_get_job_streamlog(projectUid, jobUid)
+        return '\n'.join(e.get('text', '') for e in events)
+
+    def rpc_kill_job(self, projectUid, jobUid):
+        self._getJob(projectUid, jobUid)['status'] = 'killed'
+
+    def rpc_clear_job(self, projectUid, jobUid):
+        job = self._getJob(projectUid, jobUid)
+        job['status'] = 'building'
+        job['queued_at'] = None
+
+    def rpc_clear_intermediate_results(self, projectUid, jobUid, *args):
+        self._getJob(projectUid, jobUid)
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake cryoSPARC master")
+    parser.add_argument("rootDir", help="Folder used as CRYOSPARC_HOME")
+    parser.add_argument("--records", help="Folder with recorded job outputs")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="Seconds added to every request")
+    parser.add_argument("--job-duration", type=float, default=0.,
+                        dest="jobDuration",
+                        help="Seconds a job stays running")
+    args = parser.parse_args()
+    master = FakeCryosparcMaster(args.rootDir, args.records, args.latency,
+                                 args.jobDuration).start()
+    print("Fake cryoSPARC master listening at %s" % master.url)
+    print("Set CRYOSPARC_HOME=%s" % master.rootDir, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        master.stop()
+
+
+if __name__ == "__main__":
+    main()
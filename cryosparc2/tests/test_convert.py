@@ -0,0 +1,398 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import emtable
+import numpy as np
+
+import pwem.emlib.metadata as md
+from pwem.constants import ALIGN_PROJ
+from pwem.objects import (SetOfParticles, Particle, CTFModel, Acquisition,
+                          Coordinate, Transform)
+
+from cryosparc2.constants import RELIONCOLUMNS, ALIGNMENT_MATRIX_LABEL
+from cryosparc2 import Plugin
+from cryosparc2.convert import Cs2StarWorker, Cs2StarPool, Cs2StarCache
+from cryosparc2.convert import (iterCsRows, iterCsBatches, csToRelionColumns,
+                                expmap, rot2euler, rowToAlignment,
+                                geometryFromMatrix, geometryFromMatrices,
+                                matrixFromGeometry, matricesFromGeometry,
+                                writeParticlesStar, setOfImagesToMd,
+                                particleToRow, addRandomSubset,
+                                iterParticleColumns, relionColumnsToCs,
+                                getCsSlots, CS_REFINEMENT_FIELDS,
+                                readCryosparcFsc)
+
+
+def createParticlesCs(fileName, numParticles=4):
+    """ Write a .cs file with the fields of a refinement output """
+    dtype = [('uid', '<u8'), ('blob/path', 'S32'), ('blob/idx', '<u4'),
+             ('blob/psize_A', '<f4'), ('ctf/df1_A', '<f4'),
+             ('ctf/df2_A', '<f4'), ('ctf/df_angle_rad', '<f4'),
+             ('ctf/phase_shift_rad', '<f4'),
+             ('alignments3D/pose', '<f4', (3,)),
+             ('alignments3D/shift', '<f4', (2,)),
+             ('alignments3D/psize_A', '<f4'),
+             ('alignments3D/split', '<u4')]
+    cs = np.zeros(numParticles, dtype=dtype)
+    cs['uid'] = np.arange(numParticles)
+    cs['blob/path'] = b'J1/imported/particles.mrcs'
+    cs['blob/idx'] = np.arange(numParticles)
+    cs['blob/psize_A'] = 1.5
+    cs['ctf/df1_A'] = 10000
+    cs['ctf/df2_A'] = 9000
+    cs['ctf/df_angle_rad'] = np.pi / 4
+    cs['alignments3D/pose'] = np.linspace(-1, 1, numParticles * 3).reshape(-1, 3)
+    cs['alignments3D/shift'] = [1, -2]
+    cs['alignments3D/psize_A'] = 2.
+    cs['alignments3D/split'] = np.arange(numParticles) % 2
+    with open(fileName, 'wb') as f:
+        np.save(f, cs)
+    return cs
+
+
+class TestCsReader(unittest.TestCase):
+    """ Read cryoSPARC .cs files without the STAR conversion """
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.csFile = os.path.join(self.tmpDir.name, 'particles.cs')
+        self.cs = createParticlesCs(self.csFile)
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testEulerAngles(self):
+        def relionMatrix(rot, tilt, psi):
+            ca, sa, cb, sb = np.cos(rot), np.sin(rot), np.cos(tilt), np.sin(tilt)
+            cg, sg = np.cos(psi), np.sin(psi)
+            return np.array([[cg * cb * ca - sg * sa, cg * cb * sa + sg * ca, -cg * sb],
+                             [-sg * cb * ca - cg * sa, -sg * cb * sa + cg * ca, sg * sb],
+                             [sb * ca, sb * sa, cb]])
+
+        angles = np.array([[0.3, 1.2, -2.5], [-3.0, 0.1, 1.], [2., 3.0, 0.]])
+        matrices = np.array([relionMatrix(*a) for a in angles])
+        self.assertTrue(np.allclose(rot2euler(matrices), angles))
+        self.assertTrue(np.allclose(rot2euler(np.eye(3)), [[0, 0, 0]]))
+
+        # expmap rotates by -theta around the pose axis (pyem convention)
+        pose = np.array([[0, 0, np.pi / 2]])
+        self.assertTrue(np.allclose(expmap(pose)[0],
+                                    [[0, 1, 0], [-1, 0, 0], [0, 0, 1]]))
+
+    def testParticleRows(self):
+        rows = list(iterCsRows(self.csFile))
+        self.assertEqual(len(rows), len(self.cs))
+
+        row = rows[1]
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnImageName.value),
+                         '000002@J1/imported/particles.mrcs')
+        self.assertAlmostEqual(row.get(RELIONCOLUMNS.rlnDefocusAngle.value), 45, 4)
+        self.assertAlmostEqual(row.get(RELIONCOLUMNS.rlnOriginXAngst.value), 2.)
+        self.assertAlmostEqual(row.get(RELIONCOLUMNS.rlnOriginYAngst.value), -4.)
+        self.assertEqual(row.get(RELIONCOLUMNS.rlnRandomSubset.value), 2)
+        self.assertFalse(row.hasColumn(RELIONCOLUMNS.rlnCoordinateX.value))
+
+        # The rows feed the same conversion used for the STAR files
+        alignment = rowToAlignment(row, ALIGN_PROJ, pixelSize=2.)
+        self.assertIsNotNone(alignment)
+        columns = csToRelionColumns(self.cs)
+        self.assertEqual(columns[RELIONCOLUMNS.rlnAngleTilt.value].shape,
+                         (len(self.cs),))
+
+    def testBatches(self):
+        batches = list(iterCsBatches(self.csFile, batchSize=3))
+        self.assertEqual([len(batch) for batch in batches], [3, 1])
+        self.assertNotIsInstance(batches[0], np.memmap)
+
+        rows = list(iterCsRows(self.csFile, batchSize=3))
+        self.assertEqual([row.get(RELIONCOLUMNS.rlnImageName.value) for row in rows],
+                         ['%06d@J1/imported/particles.mrcs' % (i + 1)
+                          for i in range(len(self.cs))])
+        self.assertEqual(rows, list(iterCsRows(self.csFile)))
+
+    def testFields(self):
+        batches = list(iterCsBatches(self.csFile, batchSize=3,
+                                     fields=['blob/psize_A', 'alignments3D']))
+        self.assertEqual(batches[0].dtype.names,
+                         ('blob/psize_A', 'alignments3D/pose',
+                          'alignments3D/shift', 'alignments3D/psize_A',
+                          'alignments3D/split'))
+        self.assertTrue(np.array_equal(np.concatenate(batches)['alignments3D/pose'],
+                                       self.cs['alignments3D/pose']))
+
+        # The projected rows have the same values for the columns they keep
+        fullRows = list(iterCsRows(self.csFile))
+        rows = list(iterCsRows(self.csFile, fields=CS_REFINEMENT_FIELDS))
+        self.assertFalse(rows[0].hasColumn(RELIONCOLUMNS.rlnImageName.value))
+        for row, fullRow in zip(rows, fullRows):
+            for label, value in row._asdict().items():
+                self.assertEqual(value, fullRow.get(label))
+
+
+class TestBatchedGeometry(unittest.TestCase):
+    """ The batched alignment conversion matches the per-particle one """
+
+    def testGeometry(self):
+        rng = np.random.default_rng(0)
+        shifts = rng.uniform(-10, 10, (50, 3))
+        angles = rng.uniform(-180, 180, (50, 3))
+        angles[:2, 1] = [0, 180]  # gimbal lock
+        for inverse in (False, True):
+            matrices = matricesFromGeometry(shifts, angles, inverse)
+            for i in range(len(shifts)):
+                self.assertTrue(np.allclose(
+                    matrices[i], matrixFromGeometry(shifts[i], angles[i], inverse)))
+            batchShifts, batchAngles = geometryFromMatrices(matrices, inverse)
+            for i, matrix in enumerate(matrices):
+                rowShifts, rowAngles = geometryFromMatrix(matrix, inverse)
+                self.assertTrue(np.allclose(batchShifts[i], rowShifts))
+                self.assertTrue(np.allclose(batchAngles[i], rowAngles))
+            self.assertTrue(np.allclose(batchShifts, shifts))
+
+    def testPrecomputedMatrices(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            csFile = os.path.join(tmpDir, 'particles.cs')
+            createParticlesCs(csFile, numParticles=5)
+            rows = list(iterCsRows(csFile, batchSize=2))
+            batchRows = list(iterCsRows(csFile, batchSize=2,
+                                        alignType=ALIGN_PROJ))
+        for row, batchRow in zip(rows, batchRows):
+            self.assertFalse(row.hasColumn(ALIGNMENT_MATRIX_LABEL))
+            self.assertTrue(batchRow.hasColumn(ALIGNMENT_MATRIX_LABEL))
+            expected = rowToAlignment(row, ALIGN_PROJ, pixelSize=1.5)
+            alignment = rowToAlignment(batchRow, ALIGN_PROJ, pixelSize=1.5)
+            self.assertTrue(np.allclose(alignment.getMatrix(),
+                                        expected.getMatrix()))
+
+
+class TestParticlesStar(unittest.TestCase):
+    """ Columnar conversion of a set of particles """
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        partSet = SetOfParticles(filename=os.path.join(self.tmpDir.name,
+                                                       'parts.sqlite'))
+        partSet.setSamplingRate(1.5)
+        acquisition = Acquisition(magnification=50000, voltage=300,
+                                  sphericalAberration=2.7,
+                                  amplitudeContrast=0.1)
+        partSet.setAcquisition(acquisition)
+        partSet.setAlignmentProj()
+        for i in range(5):
+            part = Particle(location=(i + 1, 'particles.mrcs'))
+            part.setAcquisition(acquisition)
+            part.setCTF(CTFModel(defocusU=10000 + i, defocusV=9000,
+                                 defocusAngle=30))
+            coord = Coordinate()
+            coord.setPosition(10 * i, 20)
+            coord.setMicId(3)
+            part.setCoordinate(coord)
+            part.setTransform(Transform(matrixFromGeometry(
+                np.array([1., -2., 0.]), np.array([10. * i, 20., 30.]), True)))
+            partSet.append(part)
+        partSet.write()
+        self.partSet = partSet
+        self.kwargs = {'fillMagnification': True, 'fillRandomSubset': True,
+                       'postprocessImageRow': addRandomSubset}
+
+    def tearDown(self):
+        self.partSet.close()
+        self.tmpDir.cleanup()
+
+    def testWriteParticles(self):
+        """ The columnar writer produces the same STAR as the MetaData one """
+        starFile = os.path.join(self.tmpDir.name, 'particles.star')
+        writeParticlesStar(self.partSet, starFile, **self.kwargs)
+
+        mdStarFile = os.path.join(self.tmpDir.name, 'particles_md.star')
+        partMd = md.MetaData()
+        setOfImagesToMd(self.partSet, partMd, particleToRow, **self.kwargs)
+        partMd.fillConstant(md.RLN_CTF_MAGNIFICATION, 50000)
+        partMd.fillConstant(md.RLN_CTF_DETECTOR_PIXEL_SIZE, 7.5)
+        partMd.write('particles@%s' % mdStarFile)
+
+        table = emtable.Table(fileName=starFile, tableName='particles')
+        mdTable = emtable.Table(fileName=mdStarFile, tableName='particles')
+        self.assertEqual(sorted(table.getColumnNames()),
+                         sorted(mdTable.getColumnNames()))
+        self.assertEqual(table.size(), 5)
+        for row, mdRow in zip(table, mdTable):
+            for label in mdTable.getColumnNames():
+                value, mdValue = row.get(label), mdRow.get(label)
+                if isinstance(mdValue, float):
+                    self.assertAlmostEqual(value, mdValue, 5)
+                else:
+                    self.assertEqual(value, mdValue)
+
+    def testCsFields(self):
+        """ The particle dataset fields are read back as the same columns """
+        batches = list(iterParticleColumns(self.partSet, batchSize=2,
+                                           **self.kwargs))
+        self.assertEqual([len(batch[RELIONCOLUMNS.rlnImageId.value])
+                          for batch in batches], [2, 2, 1])
+        columns = batches[0]
+        fields = relionColumnsToCs(columns, 1.5, 64, ALIGN_PROJ)
+        self.assertEqual(getCsSlots(fields), ['blob', 'ctf', 'alignments3D'])
+        self.assertEqual(list(fields['blob/idx']), [0, 1])
+        self.assertEqual(list(fields['alignments3D/split']), [1, 0])
+
+        cs = np.zeros(2, dtype=[(field, values.dtype, values.shape[1:])
+                                for field, values in fields.items()])
+        for field, values in fields.items():
+            cs[field] = values
+        relionColumns = csToRelionColumns(cs)
+        self.assertEqual(list(relionColumns[RELIONCOLUMNS.rlnImageName.value]),
+                         columns[RELIONCOLUMNS.rlnImageName.value])
+        for label in [RELIONCOLUMNS.rlnAngleRot.value,
+                      RELIONCOLUMNS.rlnAngleTilt.value,
+                      RELIONCOLUMNS.rlnAnglePsi.value,
+                      RELIONCOLUMNS.rlnDefocusAngle.value]:
+            self.assertTrue(np.allclose(relionColumns[label], columns[label]))
+        self.assertTrue(np.allclose(
+            relionColumns[RELIONCOLUMNS.rlnOriginXAngst.value],
+            np.array(columns[RELIONCOLUMNS.rlnOriginX.value]) * 1.5))
+
+class TestFsc(unittest.TestCase):
+    """ FSC curves of cryoSPARC fsc.txt files """
+
+    def testReadFsc(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fscFile = os.path.join(tmpDir, 'fsc.txt')
+            with open(fscFile, 'w') as f:
+                f.write('wave_number\tfsc_nomask\tfsc_tightmask\tfsc_noisesub_true\n')
+                f.write('0.0\t1.0\t1.0\t1.0\n')
+                f.write('1.0\t0.9\t0.8\t0.5\n')
+                f.write('2.0\t0.2\t0.1\t0.0\n')
+            table = readCryosparcFsc(fscFile)
+            self.assertEqual(list(table), ['wave_number', 'fsc_nomask', 'fsc_tightmask',
+                                           'fsc_noisesub_true', 'fsc_prmm'])
+            self.assertTrue(np.allclose(table['fsc_nomask'], [1.0, 0.9, 0.2]))
+            self.assertTrue(np.allclose(table['fsc_prmm'], [0, 0.6, 0.1]))
+
+            # The cached table is used while the file does not change
+            self.assertTrue(os.path.exists(os.path.join(tmpDir, 'fsc_curves.npz')))
+            with patch('numpy.loadtxt', side_effect=AssertionError):
+                cached = readCryosparcFsc(fscFile)
+            self.assertEqual(list(cached), list(table))
+            self.assertTrue(all(np.array_equal(cached[c], table[c]) for c in table))
+
+            with open(fscFile, 'a') as f:
+                f.write('3.0\t0.0\t0.0\t0.0\n')
+            self.assertEqual(len(readCryosparcFsc(fscFile)['wave_number']), 4)
+
+
+class TestCs2StarWorker(unittest.TestCase):
+    """ A single cs2star process serves all the conversion requests """
+
+    def setUp(self):
+        # Run the worker with the current environment
+        self.patches = [patch.object(Plugin, 'getCondaActivationCmd', return_value=''),
+                        patch.object(Plugin, 'getPyemEnvActivation', return_value='true')]
+        for p in self.patches:
+            p.start()
+        self.worker = Cs2StarWorker()
+
+    def tearDown(self):
+        self.worker.close()
+        for p in self.patches:
+            p.stop()
+
+    def testRequests(self):
+        missing = [('missing_%d.cs' % i, 'missing_%d.star' % i) for i in range(3)]
+        self.assertEqual(self.worker.convert(missing), [1, 1, 1])
+        pid = self.worker._process.pid
+        self.assertEqual(self.worker.convert(missing[:1]), [1])
+        self.assertEqual(self.worker._process.pid, pid)
+
+        # A dead worker is replaced by a new one
+        self.worker._process.kill()
+        self.worker._process.wait()
+        self.assertEqual(self.worker.convert(missing[:1]), [1])
+        self.assertNotEqual(self.worker._process.pid, pid)
+
+
+class TestCs2StarPool(unittest.TestCase):
+    """ The conversions are spread over a bounded number of workers """
+
+    def setUp(self):
+        self.patches = [patch.object(Plugin, 'getCondaActivationCmd', return_value=''),
+                        patch.object(Plugin, 'getPyemEnvActivation', return_value='true')]
+        for p in self.patches:
+            p.start()
+        self.pool = Cs2StarPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+        for p in self.patches:
+            p.stop()
+
+    def testConvert(self):
+        missing = [('missing_%d.cs' % i, 'missing_%d.star' % i) for i in range(5)]
+        converted = []
+        results = self.pool.convert(missing,
+                                    progress=lambda done, total, files:
+                                    converted.append((done, total, files)))
+        self.assertEqual(results, [1] * 5)
+        self.assertLessEqual(len(self.pool._workers), 2)
+        self.assertEqual([c[0] for c in converted], [1, 2, 3, 4, 5])
+        self.assertEqual(sorted(c[2] for c in converted), missing)
+        self.assertEqual(self.pool.convert([]), [])
+
+
+class TestCs2StarCache(unittest.TestCase):
+    """ Converted files are reused while the .cs file does not change """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = Cs2StarCache(os.path.join(self.tmpDir, 'cache'), 100)
+
+    def _writeFile(self, fileName, content):
+        fileName = os.path.join(self.tmpDir, fileName)
+        with open(fileName, 'w') as f:
+            f.write(content)
+        return fileName
+
+    def testGetSet(self):
+        csFile = self._writeFile('particles.cs', 'cs content')
+        starFile = self._writeFile('particles.star', 'star content')
+        outputFn = os.path.join(self.tmpDir, 'output.star')
+        key = self.cache.getKey(csFile)
+        self.assertFalse(self.cache.get(key, outputFn))
+
+        self.cache.set(key, starFile)
+        self.assertTrue(self.cache.get(key, outputFn))
+        with open(outputFn) as f:
+            self.assertEqual(f.read(), 'star content')
+
+        # A different content is a different entry
+        self._writeFile('particles.cs', 'new cs content')
+        self.assertNotEqual(self.cache.getKey(csFile), key)
+
+    def testEviction(self):
+        starFile = self._writeFile('particles.star', 'x' * 40)
+        outputFn = os.path.join(self.tmpDir, 'output.star')
+        for i, key in enumerate(['a', 'b']):
+            self.cache.set(key, starFile)
+            os.utime(self.cache._getEntry(key), (i, i))
+        self.assertTrue(self.cache.get('a', outputFn))  # 'a' is used last
+        self.cache.set('c', starFile)
+        self.assertTrue(self.cache.get('a', outputFn))
+        self.assertFalse(self.cache.get('b', outputFn))
+        self.assertTrue(self.cache.get('c', outputFn))
+
+    def testPool(self):
+        csFile = self._writeFile('particles.cs', 'cs content')
+        starFile = self._writeFile('particles.star', 'star content')
+        outputFn = os.path.join(self.tmpDir, 'output.star')
+        self.cache.set(self.cache.getKey(csFile), starFile)
+
+        pool = Cs2StarPool(2, cache=self.cache)
+        self.assertEqual(pool.convert([(csFile, outputFn)]), [0])
+        self.assertEqual(pool._workers, [])  # no conversion was needed
+        self.assertTrue(os.path.exists(outputFn))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,21 @@
 import getpass
+import json
+import os
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
 
 from cryosparc2 import V_UNKNOWN, V3_0_0
 from cryosparc2.utils import (cryosparcValidate, cryosparcExists,
                               isCryosparcRunning, calculateNewSamplingRate,
-                              getProjectName, getCryosparcVersion)
+                              getProjectName, getCryosparcVersion,
+                              callCryosparc, createProjectContainerDir,
+                              createEmptyProject, createEmptyWorkSpace,
+                              enqueueJob, waitForCryosparc, getJobStatus,
+                              getJobStreamlog, getCryosparcEnvInformation,
+                              getCryosparcProjectsList, copyFiles)
+from cryosparc2.tests.fake_master import FakeCryosparcMaster
 
 import cryosparc2.utils as csutils
 
@@ -96,6 +106,99 @@ class TestUtils(unittest.TestCase):
         sr = calculateNewSamplingRate((3, 3, 3), 1.5, (4, 4, 4))
         self.assertEqual(sr, 2, "Wrong sampling rate conversion 3")
 
+    def testCopyFiles(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            src = os.path.join(tmpDir, 'J1')
+            os.makedirs(os.path.join(src, 'stacks'))
+            for fileName in ['J1_particles.cs', 'stacks/particles.mrcs',
+                             'events.bson']:
+                with open(os.path.join(src, fileName), 'w') as f:
+                    f.write(fileName)
+
+            dst = os.path.join(tmpDir, 'extra', 'J1')
+            copyFiles(src, dst, include=['*.cs', 'stacks/*'])
+            self.assertEqual(sorted(os.listdir(dst)), ['J1_particles.cs', 'stacks'])
+            # Same filesystem: the files are hardlinks, not copies
+            self.assertTrue(os.path.samefile(os.path.join(src, 'stacks/particles.mrcs'),
+                                             os.path.join(dst, 'stacks/particles.mrcs')))
+
+            # A linked file is copied before it is modified
+            dstFile = os.path.join(dst, 'J1_particles.cs')
+            csutils.unshareFile(dstFile)
+            self.assertFalse(os.path.samefile(os.path.join(src, 'J1_particles.cs'), dstFile))
+
+            dst = os.path.join(tmpDir, 'copy')
+            copyFiles(src, dst, files=['events.bson'], mode='symlink')
+            self.assertTrue(os.path.islink(os.path.join(dst, 'events.bson')))
+            copyFiles(src, dst, files=['events.bson'], mode='copy')
+            self.assertFalse(os.path.islink(os.path.join(dst, 'events.bson')))
+
+            # Reflinks depend on the filesystem, auto mode uses a hardlink here
+            srcFile = os.path.join(src, 'events.bson')
+            self.assertEqual(csutils.placeFile(srcFile, os.path.join(dst, 'f')),
+                             'hardlink')
+            for mode in ['hardlink', 'symlink', 'copy']:
+                self.assertEqual(csutils.placeFile(srcFile, os.path.join(dst, 'f'),
+                                                   mode), mode)
+
+    def testResumeCopy(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            src, dst = os.path.join(tmpDir, 'J1'), os.path.join(tmpDir, 'extra')
+            os.makedirs(src)
+            files = ['particles_%d.mrcs' % i for i in range(3)]
+            for i, fileName in enumerate(files):
+                with open(os.path.join(src, fileName), 'wb') as f:
+                    f.write(os.urandom(1000 * (i + 1)))
+
+            # Without copy_file_range the data is copied with sendfile
+            with patch('os.copy_file_range', side_effect=OSError, create=True):
+                self.assertEqual(copyFiles(src, dst, mode='copy'), [])
+            for fileName in files:
+                with open(os.path.join(src, fileName), 'rb') as f1, \
+                        open(os.path.join(dst, fileName), 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+            with open(os.path.join(dst, '.scipion_copy_manifest.jsonl')) as f:
+                self.assertEqual(sorted(json.loads(line)['file'] for line in f), files)
+
+            # Only the missing and the modified files are copied again
+            os.remove(os.path.join(dst, files[0]))
+            os.utime(os.path.join(src, files[1]), ns=(0, 0))
+            self.assertEqual(copyFiles(src, dst, mode='copy'), [])
+            with open(os.path.join(dst, '.scipion_copy_manifest.jsonl')) as f:
+                copied = [json.loads(line)['file'] for line in f][3:]
+            self.assertEqual(sorted(copied), files[:2])
+
+            # A corrupted copy is removed and reported
+            with open(os.path.join(dst, files[2]), 'ab') as f:
+                f.write(b'x')
+            with self.assertRaises(Exception):
+                csutils.verifyCopy(os.path.join(src, files[2]), os.path.join(dst, files[2]))
+            self.assertFalse(os.path.exists(os.path.join(dst, files[2])))
+            self.assertEqual(copyFiles(src, dst, files=['missing.mrcs'], mode='copy'),
+                             ['missing.mrcs'])
+
+    def testLazyOutputs(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            jobs = [os.path.join(tmpDir, job) for job in ['J1', 'J2']]
+            extra = os.path.join(tmpDir, 'extra')
+            for job in jobs:
+                os.makedirs(job)
+                with open(os.path.join(job, 'map.mrc'), 'w') as f:
+                    f.write(job)
+            with patch.dict(os.environ, {'CRYOSPARC_LAZY_OUTPUTS': 'True'}):
+                for job in jobs:
+                    copyFiles(job, os.path.join(extra, os.path.basename(job)))
+            links = [os.path.join(extra, job, 'map.mrc') for job in ['J1', 'J2']]
+            self.assertTrue(all(os.path.islink(link) for link in links))
+
+            # Only the files of the cleared job are materialized
+            self.assertEqual(csutils.materializeFiles(extra, jobs[0]), [])
+            self.assertFalse(os.path.islink(links[0]))
+            self.assertTrue(os.path.islink(links[1]))
+            with open(links[0]) as f:
+                self.assertEqual(f.read(), jobs[0])
+            self.assertEqual(os.listdir(os.path.dirname(links[0])), ['map.mrc'])
+
     def testGetVersion(self):
 
         VERSION_FROM_FILE = "1.2.3"
@@ -151,6 +254,288 @@ class TestUtils(unittest.TestCase):
                 getFromFile.assert_called_once()
                 getEnvInfo.assert_called_once()
 
+    def testCallCryosparc(self):
+
+        with patch('cryosparc2.utils.getCommandClient') as getClient:
+            # Command client available: no process is launched
+            getClient.return_value.call.return_value = "completed"
+            with patch('cryosparc2.utils.runCmd') as runCmd:
+                status = callCryosparc('get_job_status', 'P1', 'J1')
+                self.assertEqual(status, "completed")
+                getClient.return_value.call.assert_called_once_with('get_job_status', 'P1', 'J1')
+                runCmd.assert_not_called()
+
+            # Command client not available: fallback to cryosparcm cli
+            getClient.return_value = None
+            with patch('cryosparc2.utils.getCryosparcProgram') as getProg:
+                getProg.return_value = "cryosparcm cli"
+                with patch('cryosparc2.utils.runCmd') as runCmd:
+                    runCmd.return_value = (0, "{'_id': 'abc'}")
+                    user = callCryosparc('GetUser', 'user@mail.com')
+                    self.assertEqual(user, {'_id': 'abc'})
+                    runCmd.assert_called_once_with(
+                        "cryosparcm cli 'GetUser(\"user@mail.com\")'", printCmd=False)
+
+                    runCmd.return_value = (0, "J12")
+                    jobId = callCryosparc('make_job', 'homo_refine', 'P1',
+                                          {"param": "1"}, False, 0)
+                    self.assertEqual(jobId, "J12")
+                    self.assertEqual(runCmd.call_args[0][0],
+                                     "cryosparcm cli 'make_job(\"homo_refine\", \"P1\", "
+                                     "{\"param\": \"1\"}, False, 0)'")
+
+
+class TestFakeMaster(unittest.TestCase):
+    """ Run the cryoSPARC helpers against a local fake master """
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        root = self.tmpDir.name
+        recordDir = os.path.join(root, 'records', 'homo_refine_new')
+        os.makedirs(os.path.join(recordDir, 'outputs'))
+        with open(os.path.join(recordDir, 'outputs', '{job}_particles.cs'), 'w') as f:
+            f.write('particles')
+        os.makedirs(os.path.join(recordDir, 'files'))
+        with open(os.path.join(recordDir, 'files', 'b'), 'w') as f:
+            f.write('wave_number\tfsc_nomask\n0.0\t1.0\n')
+        with open(os.path.join(recordDir, 'streamlog.json'), 'w') as f:
+            json.dump([{'type': 'text', 'text': 'Starting {job}'},
+                       {'type': 'text', 'text': 'Done'}], f)
+
+        self.master = FakeCryosparcMaster(os.path.join(root, 'cs'),
+                                          os.path.join(root, 'records'),
+                                          failJobTypes=['nu_refine']).start()
+        self.csDirPatch = patch('cryosparc2.utils.getCryosparcDir',
+                                lambda *paths: os.path.join(self.master.rootDir, *paths))
+        self.csDirPatch.start()
+        csutils.invalidateMetadataCache()
+        csutils._commandClient = None
+        csutils._jobFileClient = None
+
+    def tearDown(self):
+        self.csDirPatch.stop()
+        self.master.stop()
+        csutils.invalidateMetadataCache()
+        csutils._commandClient = None
+        csutils._jobFileClient = None
+        self.tmpDir.cleanup()
+
+    def _createProject(self):
+        projectPath = os.path.join(self.tmpDir.name, 'projects', 'test')
+        createProjectContainerDir(projectPath)
+        projectName = createEmptyProject(projectPath, 'test')
+        workSpaceName = createEmptyWorkSpace(projectName, 'run', '')
+        return projectName, workSpaceName
+
+    def testJobLifecycle(self):
+        projectName, workSpaceName = self._createProject()
+        self.assertEqual((projectName, workSpaceName), ('P1', 'W1'))
+
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{"refine_symmetry": "C1"}',
+                           '{"particles": "J0.imported_particles"}',
+                           'default', [0])
+        status = waitForCryosparc(projectName, jobId.get(), "Refinement failed")
+        self.assertEqual(status, 'completed')
+
+        projectDir = self.master.projects[projectName]['project_dir']
+        self.assertTrue(os.path.exists(os.path.join(projectDir, 'J1', 'J1_particles.cs')))
+        events = getJobStreamlog(projectName, jobId.get())
+        self.assertEqual(events[0]['text'], 'Starting J1')
+
+        failedJob = enqueueJob('nu_refine', projectName, workSpaceName, '{}',
+                               '{}', 'default')
+        with self.assertRaises(Exception):
+            waitForCryosparc(projectName, failedJob.get(), "Refinement failed")
+
+    def testMetadataCache(self):
+        for _ in range(3):
+            self.assertEqual(getCryosparcEnvInformation('master_hostname'), 'localhost')
+        self.assertEqual(self.master.calls.count('get_system_info'), 1)
+
+        csutils.invalidateMetadataCache('system_info')
+        getCryosparcEnvInformation('master_hostname')
+        self.assertEqual(self.master.calls.count('get_system_info'), 2)
+
+        # Creating a project invalidates the projects listing
+        self.assertEqual(len(getCryosparcProjectsList()), 0)
+        self._createProject()
+        self.assertEqual(len(getCryosparcProjectsList()), 1)
+        self.assertEqual(self.master.calls.count('list_projects'), 2)
+
+        # Both enqueued jobs reuse the cached user id and master hostname
+        projectName, workSpaceName = 'P1', 'W1'
+        for _ in range(2):
+            enqueueJob('homo_refine_new', projectName, workSpaceName, '{}',
+                       '{}', 'default')
+        self.assertEqual(self.master.calls.count('GetUser'), 1)
+        self.assertEqual(self.master.calls.count('get_system_info'), 2)
+
+    def testWaitForCryosparc(self):
+        self.master.jobDuration = 0.5
+        projectName, workSpaceName = self._createProject()
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{}', '{}', 'default')
+        start = time.time()
+        waitForCryosparc(projectName, jobId.get(), "Refinement failed")
+        self.assertLess(time.time() - start, 1.5)
+
+        # Transient errors are retried after a short delay
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{}', '{}', 'default')
+        waitJob = csutils.waitJob
+        failures = [Exception("Master restarting")] * 3
+        def flakyWaitJob(*args):
+            if failures:
+                raise failures.pop()
+            return waitJob(*args)
+
+        with patch('cryosparc2.utils.waitJob', side_effect=flakyWaitJob):
+            with patch('cryosparc2.utils.time.sleep') as sleep:
+                waitForCryosparc(projectName, jobId.get(), "Refinement failed")
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        self.assertLessEqual(max(delays), 4)
+
+    def testWaitForJobs(self):
+        self.master.jobDuration = 0.5
+        projectName, workSpaceName = self._createProject()
+        jobs = [(enqueueJob(jobType, projectName, workSpaceName, '{}', '{}',
+                            'default').get(), "%s failed" % jobType)
+                for jobType in ['homo_refine_new', 'nu_refine', 'homo_refine_new']]
+        start = time.time()
+        with self.assertRaises(Exception) as context:
+            csutils.waitForCryosparcJobs(projectName, jobs)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(str(context.exception), "J2: nu_refine failed")
+        self.assertEqual(csutils.getJobStatus(projectName, 'J3'), 'completed')
+
+    def testImportCache(self):
+        projectName, workSpaceName = self._createProject()
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{}', '{}', 'default')
+        waitForCryosparc(projectName, jobId.get(), "Refinement failed")
+
+        volFile = os.path.join(self.tmpDir.name, 'volume.mrc')
+        with open(volFile, 'wb') as f:
+            f.write(b'map')
+        key = csutils.getFileFingerprint(volFile, 'map', 1.5)
+        self.assertNotEqual(key, csutils.getFileFingerprint(volFile, 'mask', 1.5))
+
+        protocolDir = os.path.join(self.tmpDir.name, 'Runs', '000002_Prot')
+        os.makedirs(protocolDir)
+        importCache = csutils.ImportCache(os.path.join(self.tmpDir.name,
+                                                       'import_cache.json'))
+        self.assertIsNone(importCache.get(projectName, key))
+        importCache.set(key, jobId.get(), files=[protocolDir])
+        self.assertEqual(importCache.get(projectName, key), jobId.get())
+
+        # Changed content or a deleted importing protocol are not reused
+        with open(volFile, 'wb') as f:
+            f.write(b'new map')
+        self.assertIsNone(importCache.get(
+            projectName, csutils.getFileFingerprint(volFile, 'map', 1.5)))
+        os.rmdir(protocolDir)
+        self.assertIsNone(importCache.get(projectName, key))
+
+    def testStreamlogTail(self):
+        projectName, workSpaceName = self._createProject()
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{}', '{}', 'default')
+        waitForCryosparc(projectName, jobId.get(), "Refinement failed")
+
+        events = getJobStreamlog(projectName, jobId.get(), fromIndex=1)
+        self.assertEqual([event['text'] for event in events], ['Done'])
+        self.assertEqual(getJobStreamlog(projectName, jobId.get(), fromIndex=2), [])
+        self.assertEqual(self.master.calls.count('system.describe'), 1)
+
+        class Protocol:
+            logLine = 0
+            logText = None
+            def getLogLine(self): return self.logLine
+            def setLogLine(self, line): self.logLine = line
+            def getLogLastText(self): return self.logText
+            def setLogLastText(self, text): self.logText = text
+
+        protocol = Protocol()
+        with self.assertLogs('cryosparc2.utils', level='INFO') as logs:
+            csutils._printJobStreamlog(projectName, jobId.get(), protocol)
+            csutils._printJobStreamlog(projectName, jobId.get(), protocol)
+        self.assertEqual(protocol.logLine, 2)
+        self.assertEqual([record.getMessage() for record in logs.records],
+                         ['Starting J1', 'Done', 'Done'])
+
+        # Masters without the offset parameter are sliced on the client side
+        with patch('cryosparc2.utils._getStreamlogOffsetParams', return_value=None):
+            events = getJobStreamlog(projectName, jobId.get(), fromIndex=1)
+        self.assertEqual([event['text'] for event in events], ['Done'])
+
+    def testStreamlogIndex(self):
+        projectName, workSpaceName = self._createProject()
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{}', '{}', 'default')
+        waitForCryosparc(projectName, jobId.get(), "Refinement failed")
+        indexFile = os.path.join(self.tmpDir.name, 'streamlog.json')
+
+        index = csutils.getStreamlogIndex(projectName, jobId.get(), indexFile)
+        self.assertEqual(index.numEvents, 2)
+        index.addEvent({'type': 'text', 'text': 'FSC Iteration 012, limit',
+                        'imgfiles': [{'fileid': 'a', 'filename': 'fsc.png',
+                                      'filetype': 'png'},
+                                     {'fileid': 'b', 'filename': 'fsc.txt',
+                                      'filetype': 'txt'}]})
+        index.addEvent({'type': 'text', 'text': 'Using Filter Radius 20.3 (3.1A)'})
+        index.addEvent({'type': 'text', 'text': 'Estimated Bfactor: -85.2\n'})
+        index.addEvent({'type': 'text', 'text': 'Done iteration 7 in 2s'})
+        index.save()
+
+        index = csutils.StreamlogIndex(indexFile)
+        self.assertEqual((index.lastFscFileId, index.lastIteration), ('b', '012'))
+        self.assertEqual(index.fscFileIds, {'012': 'b'})
+        self.assertEqual(index.fileIds['fsc.png'], 'a')
+        self.assertEqual(index.mapResolution, '3.1Å')
+        self.assertEqual(index.estBFactor, ' -85.2')
+        self.assertEqual(index.doneIteration, '7')
+        self.assertEqual(index.numEvents, 6)
+
+    def testDownloadJobFile(self):
+        fscFile = os.path.join(self.tmpDir.name, 'fsc.txt')
+        self.assertEqual(csutils.downloadJobFile('b', fscFile), fscFile)
+        with open(fscFile) as f:
+            self.assertEqual(f.read(), 'wave_number\tfsc_nomask\n0.0\t1.0\n')
+
+        # A downloaded file id is not requested again
+        client = csutils.getJobFileClient()
+        with patch.object(client._session, 'post') as post:
+            otherFile = os.path.join(self.tmpDir.name, 'extra', 'fsc.txt')
+            client.download('b', otherFile)
+            post.assert_not_called()
+        self.assertTrue(os.path.exists(otherFile))
+
+        # Connection errors are retried, missing files are not
+        oldClient = csutils.JobFileClient('localhost', self.master.port,
+                                          useFileEndpoint=True)
+        get = oldClient._session.get
+        with patch('cryosparc2.utils.DOWNLOAD_RETRY_DELAY', 0), \
+                patch.object(oldClient._session, 'get',
+                             side_effect=[csutils.requests.ConnectionError(), get]) as getMock:
+            getMock.side_effect = [csutils.requests.ConnectionError(),
+                                   lambda *args, **kwargs: get(*args, **kwargs)]
+            oldClient.download('b', os.path.join(self.tmpDir.name, 'old.txt'))
+        self.assertEqual(getMock.call_count, 2)
+        with self.assertRaises(csutils.requests.HTTPError):
+            oldClient.download('missing', os.path.join(self.tmpDir.name, 'missing.txt'))
+        self.assertEqual(oldClient.downloadFiles([('b', os.path.join(self.tmpDir.name, 'c.txt'))]),
+                         [os.path.join(self.tmpDir.name, 'c.txt')])
+
+    def testCliFallback(self):
+        projectName, workSpaceName = self._createProject()
+        jobId = enqueueJob('homo_refine_new', projectName, workSpaceName,
+                           '{}', '{}', 'default')
+        with patch('cryosparc2.utils.getCommandClient') as getClient:
+            getClient.return_value = None
+            self.assertEqual(getJobStatus(projectName, jobId.get()), 'completed')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -25,12 +25,20 @@
 # *
 # **************************************************************************
 import ast
+import fnmatch
 import getpass
+import hashlib
+import itertools
+import json
 import logging
 import os
+import random
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import requests
 from pkg_resources import parse_version
 
 import pyworkflow.utils as pwutils
@@ -59,6 +67,32 @@ ACTIVE_STATUSES = [STATUS_QUEUED, STATUS_RUNNING, STATUS_STARTED,
 
 # Module variables
 _csVersion = None  # Lazy variable: never use it directly. Use getCryosparcVersion instead
+_commandClient = None  # Lazy variable: never use it directly. Use getCommandClient instead
+_commandClientLock = threading.Lock()
+_jobFileClient = None  # Lazy variable: never use it directly. Use getJobFileClient instead
+
+# Time to live (seconds) of the cached cryoSPARC metadata
+CACHE_TTL_SYSTEM_INFO = 600
+CACHE_TTL_USERS = 3600
+CACHE_TTL_CONFIG = 3600
+CACHE_TTL_LANES = 300
+CACHE_TTL_PROJECTS = 60
+
+# Job waiting: seconds the master blocks in wait_job_complete and bounds of
+# the delays between retries when cryoSPARC can not be reached
+WAIT_JOB_TIMEOUT = 5
+RETRY_MIN_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+# Job file downloads: attempts, first delay between them (doubled on each
+# retry), request timeout (seconds) and size of the blocks written to disk
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_RETRY_DELAY = 1
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Names under which get_job_streamlog may accept the index of the first event
+STREAMLOG_OFFSET_PARAMS = ['offset', 'fromidx', 'from_idx', 'start_idx']
 
 # logging variable
 logger = logging.getLogger(__name__)
@@ -85,6 +119,211 @@ class NestedDict:
         return current
 
 
+class MetadataCache:
+    """ Process-wide cache of cryoSPARC metadata (system info, users, lanes,
+    projects...). Every entry expires after its own time to live and can be
+    explicitly invalidated. Cached values are shared: do not modify them.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, ttl):
+        """ Return the value cached for key, calling compute() to get it
+        when it is missing or expired """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        value = compute()
+        with self._lock:
+            self._entries[key] = (now + ttl, value)
+        return value
+
+    def invalidate(self, *names):
+        """ Remove the entries whose key starts with any of the given names.
+        If no name is given the whole cache is cleared """
+        with self._lock:
+            if not names:
+                self._entries.clear()
+            else:
+                for key in list(self._entries):
+                    if key[0] in names:
+                        del self._entries[key]
+
+
+_metadataCache = MetadataCache()
+
+
+def invalidateMetadataCache(*names):
+    """ Invalidate the cached cryoSPARC metadata, e.g.
+    invalidateMetadataCache('system_info', 'lanes'). If no name is given
+    everything is invalidated, including the cryoSPARC version """
+    global _csVersion
+    if not names:
+        _csVersion = None
+    _metadataCache.invalidate(*names)
+
+
+class CommandCoreClient:
+    """ Keep-alive JSON-RPC client to the cryoSPARC command_core server.
+    A single pooled HTTP session is reused by every call, so querying
+    cryoSPARC does not pay a `cryosparcm cli` process launch each time.
+    """
+    def __init__(self, host, port, licenseId=None, timeout=300, poolSize=10):
+        self.url = "http://%s:%s/api" % (host, port)
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=poolSize)
+        self._session.mount('http://', adapter)
+        if licenseId:
+            self._session.headers.update({'License-ID': licenseId})
+
+    def call(self, method, *args, **kwargs):
+        """ Call a command_core function and return its result
+        :param method: name of the cryoSPARC function, e.g. get_job_status
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function (can not be
+                       combined with positional arguments)
+        :raises requests.ConnectionError if the server can not be reached
+        :raises Exception if the server reports an error
+        """
+        payload = {'jsonrpc': '2.0', 'method': method,
+                   'params': kwargs if kwargs else list(args),
+                   'id': next(self._ids)}
+        response = self._session.post(self.url, json=payload,
+                                      timeout=self.timeout)
+        response.raise_for_status()
+        content = response.json()
+        if content.get('error') is not None:
+            error = content['error']
+            message = error.get('message', error) if isinstance(error, dict) else error
+            raise Exception("%s failed --> %s" % (method, message))
+        return content.get('result')
+
+    def close(self):
+        self._session.close()
+
+
+class JobFileClient:
+    """ Keep-alive HTTP client that downloads the files of the cryoSPARC jobs
+    (FSC curves, plots...) from get_job_file, or /file/<fileid> in versions
+    older than 4.1. Files are streamed to disk and retried with backoff, and
+    every file id is downloaded only once (file ids never change).
+    """
+    def __init__(self, host, port, licenseId=None, useFileEndpoint=False,
+                 timeout=DOWNLOAD_TIMEOUT, poolSize=10):
+        self.url = "http://%s:%s" % (host, port)
+        self.useFileEndpoint = useFileEndpoint
+        self.timeout = timeout
+        self.poolSize = poolSize
+        self._files = {}
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=poolSize)
+        self._session.mount('http://', adapter)
+        if licenseId:
+            self._session.headers.update({'License-ID': licenseId})
+
+    def download(self, fileId, fileName):
+        """ Download the job file fileId into fileName
+        :returns fileName
+        """
+        fileName = os.path.abspath(fileName)
+        with self._lock:
+            cachedFile = self._files.get(fileId)
+        if cachedFile is not None and os.path.exists(cachedFile):
+            if cachedFile != fileName:
+                placeFile(cachedFile, fileName, COPY_MODE_COPY)
+            return fileName
+
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                self._download(fileId, fileName)
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, IOError) as e:
+                if attempt == DOWNLOAD_RETRIES - 1:
+                    raise
+                delay = DOWNLOAD_RETRY_DELAY * 2 ** attempt
+                logger.debug("Downloading the job file %s failed, retrying "
+                             "in %ss: %s" % (fileId, delay, e))
+                time.sleep(delay)
+        with self._lock:
+            self._files[fileId] = fileName
+        return fileName
+
+    def _download(self, fileId, fileName):
+        if self.useFileEndpoint:
+            response = self._session.get("%s/file/%s" % (self.url, fileId),
+                                         stream=True, timeout=self.timeout)
+        else:
+            response = self._session.post("%s/get_job_file" % self.url,
+                                          json={'fileid': fileId},
+                                          stream=True, timeout=self.timeout)
+        with response:
+            if response.status_code >= 500:
+                raise IOError("Server error %d" % response.status_code)
+            response.raise_for_status()
+            tmpFile = '%s.%d.%d.tmp' % (fileName, os.getpid(),
+                                        threading.get_ident())
+            size = 0
+            try:
+                with open(tmpFile, 'wb') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+                expectedSize = response.headers.get('Content-Length')
+                if expectedSize is not None and int(expectedSize) != size:
+                    raise IOError("Incomplete download of the job file %s: "
+                                  "%d of %s bytes" % (fileId, size, expectedSize))
+                os.replace(tmpFile, fileName)
+            finally:
+                if os.path.exists(tmpFile):
+                    os.remove(tmpFile)
+
+    def downloadFiles(self, files):
+        """ Download several job files at the same time
+        :param files: list of (fileId, fileName)
+        :returns the list of file names
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(self.poolSize,
+                                                       len(files)))) as executor:
+            return list(executor.map(lambda f: self.download(*f), files))
+
+    def close(self):
+        self._session.close()
+
+
+def getJobFileClient():
+    """ Get the (shared) client that downloads the cryoSPARC job files """
+    global _jobFileClient
+    if _jobFileClient is None:
+        with _commandClientLock:
+            if _jobFileClient is None:
+                systemInfo = getSystemInfo()
+                host = systemInfo.get('master_hostname')
+                if parse_version(getCryosparcVersion()) < parse_version(V4_1_0):
+                    _jobFileClient = JobFileClient(host,
+                                                   systemInfo.get('port_webapp'),
+                                                   useFileEndpoint=True)
+                else:
+                    _jobFileClient = JobFileClient(host,
+                                                   systemInfo.get('port_command_vis'),
+                                                   _getLicenceFromFile())
+    return _jobFileClient
+
+
+def downloadJobFile(fileId, fileName):
+    """ Download the file of a cryoSPARC job (e.g. an FSC curve or a plot
+    from the job event log) into fileName """
+    return getJobFileClient().download(fileId, fileName)
+
+
 def getCryosparcDir(*paths):
     """
     Get the root directory where cryoSPARC code and dependencies are installed.
@@ -128,6 +367,14 @@ def isCryosparcRunning():
     """
     import subprocess
     status = -1
+    client = getCommandClient()
+    if client is not None:
+        try:
+            client.call('test_connection')
+            return True
+        except Exception as e:
+            logger.debug("Command client can't connect to cryoSPARC: %s" % e)
+
     if getCryosparcProgram() is not None:
         test_conection_cmd = (getCryosparcProgram() +
                               ' %stest_connection()%s ' % ("'", "'"))
@@ -196,10 +443,8 @@ def getCryosparcEnvInformation(envVar=VERSION):
     """
     Get the cryosparc environment information
     """
-    import ast
     system_info = getSystemInfo()
-    dictionary = ast.literal_eval(system_info[1])
-    envVariable = str(dictionary[envVar])
+    envVariable = str(system_info[envVar])
     return envVariable
 
 
@@ -227,15 +472,98 @@ def _getCryosparcVersionFromFile():
 
 
 def _getLicenceFromFile():
+    return _getConfigVariable(CRYOSPARC_LICENSE_ID_VARIABLE)
+
+
+def _getConfigVariable(variableName):
+    """ Read a variable from the cryoSPARC master config.sh file
+    :returns the variable value or None if it is not defined
+    """
+    return _metadataCache.get(('config', variableName),
+                              lambda: _readConfigVariable(variableName),
+                              CACHE_TTL_CONFIG)
+
+
+def _readConfigVariable(variableName):
     configFile = getCryosparcDir(CRYOSPARC_MASTER, CRYOSPARC_CONFIG_FILE)
     with open(configFile, 'r') as f:
         configContent = f.read().strip().split("\n")
         for variable in configContent:
-            if CRYOSPARC_LICENSE_ID_VARIABLE in variable:
-                return variable.split("=")[1].replace("\"", "")
+            if variableName in variable and "=" in variable:
+                return variable.split("=")[1].replace("\"", "").strip()
         return None
 
 
+def getCommandClient():
+    """ Get the (shared) command_core client. The master hostname and base
+    port are read from the cryoSPARC config file. Return None when they can
+    not be found, in that case the `cryosparcm cli` backend is used.
+    """
+    global _commandClient
+    if _commandClient is None:
+        with _commandClientLock:
+            if _commandClient is None:
+                try:
+                    host = _getConfigVariable(CRYOSPARC_MASTER_HOSTNAME_VARIABLE)
+                    basePort = _getConfigVariable(CRYOSPARC_BASE_PORT_VARIABLE)
+                    if host is None or basePort is None:
+                        return None
+                    port = int(basePort) + CRYOSPARC_COMMAND_CORE_PORT_OFFSET
+                    _commandClient = CommandCoreClient(host, port,
+                                                       _getLicenceFromFile())
+                except Exception as e:
+                    logger.debug("Couldn't create the cryoSPARC command client: %s" % e)
+                    return None
+    return _commandClient
+
+
+def _cliArgument(arg):
+    """ Format an argument the way `cryosparcm cli` expects it """
+    if isinstance(arg, str):
+        return '"%s"' % arg
+    elif isinstance(arg, (dict, list)):
+        return str(arg).replace('\'', '"')
+    return str(arg)
+
+
+def _toDict(value):
+    """ Convert the params/connections strings built by the protocols
+    into a python dictionary """
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def callCryosparc(method, *args, printCmd=False):
+    """ Call a cryoSPARC command_core function and return its result as a
+    python object. The persistent command client is used if available,
+    otherwise (or if the server can not be reached through it) the call
+    is launched with `cryosparcm cli`.
+    :parameter method: name of the cryoSPARC function, e.g. get_job_status
+    :parameter args: positional arguments of the function
+    :parameter printCmd (default False) prints the call
+    """
+    client = getCommandClient()
+    if client is not None:
+        if printCmd:
+            logger.info(pwutils.greenStr("Calling: %s%s" % (method, args)))
+        try:
+            return client.call(method, *args)
+        except requests.ConnectionError as e:
+            logger.debug("Command client failed, using cryosparcm cli: %s" % e)
+
+    cmd = (getCryosparcProgram() + " '%s(%s)'"
+           % (method, ", ".join(_cliArgument(arg) for arg in args)))
+    output = runCmd(cmd, printCmd=printCmd)[1]
+    try:
+        return ast.literal_eval(output)
+    except (ValueError, SyntaxError):
+        return output
+
+
 def getCryosparcUser(userId=True):
     """
     Get the user
@@ -254,10 +582,9 @@ def getCryosparcProjectsList():
     Get list of all projects available
     :return: all projects available in the database
     """
-    projects_list_cmd = (getCryosparcProgram() + ' %slist_projects()%s ' % ("'", "'"))
-    cmd = runCmd(projects_list_cmd, printCmd=False)[1]
-    projectList = ast.literal_eval(cmd)
-    return projectList
+    return _metadataCache.get(('projects',),
+                              lambda: callCryosparc('list_projects'),
+                              CACHE_TTL_PROJECTS)
 
 
 def getCryosparcWorkSpaces(projectId):
@@ -269,10 +596,9 @@ def getCryosparcWorkSpaces(projectId):
     :return: list of workpaces in a project or all projects if not specified
     :rtype: list
     """
-    workspace_list_cmd = (getCryosparcProgram() + ' %slist_workspaces("%s")%s ' % ("'", str(projectId), "'"))
-    cmd = runCmd(workspace_list_cmd, printCmd=False)[1]
-    workspacesList = ast.literal_eval(cmd)
-    return workspacesList
+    return _metadataCache.get(('workspaces', str(projectId)),
+                              lambda: callCryosparc('list_workspaces', str(projectId)),
+                              CACHE_TTL_PROJECTS)
 
 
 def isCryosparcStandalone():
@@ -353,12 +679,10 @@ def createEmptyProject(projectDir, projectTitle):
                             desc=None)
     """
 
-    create_empty_project_cmd = (getCryosparcProgram() +
-                                ' %screate_empty_project("%s", "%s", "%s")%s '
-                                % ("'", str(getCryosparcUser()),
-                                   str(projectDir), str(projectTitle), "'"))
-
-    return runCmd(create_empty_project_cmd, printCmd=False)
+    projectId = str(callCryosparc('create_empty_project', str(getCryosparcUser()),
+                                  str(projectDir), str(projectTitle)))
+    invalidateMetadataCache('projects')
+    return projectId
 
 
 def getProjectInformation(project_uid, info='project_dir'):
@@ -367,23 +691,12 @@ def getProjectInformation(project_uid, info='project_dir'):
     :param project_uid: the id of the project
     :return: the information related to the project that's stored in the database
     """
-    import ast
-    from cryosparc.tools import CryoSPARC
-    getProject_cmd = (getCryosparcProgram() +
-                                ' %sget_project("%s")%s '
-                                % ("'", str(project_uid), "'"))
-
-    project_info = runCmd(getProject_cmd, printCmd=False)
-    dictionary = ast.literal_eval(project_info[1])
+    dictionary = callCryosparc('get_project', str(project_uid))
     return str(dictionary[info])
 
 
 def getUserToken(email):
-    get_user_cmd = (getCryosparcProgram() +
-                                ' %sGetUser("%s")%s '
-                                % ("'", str(email),"'"))
-
-    return runCmd(get_user_cmd, printCmd=False)
+    return callCryosparc('GetUser', str(email))
 
 
 def updateProjectDirectory(project_uid, new_project_dir):
@@ -393,11 +706,9 @@ def updateProjectDirectory(project_uid, new_project_dir):
        :param project_uid: uid of the project to update
        :param new_project_dir_container: the new directory
        """
-    updateProjectDirectory_cmd = (getCryosparcProgram() +
-                      ' %supdate_project_directory("%s", "%s")%s '
-                      % ("'", str(project_uid), str(new_project_dir), "'"))
-
-    runCmd(updateProjectDirectory_cmd, printCmd=False)
+    callCryosparc('update_project_directory', str(project_uid),
+                  str(new_project_dir))
+    invalidateMetadataCache('projects')
 
 
 def getOutputPreffix(projectName):
@@ -416,10 +727,8 @@ def createProjectContainerDir(project_container_dir):
               still in the returned path (the path should be expanded every
               time it is used)
     """
-    create_project_dir_cmd = (getCryosparcProgram() +
-                              ' %scheck_or_create_project_container_dir("%s")%s '
-                              % ("'", project_container_dir, "'"))
-    return runCmd(create_project_dir_cmd, printCmd=False)
+    return str(callCryosparc('check_or_create_project_container_dir',
+                             project_container_dir))
 
 
 def createEmptyWorkSpace(projectName, workspaceTitle, workspaceComment):
@@ -429,19 +738,82 @@ def createEmptyWorkSpace(projectName, workspaceTitle, workspaceComment):
                            title=None, desc=None)
     returns the new uid of the workspace that was created
     """
-    create_work_space_cmd = (getCryosparcProgram() +
-                             ' %screate_empty_workspace("%s", "%s", "%s", "%s", "%s")%s '
-                             % ("'", projectName, str(getCryosparcUser(userId=False)),
-                                "None", str(workspaceTitle),
-                                str(workspaceComment), "'"))
-    return runCmd(create_work_space_cmd, printCmd=False)
+    workspaceId = str(callCryosparc('create_empty_workspace', str(projectName),
+                                    str(getCryosparcUser(userId=False)), "None",
+                                    str(workspaceTitle), str(workspaceComment)))
+    invalidateMetadataCache('workspaces')
+    return workspaceId
+
 
+class ImportCache:
+    """ Import jobs of a cryoSPARC project keyed by a fingerprint of the
+    imported input, so that identical inputs are imported only once. An
+    entry is reused while its job is completed and the files it depends on
+    (e.g. the directory of the protocol that imported it) still exist.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
 
-def doImportParticlesStar(protocol):
+    def _load(self):
+        try:
+            with open(self.fileName) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, projectName, key):
+        """ Return the uid of the job that imported key or None """
+        entry = self._load().get(key)
+        if entry is None:
+            return None
+        if not all(os.path.exists(fn) for fn in entry['files']):
+            return None
+        try:
+            status = getJobStatus(projectName, entry['job'])
+        except Exception as e:
+            logger.debug("Can not get the status of job %s: %s"
+                         % (entry['job'], e))
+            return None
+        return entry['job'] if status == STATUS_COMPLETED else None
+
+    def set(self, key, job, files=()):
+        entries = self._load()
+        entries[key] = {'job': str(job),
+                        'files': [os.path.abspath(fn) for fn in files]}
+        # Several protocols may be importing at the same time
+        tmpFile = '%s.%d.tmp' % (self.fileName, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmpFile, self.fileName)
+
+
+def getFileFingerprint(fileName, *params):
+    """ Return a hash of the content of fileName and the given params """
+    fileHash = hashlib.sha1(repr(params).encode())
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def getSetFingerprint(imgSet, *params):
+    """ Return a hash identifying the content of a Scipion set: its sqlite
+    file (path, size and modification time), number of items, binary files
+    and the given params """
+    values = [imgSet.getSize()] + list(params)
+    for fileName in [imgSet.getFileName()] + sorted(imgSet.getFiles()):
+        stat = os.stat(fileName)
+        values += [os.path.abspath(fileName), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def doImportParticlesStar(protocol, pendingJobs=None):
     """
     do_import_particles_star(puid, wuid, uuid, abs_star_path,
                              abs_blob_path=None, psize_A=None)
     returns the new uid of the job that was created
+    :param pendingJobs: if given, the job is added to this list (see
+           waitForCryosparcJobs) instead of waiting for it
     """
     print(pwutils.yellowStr("Importing particles..."), flush=True)
     className = "import_particles"
@@ -455,16 +827,77 @@ def doImportParticlesStar(protocol):
     import_particles = enqueueJob(className, protocol.projectName, protocol.workSpaceName,
                                   str(params).replace('\'', '"'), '{}', protocol.lane)
 
-    waitForCryosparc(protocol.projectName.get(), import_particles.get(),
-                     "An error occurred importing particles. "
-                     "Please, go to cryoSPARC software for more "
-                     "details.")
+    _waitForImport(protocol.projectName.get(), import_particles.get(),
+                   "An error occurred importing particles. "
+                   "Please, go to cryoSPARC software for more "
+                   "details.", pendingJobs)
 
     return import_particles
 
 
-def doImportVolumes(protocol, refVolumePath, refVolume, volType, msg):
+def _waitForImport(projectName, jobId, failureMessage, pendingJobs):
+    if pendingJobs is None:
+        waitForCryosparc(projectName, jobId, failureMessage)
+    else:
+        pendingJobs.append((jobId, failureMessage))
+
+
+def useCsParticleImport():
+    """ Whether the input particles are imported as a particle dataset filled
+    from the Scipion set (doImportParticlesCs) instead of a STAR file """
+    return pwutils.envVarOn(CRYOSPARC_IMPORT_PARTICLES_CS)
+
+
+def doImportParticlesCs(protocol):
     """
+    Import the input particles with an external job whose particle output is
+    filled directly from the Scipion set, so no STAR file is written nor
+    parsed by cryoSPARC. The output has the same name as the one of the
+    import_particles job
+    returns the uid of the external job
+    """
+    from pyworkflow.object import String
+    from .convert import convertBinaryFiles, iterParticleColumns, relionColumnsToCs, getCsSlots
+
+    print(pwutils.yellowStr("Importing particles..."), flush=True)
+    imgSet = protocol._getInputParticles()
+    filesDict = convertBinaryFiles(imgSet, protocol._getPath())
+    # cryoSPARC resolves the blob paths from the project directory
+    filesDict = {fn: os.path.abspath(filesDict.get(fn, fn))
+                 for fn in imgSet.getFiles()}
+    alignType = imgSet.getAlignment()
+
+    cs = getCryosparcToolsClient()
+    project = cs.find_project(protocol.projectName.get())
+    job = project.create_external_job(protocol.workSpaceName.get(),
+                                      "Import particles")
+    outputName = 'imported_particles'
+    particles = None
+    start = 0
+    for columns in iterParticleColumns(imgSet, filesDict=filesDict,
+                                       alignType=alignType):
+        fields = relionColumnsToCs(columns, imgSet.getSamplingRate(),
+                                   imgSet.getXDim(), alignType)
+        if particles is None:
+            particles = job.add_output(type="particle", name=outputName,
+                                       slots=getCsSlots(fields),
+                                       title="Imported particles",
+                                       alloc=imgSet.getSize())
+        end = start + len(fields['blob/idx'])
+        for field, values in fields.items():
+            particles[field][start:end] = values
+        start = end
+
+    with job.run():
+        job.save_output(outputName, particles)
+
+    return String(job.uid)
+
+
+def doImportVolumes(protocol, refVolumePath, refVolume, volType, msg,
+                    pendingJobs=None):
+    """
+    :param pendingJobs: see doImportParticlesStar
     :return:
     """
     logger.info(pwutils.yellowStr(msg))
@@ -478,16 +911,16 @@ def doImportVolumes(protocol, refVolumePath, refVolume, volType, msg):
                                 str(params).replace('\'', '"'), '{}',
                                 protocol.lane)
 
-    waitForCryosparc(protocol.projectName.get(), importedVolume.get(),
-                     "An error occurred importing the volume. "
-                     "Please, go to cryoSPARC software for more "
-                     "details."
-                     )
+    _waitForImport(protocol.projectName.get(), importedVolume.get(),
+                   "An error occurred importing the volume. "
+                   "Please, go to cryoSPARC software for more "
+                   "details.", pendingJobs)
 
     return importedVolume
 
 
-def doImportMicrographs(protocol):
+def doImportMicrographs(protocol, pendingJobs=None):
+    """ :param pendingJobs: see doImportParticlesStar """
     print(pwutils.yellowStr("Importing micrographs..."), flush=True)
     className = "import_micrographs"
     micrographs = protocol._getInputMicrographs()
@@ -514,10 +947,10 @@ def doImportMicrographs(protocol):
     import_particles = enqueueJob(className, protocol.projectName, protocol.workSpaceName,
                                   str(params).replace('\'', '"'), '{}', protocol.lane)
 
-    waitForCryosparc(protocol.projectName.get(), import_particles.get(),
-                     "An error occurred importing particles. "
-                     "Please, go to cryoSPARC software for more "
-                     "details.")
+    _waitForImport(protocol.projectName.get(), import_particles.get(),
+                   "An error occurred importing particles. "
+                   "Please, go to cryoSPARC software for more "
+                   "details.", pendingJobs)
 
     return import_particles
 
@@ -527,12 +960,9 @@ def doJob(jobType, projectName, workSpaceName, params, input_group_connect):
     do_job(job_type, puid='P1', wuid='W1', uuid='devuser', params={},
            input_group_connects={})
     """
-    do_job_cmd = (getCryosparcProgram() +
-                  ' %sdo_job("%s","%s","%s", "%s", %s, %s)%s' %
-                  ("'", jobType, projectName, workSpaceName, getCryosparcUser(),
-                   params, input_group_connect, "'"))
-
-    return runCmd(do_job_cmd)
+    return callCryosparc('do_job', jobType, projectName, workSpaceName,
+                         getCryosparcUser(), _toDict(params),
+                         _toDict(input_group_connect), printCmd=True)
 
 
 def enqueueJob(jobType, projectName, workSpaceName, params, input_group_connect,
@@ -560,41 +990,38 @@ def enqueueJob(jobType, projectName, workSpaceName, params, input_group_connect,
     #                      getCryosparcUser(),
     #                      params, input_group_connect, "'"))
 
+    projectName = str(projectName)
+    workSpaceName = str(workSpaceName)
+    params = _toDict(params)
+    input_group_connect = _toDict(input_group_connect)
+
     # Create a compatible job to versions >= v3.0.X < v4_3_1
     if parse_version(V3_0_0) <= parse_version(cryosparcVersion) < parse_version(V4_3_1):
-        make_job_cmd = (getCryosparcProgram() +
-                        ' %smake_job("%s","%s","%s", "%s", "None", "None", %s, %s, "False", 0)%s' %
-                        ("'", jobType, projectName, workSpaceName,
-                         getCryosparcUser(),
-                         params, input_group_connect, "'"))
+        make_job_args = (jobType, projectName, workSpaceName,
+                         getCryosparcUser(), "None", "None",
+                         params, input_group_connect, "False", 0)
 
     # Create a compatible job to versions >= v4_3_1
     elif parse_version(cryosparcVersion) >= parse_version(V4_3_1):
-        make_job_cmd = (getCryosparcProgram() +
-                        ' %smake_job("%s","%s","%s", "%s", "None", "None", "None", %s, %s, "False", 0)%s' %
-                        ("'", jobType, projectName, workSpaceName,
-                         getCryosparcUser(),
-                         params, input_group_connect, "'"))
+        make_job_args = (jobType, projectName, workSpaceName,
+                         getCryosparcUser(), "None", "None", "None",
+                         params, input_group_connect, "False", 0)
 
-    exitCode, cmdOutput = runCmd(make_job_cmd)
+    cmdOutput = callCryosparc('make_job', *make_job_args, printCmd=True)
 
     # Extract the jobId
-    jobId = String(cmdOutput.split()[-1])
+    jobId = String(str(cmdOutput).split()[-1])
 
     if group_connect is not None:
         for key, valuesList in group_connect.items():
             for value in valuesList:
-                job_connect_group = (getCryosparcProgram() +
-                                     ' %sjob_connect_group("%s", "%s", "%s")%s' %
-                                     ("'", projectName, value, (str(jobId) + "." + key), "'"))
-                runCmd(job_connect_group, printCmd=False)
+                callCryosparc('job_connect_group', projectName, value,
+                              str(jobId) + "." + key)
 
     if result_connect is not None:
         for key, value in result_connect.items():
-            job_connect_group = (getCryosparcProgram() +
-                                 ' %sjob_connect_result("%s", "%s", "%s")%s' %
-                                 ("'", projectName, value, (str(jobId) + "." + key), "'"))
-            runCmd(job_connect_group, printCmd=True)
+            callCryosparc('job_connect_result', projectName, value,
+                          str(jobId) + "." + key, printCmd=True)
 
     logger.info(pwutils.greenStr("Got %s for JobId" % jobId))
 
@@ -622,45 +1049,27 @@ def enqueueJob(jobType, projectName, workSpaceName, params, input_group_connect,
     if parse_version(cryosparcVersion) <= parse_version(V3_3_2):
         if standaloneInstallation:
             hostname = getCryosparcEnvInformation('master_hostname')
-            if gpusToUse:
-                gpusToUse = str(gpusToUse)
             no_check_inputs_ready = False
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s", "%s", %s, "%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, hostname, gpusToUse,
-                                no_check_inputs_ready, "'"))
+            enqueue_job_args = (projectName, str(jobId), lane, hostname,
+                                gpusToUse, str(no_check_inputs_ready))
         else:
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, "'"))
+            enqueue_job_args = (projectName, str(jobId), lane)
     elif parse_version(cryosparcVersion) >= parse_version(V4_0_0):
         user = getCryosparcUser()
         if standaloneInstallation:
             hostname = getCryosparcEnvInformation('master_hostname')
-            if gpusToUse:
-                gpusToUse = str(gpusToUse)
             no_check_inputs_ready = False
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s", "%s", "%s", %s, "%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, user, hostname, gpusToUse,
-                                no_check_inputs_ready, "'"))
+            enqueue_job_args = (projectName, str(jobId), lane, user, hostname,
+                                gpusToUse, str(no_check_inputs_ready))
         else:
-            enqueue_job_cmd = (getCryosparcProgram() +
-                               ' %senqueue_job("%s","%s","%s","%s")%s' %
-                               ("'", projectName, jobId,
-                                lane, user, "'"))
-    runCmd(enqueue_job_cmd)
+            enqueue_job_args = (projectName, str(jobId), lane, user)
+    callCryosparc('enqueue_job', *enqueue_job_args, printCmd=True)
 
     return jobId
 
 
-def customLatentTrajectory(latentsPoints, projectId, workspaceId, trainingJobId):
-    """Output the trajectory as a new output in CryoSPARC.
-       The resulting trajectory may be used as input to the 3D Flex Generator job
-       to generate a volume series along the trajectory."""
+def getCryosparcToolsClient():
+    """ Return a cryosparc-tools client logged in with the plugin credentials """
     from cryosparc.tools import CryoSPARC
 
     credentials = _getCredentials()
@@ -669,12 +1078,18 @@ def customLatentTrajectory(latentsPoints, projectId, workspaceId, trainingJobId)
         raise Exception("Error obtaining cryoSPARC's credentials: %s" % credentials[1])
 
     credentials = credentials[1]
-    cs = CryoSPARC(license=credentials['license'],
-                   host=credentials['host'],
-                   base_port=int(credentials['base_port']),
-                   email=credentials['email'],
-                   password=credentials['password'])
+    return CryoSPARC(license=credentials['license'],
+                     host=credentials['host'],
+                     base_port=int(credentials['base_port']),
+                     email=credentials['email'],
+                     password=credentials['password'])
+
 
+def customLatentTrajectory(latentsPoints, projectId, workspaceId, trainingJobId):
+    """Output the trajectory as a new output in CryoSPARC.
+       The resulting trajectory may be used as input to the 3D Flex Generator job
+       to generate a volume series along the trajectory."""
+    cs = getCryosparcToolsClient()
     project = cs.find_project(projectId)
     particles = project.find_job(trainingJobId).load_output("particles")
     numComponents = int(len([x for x in particles.fields() if "components_mode" in x]) / 2)
@@ -778,37 +1193,26 @@ def waitForCryosparc(projectName, jobId, failureMessage, protocol=None):
     :returns job Status
     :raises Exception when parsing cryosparc's output looks wrong"""
 
-    # While is needed here, cause waitJob has a timeout of 5 secs.
+    # The master returns from wait_job_complete as soon as the job finishes
+    # (or after WAIT_JOB_TIMEOUT), so each iteration is a long poll. When
+    # cryoSPARC can not be reached we retry with an increasing delay.
+    retryDelays = None
     while True:
         try:
-            status = getJobStatus(projectName, jobId)
-            if status not in STOP_STATUSES:
-                waitJob(projectName, jobId)
-                if protocol is not None:
-                    jobStreamLog = getJobStreamlog(projectName, jobId)
-                    jobStreamLogList = eval(jobStreamLog[1])
-                    jobLogLastLine = protocol.getLogLine()
-                    lenLog = len(jobStreamLogList)
-                    if lenLog > jobLogLastLine:
-                        protocol.setLogLine(lenLog)
-                        for line in range(jobLogLastLine, lenLog):
-                            logDict = jobStreamLogList[line]
-                            if logDict['type'] == 'text' and 'text' in logDict and logDict['text']:
-                                logger.info(logDict['text'])
-                    else:
-                        jobLogLastLine = len(jobStreamLogList) - 1
-                        while jobLogLastLine:
-                            logDict = jobStreamLogList[jobLogLastLine]
-                            if logDict['type'] == 'text' and 'text' in logDict and logDict['text']:
-                                logger.info(logDict['text'])
-                                break
-                            jobLogLastLine -= 1
-            else:
+            status = waitJob(projectName, jobId)
+            if protocol is not None:
+                _printJobStreamlog(projectName, jobId, protocol)
+            retryDelays = None
+            if status in STOP_STATUSES:
                 break
         except Exception as e:
-            logger.error("Can't query cryoSPARC about the job %s. Maybe it needs a restart ? We'll wait 5 minutes" % jobId, exc_info=e)
-            import time
-            time.sleep(300)  # wait 5 minutes
+            if retryDelays is None:
+                retryDelays = backoffDelays()
+            delay = next(retryDelays)
+            logger.error("Can't query cryoSPARC about the job %s. Maybe it needs "
+                         "a restart ? We'll retry in %0.1f seconds" % (jobId, delay),
+                         exc_info=e)
+            time.sleep(delay)
 
     if status != STATUS_COMPLETED:
         raise Exception(failureMessage)
@@ -816,70 +1220,208 @@ def waitForCryosparc(projectName, jobId, failureMessage, protocol=None):
     return status
 
 
+def waitForCryosparcJobs(projectName, jobs):
+    """ Wait for several jobs that run at the same time. All of them are
+    awaited even if some fail, and the failures are reported together
+    :parameter jobs: list of (jobId, failureMessage)
+    :raises Exception with the messages of all the failed jobs"""
+    errors = []
+    for jobId, failureMessage in jobs:
+        try:
+            waitForCryosparc(projectName, jobId, failureMessage)
+        except Exception as e:
+            logger.error("Job %s failed: %s" % (jobId, e))
+            errors.append("%s: %s" % (jobId, e))
+    if errors:
+        raise Exception("\n".join(errors))
+
+
+def backoffDelays(minDelay=RETRY_MIN_DELAY, maxDelay=RETRY_MAX_DELAY):
+    """ Generate exponentially increasing delays (capped to maxDelay) with a
+    random jitter, so several clients do not retry at the same time """
+    delay = minDelay
+    while True:
+        yield random.uniform(delay / 2., delay)
+        delay = min(delay * 2, maxDelay)
+
+
+def _printJobStreamlog(projectName, jobId, protocol):
+    """ Print the job event log lines that were not printed yet. Only the
+    events after the protocol log cursor are fetched """
+    jobLogLastLine = protocol.getLogLine()
+    newEvents = getJobStreamlog(projectName, jobId, fromIndex=jobLogLastLine)
+    if newEvents:
+        protocol.setLogLine(jobLogLastLine + len(newEvents))
+        for logDict in newEvents:
+            if logDict['type'] == 'text' and 'text' in logDict and logDict['text']:
+                logger.info(logDict['text'])
+                protocol.setLogLastText(logDict['text'])
+    elif protocol.getLogLastText():
+        logger.info(protocol.getLogLastText())
+
+
 def getJobStatus(projectName, job):
     """
     Return the job status
     """
-    get_job_status_cmd = (getCryosparcProgram() +
-                          ' %sget_job_status("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    status = runCmd(get_job_status_cmd, printCmd=False)
-    return status[-1]
+    return str(callCryosparc('get_job_status', str(projectName), str(job)))
 
 
 def getJob(projectName, job):
     """
        Return the job
        """
-    get_job_status_cmd = (getCryosparcProgram() +
-                          ' %sget_job("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    job = runCmd(get_job_status_cmd, printCmd=False)
-    return job
+    return callCryosparc('get_job', str(projectName), str(job))
 
 
 def getJobLog(projectName, job):
     """
        Get the full contents of the given job's standard output log
        """
-    get_job_log_cmd = (getCryosparcProgram() +
-                          ' %sget_job_log("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
-
-    logStr = runCmd(get_job_log_cmd, printCmd=False)
-    return logStr
+    return callCryosparc('get_job_log', str(projectName), str(job))
 
 
-def getJobStreamlog(projectName, job):
+def getJobStreamlog(projectName, job, fromIndex=0):
     """
        Get a list of dictionaries representing the given job's event log
+       :param fromIndex: index of the first event to return. If the master
+              supports it, only these events are transferred
        """
-    get_job_stream_log_cmd = (getCryosparcProgram() +
-                          ' %sget_job_streamlog("%s", "%s")%s'
-                          % ("'", projectName, job, "'"))
+    offsetParams = _getStreamlogOffsetParams() if fromIndex else None
+    if offsetParams is not None:
+        projectParam, jobParam, offsetParam = offsetParams
+        return getCommandClient().call('get_job_streamlog',
+                                       **{projectParam: str(projectName),
+                                          jobParam: str(job),
+                                          offsetParam: fromIndex})
+
+    return callCryosparc('get_job_streamlog', str(projectName), str(job))[fromIndex:]
+
+
+def _getStreamlogOffsetParams():
+    """ Find out, from the procedures the master describes, if
+    get_job_streamlog accepts the index of the first event to return.
+    :returns the names of the (project, job, offset) parameters or None
+    """
+    client = getCommandClient()
+    if client is None:
+        return None
 
-    logList = runCmd(get_job_stream_log_cmd, printCmd=False)
-    return logList
+    def describe():
+        try:
+            procs = client.call('system.describe').get('procs', [])
+        except Exception as e:
+            logger.debug("Couldn't get the cryoSPARC procedures: %s" % e)
+            return None
+        for proc in procs:
+            if proc.get('name') == 'get_job_streamlog':
+                names = [param.get('name') if isinstance(param, dict) else param
+                         for param in proc.get('params', [])]
+                offsetNames = [name for name in names[2:]
+                               if name in STREAMLOG_OFFSET_PARAMS]
+                if offsetNames:
+                    return names[0], names[1], offsetNames[0]
+        return None
+
+    return _metadataCache.get(('streamlog_offset',), describe,
+                              CACHE_TTL_SYSTEM_INFO)
 
 
-def waitJob(projectName, job):
+def waitJob(projectName, job, timeout=WAIT_JOB_TIMEOUT):
     """
-    Wait while the job not finished
+    Wait while the job not finished (at most timeout seconds)
+    :returns the job status
     """
-    wait_job_cmd = (getCryosparcProgram() +
-                    ' %swait_job_complete("%s", "%s")%s'
-                    % ("'", projectName, job, "'"))
-    runCmd(wait_job_cmd, printCmd=False)
+    status = callCryosparc('wait_job_complete', str(projectName), str(job),
+                           timeout)
+    if status not in STOP_STATUSES + ACTIVE_STATUSES:
+        status = getJobStatus(projectName, job)
+    return status
 
 
 def get_job_streamlog(projectName, job, fileName):
-    get_job_streamlog_cmd = (getCryosparcProgram() +
-                             ' %sget_job_streamlog("%s", "%s")%s%s'
-                             % ("'", projectName, job, "'", ">" + fileName))
+    with open(fileName, 'w') as f:
+        f.write(str(getJobStreamlog(projectName, job)))
+
+
+class StreamlogIndex:
+    """ Compact summary of a job event log: last iteration, FSC file ids per
+    iteration, map resolution, B-factor and the ids of the files attached to
+    the events. The events are parsed one by one and only once: the index is
+    kept in a json file and updated with the new events of the job.
+    """
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self.numEvents = 0
+        self.lastIteration = None
+        self.fscFileIds = {}
+        self.lastFscFileId = None
+        self.tightMaskFscFileId = None
+        self.doneIteration = None
+        self.classIteration = None
+        self.mapResolution = None
+        self.estBFactor = None
+        self.fileIds = {}
+        if os.path.exists(fileName):
+            with open(fileName) as f:
+                self.__dict__.update(json.load(f))
+
+    def update(self, projectName, job):
+        """ Parse the job events that were not indexed yet and save the
+        index if something changed """
+        events = getJobStreamlog(projectName, job, fromIndex=self.numEvents)
+        if events:
+            for event in events:
+                self.addEvent(event)
+            self.save()
+        return self
+
+    def save(self):
+        values = {key: value for key, value in self.__dict__.items()
+                  if not key.startswith('_')}
+        with open(self._fileName, 'w') as f:
+            json.dump(values, f)
+
+    def addEvent(self, event):
+        self.numEvents += 1
+        imgFiles = event.get('imgfiles') or []
+        for imgFile in imgFiles:
+            if 'filename' in imgFile:
+                self.fileIds[imgFile['filename']] = imgFile['fileid']
+
+        if 'text' not in event:
+            return
+        text = str(event['text'])
+
+        if text.startswith('FSC Iteration') or text.startswith('FSC iIteration'):
+            self.lastIteration = text.split(',')[0][-3:]
+            for imgFile in imgFiles:
+                if imgFile['filetype'] == 'txt':
+                    self.lastFscFileId = imgFile['fileid']
+                    self.fscFileIds[self.lastIteration] = self.lastFscFileId
+                    break
+        elif text.startswith('FSC, after mask auto-tightening'):
+            self.tightMaskFscFileId = imgFiles[2]['fileid']
+        elif text.startswith('Done iteration'):
+            self.doneIteration = text.split(' ')[2]
+        elif 'Using Filter Radius' in text:
+            self.mapResolution = text.split('(')[1].split(')')[0].replace('A', 'Å')
+        elif 'Estimated Bfactor' in text:
+            self.estBFactor = text.split(':')[1].replace('\n', '')
+        else:
+            it = None
+            if text.startswith('Batch Class Distribution (Iteration:'):
+                it = text.split(': ')[1].split(')')[0]
+            elif text.startswith('Viewing Direction Distribution (Iteration'):
+                it = text.split(' ')[4].split(')')[0]
+            if it is not None:
+                self.classIteration = it.zfill(3)
+
 
-    runCmd(get_job_streamlog_cmd, printCmd=False)
+def getStreamlogIndex(projectName, job, fileName):
+    """ Return the StreamlogIndex of a job, stored in fileName and updated
+    with the latest job events """
+    return StreamlogIndex(fileName).update(projectName, job)
 
 
 def killJob(projectName, job):
@@ -888,10 +1430,7 @@ def killJob(projectName, job):
     :param projectName: the uid of the project that contains the job to kill
     :param job: the uid of the job to kill
     """
-    kill_job_cmd = (getCryosparcProgram() +
-                    ' %skill_job("%s", "%s")%s'
-                    % ("'", projectName, job, "'"))
-    runCmd(kill_job_cmd, printCmd=True)
+    callCryosparc('kill_job', str(projectName), str(job), printCmd=True)
 
 
 def clearJob(projectName, job):
@@ -902,10 +1441,7 @@ def clearJob(projectName, job):
         :param job: the uid of the job to clear
         ** IMPORTANT: This method can be launch only if the job is queued
         """
-    clear_job_cmd = (getCryosparcProgram() +
-                     ' %sclear_job("%s", "%s")%s'
-                     % ("'", projectName, job, "'"))
-    runCmd(clear_job_cmd, printCmd=False)
+    callCryosparc('clear_job', str(projectName), str(job))
 
 
 def clearIntermediateResults(projectName, job, wait=3):
@@ -915,10 +1451,7 @@ def clearIntermediateResults(projectName, job, wait=3):
     :param job: the uid of the job to clear
     """
     logger.info(pwutils.yellowStr("Removing intermediate results..."))
-    clear_int_results_cmd = (getCryosparcProgram() +
-                             ' %sclear_intermediate_results("%s", "%s")%s'
-                             % ("'", projectName, job, "'"))
-    runCmd(clear_int_results_cmd, printCmd=False)
+    callCryosparc('clear_intermediate_results', str(projectName), str(job))
     # wait a delay in order to delete intermediate results correctly
     time.sleep(wait)
 
@@ -939,24 +1472,25 @@ def getSystemInfo():
         'version' : get_running_version(),
     }
     """
-    system_info_cmd = (getCryosparcProgram() + " 'get_system_info()'")
-    return runCmd(system_info_cmd, printCmd=False)
+    return _metadataCache.get(('system_info',),
+                              lambda: callCryosparc('get_system_info'),
+                              CACHE_TTL_SYSTEM_INFO)
 
 
 def userExist(email):
     """
     Return if an user exist into cryoSPARC
     """
-    getUser_cmd = (getCryosparcProgram() + ' %sUserExists("%s")%s' % ("'", email, "'"))
-    return runCmd(getUser_cmd, printCmd=False)[1] == 'True'
+    return _metadataCache.get(('user_exists', str(email)),
+                              lambda: callCryosparc('UserExists', str(email)) is True,
+                              CACHE_TTL_USERS)
 
 
 def getUserId(email):
     """Get the user Id taking into account the user email"""
-    import ast
-    getUser_cmd = (getCryosparcProgram() + ' %sGetUser("%s")%s' % ("'", email, "'"))
-    user = runCmd(getUser_cmd, printCmd=False)
-    return ast.literal_eval(user[1])['_id']
+    return _metadataCache.get(('user_id', str(email)),
+                              lambda: callCryosparc('GetUser', str(email))['_id'],
+                              CACHE_TTL_USERS)
 
 
 def _getCredentials():
@@ -996,9 +1530,9 @@ def getSchedulerLanes():
     csValidate = cryosparcValidate()
     if not csValidate:
         try:
-            lanes_info_cmd = (getCryosparcProgram() + " 'get_scheduler_lanes()'")
-            _csLanes = runCmd(lanes_info_cmd, printCmd=False)[1]
-            lanes_dict_list = eval(_csLanes)
+            lanes_dict_list = _metadataCache.get(('lanes',),
+                                                 lambda: callCryosparc('get_scheduler_lanes'),
+                                                 CACHE_TTL_LANES)
             _csLanes = []
             for lanes in lanes_dict_list:
                 _csLanes.append(lanes.get('name'))
@@ -1144,28 +1678,296 @@ def fixVolume(paths):
     if isinstance(paths, str):
         paths = [paths]
     for path in paths:
+        unshareFile(path)
         ccp4header = Ccp4Header(path, readHeader=True)
         ccp4header.setISPG(1)
         ccp4header.writeHeader()
 
 
-def copyFiles(src, dst, files=None):
+def copyFiles(src, dst, files=None, include=None, mode=None):
     """
     Copy a list of files from src to dst. If files is None, all files of src are
     copied to dst
     :param src: source folder path
     :param dst: destiny folder path
     :param files: a list of files to be copied
-    :return:
-    """
+    :param include: optional list of glob patterns, only the files of src whose
+                    relative path or name matches one of them are copied
+    :param mode: how the files are placed (see COPY_MODES), by default
+                 the one given by getCopyMode
+    :return: the list of files that could not be copied
+    """
+    mode = mode or getCopyMode()
+    if mode not in COPY_MODES:
+        raise Exception("Unknown copy mode %s, the valid ones are: %s"
+                        % (mode, ', '.join(COPY_MODES)))
     try:
         if files is None:
-            shutil.copytree(src, dst)
-        else:
-            if isinstance(files, str):
-                files = [files]
-            for file in files:
-                shutil.copy(os.path.join(src, file),
-                            os.path.join(dst, file))
+            files = _listFiles(src, include)
+            os.makedirs(dst, exist_ok=True)
+        elif isinstance(files, str):
+            files = [files]
     except Exception as ex:
         logger.error("Unable to execute the copy: Files or directory does not exist: ", exc_info=ex)
+        return [src]
+    return placeFiles(src, dst, files, mode)
+
+
+def useLazyOutputs():
+    """ Whether the outputs reference the cryoSPARC job files in place """
+    return pwutils.envVarOn(CRYOSPARC_LAZY_OUTPUTS)
+
+
+def getCopyMode():
+    """ Default mode of copyFiles: CRYOSPARC_COPY_MODE if it is defined,
+    symlinks for lazy outputs and COPY_MODE_AUTO otherwise """
+    defaultMode = COPY_MODE_SYMLINK if useLazyOutputs() else COPY_MODE_AUTO
+    return os.environ.get(CRYOSPARC_COPY_MODE) or defaultMode
+
+
+def materializeFiles(folder, target=None):
+    """ Replace the symlinks of folder by the files they point to (hardlinked
+    or copied, see placeFile), e.g. before the cryoSPARC job they reference
+    is cleared
+    :param target: if given, only the links to files inside this folder are
+                   replaced
+    :returns the list of links that could not be replaced
+    """
+    target = os.path.realpath(target) if target else None
+    links = []
+    for root, _, fileNames in os.walk(folder):
+        for fileName in fileNames:
+            link = os.path.join(root, fileName)
+            if not os.path.islink(link):
+                continue
+            srcFile = os.path.realpath(link)
+            if target is None or srcFile.startswith(target + os.sep):
+                links.append((srcFile, link))
+
+    def materialize(srcFile, link):
+        if placeFile(srcFile, link) == COPY_MODE_COPY:
+            verifyCopy(srcFile, link)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=getCopyThreads()) as executor:
+        futures = {executor.submit(materialize, *files): files[1]
+                   for files in links}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                logger.error("Unable to materialize %s" % futures[future],
+                             exc_info=ex)
+                failed.append(futures[future])
+    if links:
+        logger.info("%d files materialized in %s"
+                    % (len(links) - len(failed), folder))
+    return failed
+
+
+def getCopyThreads():
+    return max(1, int(os.environ.get(CRYOSPARC_COPY_THREADS,
+                                     COPY_DEFAULT_THREADS)))
+
+
+def placeFiles(src, dst, files, mode=COPY_MODE_AUTO):
+    """ Place several files of src in dst (see placeFile), a few of them at
+    the same time. The copied files are verified with their checksum and
+    recorded in a manifest of dst, so that a copy that was interrupted only
+    copies the remaining files when it is repeated
+    :returns the list of files that could not be placed
+    """
+    manifest = CopyManifest(os.path.join(dst, COPY_MANIFEST_FILE))
+
+    def place(file):
+        srcFile, dstFile = os.path.join(src, file), os.path.join(dst, file)
+        if manifest.isCopied(file, srcFile, dstFile):
+            return
+        if placeFile(srcFile, dstFile, mode) == COPY_MODE_COPY:
+            checksum = verifyCopy(srcFile, dstFile)
+            manifest.add(file, srcFile, checksum)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=getCopyThreads()) as executor:
+        futures = {executor.submit(place, file): file for file in files}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                logger.error("Unable to copy %s to %s"
+                             % (os.path.join(src, futures[future]), dst),
+                             exc_info=ex)
+                failed.append(futures[future])
+    return failed
+
+
+class CopyManifest:
+    """ Files copied to a folder, one JSON line per file with the size and
+    modification time of the source and the checksum of the copy """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.fileName) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue  # the last line of an interrupted copy
+                        self._entries[entry['file']] = entry
+            except OSError:
+                pass
+        return self._entries
+
+    def isCopied(self, file, srcFile, dstFile):
+        """ True if srcFile was already copied to dstFile and has not changed
+        since then """
+        with self._lock:
+            entry = self._load().get(file)
+        if entry is None or not os.path.isfile(dstFile):
+            return False
+        stat = os.stat(srcFile)
+        return (entry['size'] == stat.st_size == os.path.getsize(dstFile) and
+                entry['mtime'] == stat.st_mtime_ns)
+
+    def add(self, file, srcFile, checksum):
+        stat = os.stat(srcFile)
+        entry = {'file': file, 'size': stat.st_size,
+                 'mtime': stat.st_mtime_ns, 'checksum': checksum}
+        with self._lock:
+            self._load()[file] = entry
+            with open(self.fileName, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def verifyCopy(srcFile, dstFile):
+    """ Compare the checksums of srcFile and its copy dstFile
+    :returns the checksum
+    """
+    checksum = getFileFingerprint(srcFile)
+    if getFileFingerprint(dstFile) != checksum:
+        os.remove(dstFile)
+        raise Exception("The copy of %s is corrupted" % srcFile)
+    return checksum
+
+
+def _listFiles(src, include=None):
+    """ Return the paths, relative to src, of the files under src that match
+    any of the include patterns (all of them if include is None) """
+    if not os.path.isdir(src):
+        raise FileNotFoundError(src)
+    files = []
+    for root, _, fileNames in os.walk(src, followlinks=True):
+        for fileName in fileNames:
+            relPath = os.path.relpath(os.path.join(root, fileName), src)
+            if fileName == COPY_MANIFEST_FILE:
+                continue
+            if include is None or any(fnmatch.fnmatch(relPath, pattern) or
+                                      fnmatch.fnmatch(fileName, pattern)
+                                      for pattern in include):
+                files.append(relPath)
+    return files
+
+
+def _reflink(src, dst):
+    """ Clone src into dst sharing its blocks (copy-on-write) """
+    import fcntl
+    with open(src, 'rb') as fSrc, open(dst, 'wb') as fDst:
+        try:
+            fcntl.ioctl(fDst.fileno(), FICLONE, fSrc.fileno())
+        except OSError:
+            fDst.close()
+            os.remove(dst)
+            raise
+    shutil.copymode(src, dst)
+
+
+def _copyFile(src, dst):
+    """ Copy src into dst in large blocks, in the kernel (copy_file_range or
+    sendfile) when it is possible """
+    with open(src, 'rb') as fSrc, open(dst, 'wb') as fDst:
+        size = os.fstat(fSrc.fileno()).st_size
+        offset = 0
+        for copyRange in [getattr(os, 'copy_file_range', None),
+                          getattr(os, 'sendfile', None)]:
+            if copyRange is None:
+                continue
+            fDst.seek(offset)  # sendfile writes at the current position
+            try:
+                while offset < size:
+                    if copyRange is os.sendfile:
+                        copied = os.sendfile(fDst.fileno(), fSrc.fileno(),
+                                             offset, COPY_CHUNK_SIZE)
+                    else:
+                        copied = copyRange(fSrc.fileno(), fDst.fileno(),
+                                           COPY_CHUNK_SIZE, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                break
+            except OSError:
+                continue  # e.g. not supported between these filesystems
+        if offset < size:
+            fSrc.seek(offset)
+            fDst.seek(offset)
+            shutil.copyfileobj(fSrc, fDst, COPY_CHUNK_SIZE)
+    shutil.copymode(src, dst)
+
+
+_placeFunctions = {COPY_MODE_HARDLINK: os.link,
+                   COPY_MODE_REFLINK: _reflink,
+                   COPY_MODE_SYMLINK: lambda src, dst: os.symlink(os.path.abspath(src), dst),
+                   COPY_MODE_COPY: _copyFile}
+
+
+def unshareFile(path):
+    """ Replace a symlink or hardlink by a copy of the file, so that it can
+    be modified without changing the cryoSPARC output """
+    if os.path.islink(path) or os.stat(path).st_nlink > 1:
+        tmpFile = '%s.%d.tmp' % (path, os.getpid())
+        shutil.copy(path, tmpFile)
+        os.replace(tmpFile, path)
+
+
+def placeFile(src, dst, mode=COPY_MODE_AUTO):
+    """ Place the file src in dst, replacing it if it exists. In auto mode a
+    hardlink is tried first, then a reflink and then a plain copy, so the
+    data is only duplicated when the filesystem can not share it. Linked
+    files must not be modified in place (see unshareFile)
+    :returns the mode used
+    """
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    # dst is only replaced once src is placed, it may be a link to src
+    tmpFile = '%s.%d.%d.tmp' % (dst, os.getpid(), threading.get_ident())
+    if os.path.lexists(tmpFile):
+        os.remove(tmpFile)
+    try:
+        if mode == COPY_MODE_AUTO:
+            mode = _placeAuto(src, tmpFile)
+        else:
+            _placeFunctions[mode](src, tmpFile)
+        os.replace(tmpFile, dst)
+        if os.path.lexists(tmpFile):  # dst was already a hardlink of src
+            os.remove(tmpFile)
+    except BaseException:
+        if os.path.lexists(tmpFile):
+            os.remove(tmpFile)
+        raise
+    return mode
+
+
+def _placeAuto(src, dst):
+    src = os.path.realpath(src)
+    for mode in [COPY_MODE_HARDLINK, COPY_MODE_REFLINK]:
+        try:
+            _placeFunctions[mode](src, dst)
+            return mode
+        except OSError:
+            pass  # e.g. other filesystem, not supported or not permitted
+    _copyFile(src, dst)
+    return COPY_MODE_COPY
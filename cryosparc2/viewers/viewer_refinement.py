@@ -192,10 +192,7 @@ class CryosPARCViewer3DRefinement(EmProtocolViewer):
     def _showCryoSPARVolume(self, paramName=None):
         views = []
         system_info = getSystemInfo()
-        status_errors = system_info[0]
-        print(status_errors)
-        if not status_errors:
-            system_info = eval(system_info[1])
+        if system_info:
             master_hostname = system_info.get('master_hostname')
             port_webapp = system_info.get('port_webapp')
             port_app = system_info.get('port_app')